@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Times `UploadSet.extension_allowed` with the compiled `ExtensionPolicy`
+against the tuple scans it replaced, for a few kinds of extension lists.
+
+Run it from the repository root::
+
+    python benchmarks/extension_check.py
+"""
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from flask import Flask
+from flask_uploads import (UploadSet, configure_uploads, DEFAULTS, ALL,
+                           AllExcept, SCRIPTS, EXECUTABLES)
+
+
+class TupleScanSet(UploadSet):
+    # The check as it was before policies were compiled.
+    def extension_allowed(self, ext):
+        return ((ext in self.config.allow) or
+                (ext in self.extensions and ext not in self.config.deny))
+
+
+def bench(extensions, number):
+    app = Flask(__name__)
+    app.config.update(UPLOADED_NEW_DEST='/tmp', UPLOADED_OLD_DEST='/tmp',
+                      UPLOADED_NEW_ALLOW=['bin'], UPLOADED_OLD_ALLOW=['bin'],
+                      UPLOADED_NEW_DENY=['svg', 'doc'],
+                      UPLOADED_OLD_DENY=['svg', 'doc'])
+    new = UploadSet('new', extensions)
+    old = TupleScanSet('old', extensions)
+    configure_uploads(app, (new, old))
+    # The worst case for a tuple is an extension it doesn't contain.
+    exts = ('txt', 'webp', 'exe', 'bin', 'svg', 'zzz')
+    results = []
+    with app.app_context():
+        for uset in (old, new):
+            check = uset.extension_allowed
+            assert [check(e) for e in exts] == \
+                [new.extension_allowed(e) for e in exts]
+
+            def run():
+                for ext in exts:
+                    check(ext)
+            results.append(min(timeit.repeat(run, number=number, repeat=5)))
+    return results
+
+
+def main(number=20000):
+    cases = (('DEFAULTS', DEFAULTS), ('ALL', ALL),
+             ('AllExcept', AllExcept(SCRIPTS + EXECUTABLES)))
+    print('%-10s %12s %12s %8s' % ('extensions', 'tuple scan', 'policy',
+                                   'speedup'))
+    for label, extensions in cases:
+        old, new = bench(extensions, number)
+        per_check = 1e9 / (number * 6)
+        print('%-10s %10.0fns %10.0fns %7.1fx' %
+              (label, old * per_check, new * per_check, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,25 +9,60 @@ an `UploadSet` object and upload your files to it.
 :license:   MIT/X11, see LICENSE for details
 """
 
-import sys
-
-PY3 = sys.version_info[0] == 3
-
-if PY3:
-    string_types = str,
-else:
-    string_types = basestring,
+# Flask-Uploads needs Python 3.6 or later. These names are kept from when it
+# also ran on Python 2.
+PY3 = True
+string_types = str,
+text_type = str
+from urllib.parse import quote as url_quote
 
+import asyncio
+import base64
+import calendar
+import collections
+import errno
+import gzip
+import hashlib
+import json
+import mimetypes
 import os.path
 import posixpath
+import re
+import shutil
+import stat
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
 
-from flask import current_app, send_from_directory, abort, url_for
+from flask import (current_app, request, send_file,
+                   abort, jsonify, url_for, g, has_request_context)
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+from io import BytesIO
 from itertools import chain
 from werkzeug.datastructures import FileStorage
+from werkzeug.formparser import default_stream_factory
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
 
 from flask import Blueprint
 
+# Flask's context variable for the app context is private, and only exists
+# since Flask 2.2. Without it, `_current_app` goes through the proxy.
+try:
+    from flask.globals import _cv_app
+except ImportError:
+    _cv_app = None
+try:
+    from lzma import LZMAError
+except ImportError:
+    LZMAError = EOFError
+
 # Extension presets
 
 #: This just contains plain text files (.txt).
@@ -86,6 +121,66 @@ EXECUTABLES = tuple('so exe dll'.split())
 #: The default allowed extensions - `TEXT`, `DOCUMENTS`, `DATA`, and `IMAGES`.
 DEFAULTS = TEXT + DOCUMENTS + IMAGES + DATA
 
+#: The values the `UPLOADED_X_FSYNC` setting can have.
+FSYNC_POLICIES = ('none', 'file', 'file+dir')
+
+#: The values the `UPLOADED_X_SERVE` setting can have.
+SERVE_MODES = ('python', 'xsendfile', 'xaccel')
+
+#: How long, in seconds, browsers are told they can cache files from
+#: content-addressed sets, whose contents never change. (One year.)
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+#: The content codings `UPLOADED_X_COMPRESS` can use, and the suffix each
+#: one's compressed copies are given.
+COMPRESSIONS = {'gzip': '.gz', 'br': '.br', 'zstd': '.zst'}
+
+#: The extensions of the files `UPLOADED_X_COMPRESS` compresses - `TEXT`,
+#: `DATA`, `SCRIPTS` and .svg. Other formats are usually compressed already.
+COMPRESSIBLE = frozenset(TEXT + DATA + SCRIPTS + ('svg',))
+
+_ZIP = (b'PK\x03\x04', b'PK\x05\x06')
+_OLE = (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1',)
+_GZIP = (b'\x1f\x8b',)
+_JPEG = (b'\xff\xd8\xff',)
+_OGG = (b'OggS',)
+
+#: The magic numbers files with the extensions in `IMAGES`, `DOCUMENTS`,
+#: `AUDIO` and `ARCHIVES` start with, used when `UPLOADED_X_SNIFF` is set.
+#: Each extension has a tuple of signatures, and a file matches if it has
+#: any of them. A signature is either the bytes the file starts with, or a
+#: tuple of ``(offset, bytes)`` pairs that must all be there. Formats that
+#: are plain text, like ``svg``, can't be told apart by their first bytes,
+#: so they aren't listed and aren't checked.
+SIGNATURES = {
+    # IMAGES
+    'jpg': _JPEG, 'jpe': _JPEG, 'jpeg': _JPEG,
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'gif': (b'GIF87a', b'GIF89a'),
+    'bmp': (b'BM',),
+    'webp': (((0, b'RIFF'), (8, b'WEBP')),),
+    # DOCUMENTS
+    'rtf': (b'{\\rtf',),
+    'pdf': (b'%PDF-',),
+    'doc': _OLE, 'xls': _OLE,
+    'docx': _ZIP, 'xlsx': _ZIP, 'odf': _ZIP, 'ods': _ZIP,
+    'gnumeric': _GZIP,
+    # AUDIO
+    'wav': (((0, b'RIFF'), (8, b'WAVE')),),
+    'mp3': (b'ID3', b'\xff\xfb', b'\xff\xfa', b'\xff\xf3', b'\xff\xf2',
+            b'\xff\xe3'),
+    'aac': (b'\xff\xf1', b'\xff\xf9', b'ADIF'),
+    'ogg': _OGG, 'oga': _OGG,
+    'flac': (b'fLaC',),
+    # ARCHIVES
+    'gz': _GZIP, 'tgz': _GZIP,
+    'bz2': (b'BZh',),
+    'zip': _ZIP,
+    'tar': (((257, b'ustar'),),),
+    'txz': (b'\xfd7zXZ\x00',),
+    '7z': (b'7z\xbc\xaf\x27\x1c',),
+}
+
 
 class UploadNotAllowed(Exception):
     """
@@ -94,6 +189,87 @@ class UploadNotAllowed(Exception):
     """
 
 
+class UploadTooLarge(UploadNotAllowed):
+    """
+    This exception is raised if an upload is bigger than its set's
+    `UPLOADED_X_MAX_SIZE`, or would take the files saved to the set during
+    the current request past `UPLOADED_X_MAX_REQUEST_SIZE`. Nothing is left
+    behind when it is raised. It is an `UploadNotAllowed`, so code that
+    already catches that keeps working.
+    """
+
+
+class SavedFile(text_type):
+    """
+    This is what `UploadSet.save` returns. It is the name the file was saved
+    under (including the folder), so it can be used anywhere a filename can,
+    but it also carries some details about the saved file. The constructor's
+    arguments other than `name` are also the attributes.
+
+    :param name: The name the file was saved under.
+    :param digest: The hex digest of the file's contents, if the set is
+                   configured to hash uploads. Otherwise it is `None`.
+    :param size: The number of bytes saved, or `None` if it isn't known.
+    :param created: `False` if the contents were already stored and nothing
+                    had to be written, as with content-addressed sets.
+    """
+    #: The `ProcessingQueueFull` raised if the file couldn't be queued for
+    #: the set's post-processing stages, or `None`. The file is saved either
+    #: way, so it can be queued again later with `UploadSet.process`.
+    processing_error = None
+
+    def __new__(cls, name, digest=None, size=None, created=True):
+        self = text_type.__new__(cls, name)
+        self.digest = digest
+        self.size = size
+        self.created = created
+        return self
+
+    def __repr__(self):
+        return '<SavedFile %s>' % text_type.__repr__(self)
+
+    def within(self, folder):
+        """
+        This returns a copy of this result, with its name inside `folder`.
+
+        :param folder: The folder to put the name in. If it is empty, the
+                       result is returned as is.
+        """
+        if not folder:
+            return self
+        return SavedFile(posixpath.join(folder, self), self.digest,
+                         self.size, self.created)
+
+
+def content_name(digest, ext):
+    """
+    This returns the name a file with the given digest and extension is
+    stored under in a content-addressed set, like ``ab/cd/abcd1234.jpg``.
+
+    :param digest: The hex digest of the file's contents.
+    :param ext: The file's extension, without the dot. It may be empty.
+    """
+    name = digest + '.' + ext if ext else digest
+    return posixpath.join(digest[:2], digest[2:4], name)
+
+
+#: The hidden folder in a set's destination that deduplicated sets keep the
+#: single stored copy of each file's contents in.
+BLOB_FOLDER = '.blobs'
+
+
+def blob_path(destination, digest):
+    """
+    This returns the path a deduplicated set stores the contents with the
+    given digest at.
+
+    :param destination: The set's destination.
+    :param digest: The hex digest of the contents.
+    """
+    return os.path.join(destination, BLOB_FOLDER, digest[:2], digest[2:4],
+                        digest)
+
+
 def tuple_from(*iters):
     return tuple(itertools.chain(*iters))
 
@@ -194,6 +370,97 @@ def config_for_set(uset, app, defaults=None):
     deny_extns = tuple(config.get(prefix + 'DENY', ()))
     destination = config.get(prefix + 'DEST')
     base_url = config.get(prefix + 'URL')
+    atomic = config.get(prefix + 'ATOMIC', False)
+    resumable = config.get(prefix + 'RESUMABLE', False)
+    resumable_ttl = config.get(prefix + 'RESUMABLE_TTL', 24 * 60 * 60)
+    buffer_size = config.get(prefix + 'BUFFER_SIZE', 16384)
+    content_addressed = config.get(prefix + 'CONTENT_ADDRESSED', False)
+    deduplicate = config.get(prefix + 'DEDUPLICATE', False)
+    hash_name = config.get(prefix + 'HASH')
+    max_size = config.get(prefix + 'MAX_SIZE')
+    max_request_size = config.get(prefix + 'MAX_REQUEST_SIZE')
+    content_types = tuple(config.get(prefix + 'CONTENT_TYPES', ()))
+    backend = config.get(prefix + 'BACKEND')
+    if isinstance(backend, string_types):
+        try:
+            factory = BACKENDS[backend]
+        except KeyError:
+            raise ValueError("%sBACKEND must be one of %s, or a "
+                             "StorageBackend" %
+                             (prefix, ', '.join(sorted(BACKENDS))))
+        backend = factory(app, uset, prefix)
+    if hash_name is None and (content_addressed or deduplicate):
+        hash_name = 'sha256'
+    if hash_name is not None:
+        # fail at configuration time rather than on the first upload
+        hashlib.new(hash_name)
+    fsync = config.get(prefix + 'FSYNC', 'none')
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError("%sFSYNC must be one of %s" %
+                         (prefix, ', '.join(FSYNC_POLICIES)))
+    serve = config.get(prefix + 'SERVE', 'python')
+    if serve not in SERVE_MODES:
+        raise ValueError("%sSERVE must be one of %s" %
+                         (prefix, ', '.join(SERVE_MODES)))
+    serve_prefix = config.get(prefix + 'SERVE_PREFIX')
+    shard = config.get(prefix + 'SHARD')
+    if isinstance(shard, string_types):
+        try:
+            shard = SHARDS[shard]
+        except KeyError:
+            raise ValueError("%sSHARD must be one of %s, or a callable" %
+                             (prefix, ', '.join(sorted(SHARDS))))
+    variants = dict(config.get(prefix + 'VARIANTS') or {})
+    for variant, size in variants.items():
+        width, height = size
+        variants[variant] = (int(width), int(height))
+    if variants and find_spec('PIL') is None:
+        raise RuntimeError("%sVARIANTS requires Pillow" % prefix)
+    variants_eager = config.get(prefix + 'VARIANTS_EAGER', False)
+    compress = config.get(prefix + 'COMPRESS') or ()
+    if isinstance(compress, string_types):
+        compress = (compress,)
+    compress = tuple(compress)
+    compress_only = config.get(prefix + 'COMPRESS_ONLY', False)
+    if compress_only and not compress:
+        compress = ('gzip',)
+    for encoding in compress:
+        if encoding not in COMPRESSIONS:
+            raise ValueError("%sCOMPRESS can only use %s" %
+                             (prefix, ', '.join(sorted(COMPRESSIONS))))
+    if 'br' in compress and find_spec('brotli') is None:
+        raise RuntimeError("%sCOMPRESS with br requires brotli" % prefix)
+    if 'zstd' in compress and find_spec('zstandard') is None:
+        raise RuntimeError("%sCOMPRESS with zstd requires zstandard" % prefix)
+    if compress and not (backend is None or
+                         isinstance(backend, LocalStorage)):
+        raise ValueError("%sCOMPRESS only works with the local backend" %
+                         prefix)
+    if compress_only and compress[0] != 'gzip':
+        raise ValueError("%sCOMPRESS_ONLY stores files with gzip, so it must "
+                         "come first in %sCOMPRESS" % (prefix, prefix))
+    if compress_only and (content_addressed or deduplicate):
+        raise ValueError("%sCOMPRESS_ONLY can't be used with "
+                         "content-addressed or deduplicated sets" % prefix)
+    archive_max_members = config.get(prefix + 'ARCHIVE_MAX_MEMBERS', 1000)
+    archive_max_size = config.get(prefix + 'ARCHIVE_MAX_SIZE')
+    archive_max_ratio = config.get(prefix + 'ARCHIVE_MAX_RATIO', 100)
+    sniff = config.get(prefix + 'SNIFF', False)
+    if sniff is True:
+        sniff = SIGNATURES
+    elif sniff:
+        sniff = dict(SIGNATURES, **sniff)
+    else:
+        sniff = None
+    stat_cache = config.get(prefix + 'STAT_CACHE')
+    if stat_cache:
+        stat_cache = StatCache(stat_cache,
+                               config.get(prefix + 'STAT_CACHE_TTL', 5))
+    else:
+        stat_cache = None
+    if serve == 'xaccel' and serve_prefix is None:
+        raise ValueError("%sSERVE_PREFIX is needed to serve with xaccel" %
+                         prefix)
 
     if destination is None:
         # the upload set's destination wasn't given
@@ -205,13 +472,29 @@ def config_for_set(uset, app, defaults=None):
             if defaults['dest'] is not None:
                 using_defaults = True
                 destination = os.path.join(defaults['dest'], uset.name)
-            else:
+            elif backend is None or isinstance(backend, LocalStorage):
                 raise RuntimeError("no destination for set %s" % uset.name)
 
     if base_url is None and using_defaults and defaults['url']:
         base_url = addslash(defaults['url']) + uset.name + '/'
 
-    return UploadConfiguration(destination, base_url, allow_extns, deny_extns)
+    return UploadConfiguration(destination, base_url, allow_extns, deny_extns,
+                               atomic=atomic, buffer_size=buffer_size,
+                               fsync=fsync, hash=hash_name,
+                               content_addressed=content_addressed,
+                               deduplicate=deduplicate, backend=backend,
+                               resumable=resumable,
+                               resumable_ttl=resumable_ttl, max_size=max_size,
+                               max_request_size=max_request_size,
+                               content_types=content_types, serve=serve,
+                               serve_prefix=serve_prefix,
+                               stat_cache=stat_cache, shard=shard,
+                               variants=variants,
+                               variants_eager=variants_eager, sniff=sniff,
+                               compress=compress, compress_only=compress_only,
+                               archive_max_members=archive_max_members,
+                               archive_max_size=archive_max_size,
+                               archive_max_ratio=archive_max_ratio)
 
 
 def configure_uploads(app, upload_sets):
@@ -233,15 +516,22 @@ def configure_uploads(app, upload_sets):
 
     if not hasattr(app, 'upload_set_config'):
         app.upload_set_config = {}
+        app.upload_sets = {}
     set_config = app.upload_set_config
     defaults = dict(dest=app.config.get('UPLOADS_DEFAULT_DEST'),
                     url=app.config.get('UPLOADS_DEFAULT_URL'))
 
     for uset in upload_sets:
         config = config_for_set(uset, app, defaults)
+        config.policy = ExtensionPolicy(uset.extensions, config.allow,
+                                        config.deny)
+        if config.sniff is not None:
+            config.signatures = SignatureTable(config.policy, config.sniff)
         set_config[uset.name] = config
+        app.upload_sets[uset.name] = uset
 
-    should_serve = any(s.base_url is None for s in set_config.values())
+    should_serve = any(s.base_url is None or s.resumable or s.variants
+                       for s in set_config.values())
     if '_uploads' not in app.blueprints and should_serve:
         app.register_blueprint(uploads_mod)
 
@@ -279,6 +569,110 @@ class AllExcept(object):
         return item not in self.items
 
 
+class ExtensionPolicy(object):
+    """
+    This is an `UploadSet`'s extensions, combined with its `ALLOW` and
+    `DENY` settings, compiled into frozensets so that checking an extension
+    is a single hash lookup. `configure_uploads` compiles one for each set,
+    and `UploadSet.extension_allowed` uses it. `ALL` and `AllExcept` are
+    compiled to the set of extensions they *don't* allow, so they work the
+    same way. Any other kind of container is kept as it is and asked
+    directly.
+
+    An extension is allowed if it is in `allow`, or if it is in
+    `extensions` and not in `deny`. The policy is a snapshot, so changes to
+    a mutable `extensions` list made afterwards aren't seen.
+
+    :param extensions: The set's extensions, as passed to `UploadSet`.
+    :param allow: Extensions to allow anyway.
+    :param deny: Extensions to refuse anyway.
+    """
+    def __init__(self, extensions, allow=(), deny=()):
+        self.extensions = extensions
+        self.allow = frozenset(allow)
+        self.deny = frozenset(deny)
+        #: The extensions refused, for `ALL` and `AllExcept`, or `None`.
+        self.blocked = None
+        #: The extensions allowed, for a plain list or set, or `None`.
+        self.allowed = None
+        if isinstance(extensions, All):
+            self.blocked = self.deny - self.allow
+        elif (isinstance(extensions, AllExcept) and
+              isinstance(extensions.items, (tuple, list, set, frozenset))):
+            self.blocked = ((frozenset(extensions.items) | self.deny) -
+                            self.allow)
+        elif isinstance(extensions, (tuple, list, set, frozenset)):
+            self.allowed = (frozenset(extensions) - self.deny) | self.allow
+
+    def allows(self, ext):
+        """
+        This returns whether `ext` (without the dot) is allowed.
+
+        :param ext: The extension to check, without the dot.
+        """
+        if self.blocked is not None:
+            return ext not in self.blocked
+        if self.allowed is not None:
+            return ext in self.allowed
+        return ext in self.allow or (ext in self.extensions and
+                                     ext not in self.deny)
+
+    def __contains__(self, ext):
+        return self.allows(ext)
+
+
+class SignatureTable(object):
+    """
+    This is the `SIGNATURES` of an `UploadSet`'s extensions, compiled into
+    one regular expression per extension, so checking a file's first bytes
+    is a single match. `configure_uploads` compiles one for each set that
+    has `UPLOADED_X_SNIFF` turned on, and `UploadSet.content_allowed` uses
+    it.
+
+    :param extensions: The extensions to compile signatures for, like
+                       `IMAGES`. `ALL` and `AllExcept` work too.
+    :param signatures: The signatures to pick from, in the same form as
+                       `SIGNATURES`.
+    """
+    def __init__(self, extensions, signatures=None):
+        if signatures is None:
+            signatures = SIGNATURES
+        self.extensions = extensions
+        self.patterns = {}
+        #: How many bytes from the start of a file the signatures look at.
+        self.size = 0
+        for ext, sigs in signatures.items():
+            if ext not in extensions:
+                continue
+            alternatives = []
+            for sig in sigs:
+                if isinstance(sig, bytes):
+                    sig = ((0, sig),)
+                pattern = b''
+                end = 0
+                for offset, data in sorted(sig):
+                    pattern += b'.{%d}' % (offset - end) + re.escape(data)
+                    end = offset + len(data)
+                alternatives.append(pattern)
+                self.size = max(self.size, end)
+            self.patterns[ext] = re.compile(
+                b'(?:' + b'|'.join(alternatives) + b')', re.DOTALL).match
+
+    def matches(self, ext, head):
+        """
+        This returns whether `head`, the first `size` bytes of a file, fits
+        the extension `ext`. Extensions without signatures always fit.
+
+        :param ext: The extension, without the dot.
+        :param head: The start of the file.
+        """
+        match = self.patterns.get(ext.lower())
+        return match is None or match(head) is not None
+
+    def __contains__(self, ext):
+        return ext.lower() in self.patterns
+
+
 class UploadConfiguration(object):
     """
     This holds the configuration for a single `UploadSet`. The constructor's
@@ -292,202 +686,3837 @@ class UploadConfiguration(object):
                   `UploadSet` extensions list.
     :param deny: A list of extensions to deny, even if they are in the
                  `UploadSet` extensions list.
+    :param atomic: If `True`, files are written to a temporary file in the
+                   target folder and then published under their final name
+                   in one step that never overwrites an existing file.
+    :param buffer_size: The number of bytes copied at a time when an upload
+                        has to be copied in Python.
+    :param fsync: One of `FSYNC_POLICIES`. ``none`` leaves flushing to the
+                  operating system, ``file`` calls `os.fsync` on each saved
+                  file, and ``file+dir`` also syncs the folder it was saved
+                  in, so the new name survives a crash too.
+    :param hash: The name of a `hashlib` algorithm, like ``sha256`` or
+                 ``blake2b``. If it is given, every upload is hashed while it
+                 is saved, and the digest is available from the `SavedFile`
+                 that `UploadSet.save` returns.
+    :param content_addressed: If `True`, files are stored under a name made
+                              from their digest (see `content_name`), and
+                              files whose contents are already stored aren't
+                              written again. This uses ``sha256`` if `hash`
+                              isn't given.
+    :param deduplicate: If `True`, each distinct content is stored once in
+                        `BLOB_FOLDER`, and saved files are hard links to it,
+                        under the names they would have had anyway. This
+                        uses ``sha256`` if `hash` isn't given, and it is
+                        ignored if `content_addressed` is set.
+    :param backend: The `StorageBackend` the set's files are kept in. The
+                    default is a `LocalStorage` for `destination`.
+    :param resumable: If `True`, clients can upload files to this set in
+                      pieces through the uploads module, and pick up where
+                      they left off if the connection drops. See
+                      `ResumableUpload`.
+    :param resumable_ttl: How many seconds an unfinished resumable upload is
+                          kept after the last data arrived for it, or `None`
+                          to keep it until it is finished or deleted.
+    :param max_size: The largest file, in bytes, the set accepts, or `None`
+                     for no limit of its own.
+    :param max_request_size: The most bytes, in total, that can be saved to
+                             the set during one request, or `None` for no
+                             limit.
+    :param content_types: The content types files may be declared as, like
+                          ``image/png``, or ``image/*`` for a whole family.
+                          If it is empty, the declared type isn't checked.
+    :param serve: One of `SERVE_MODES`: how the uploads module sends the
+                  set's files. ``python`` sends them from Python, while
+                  ``xsendfile`` and ``xaccel`` hand them to the Web server
+                  with an ``X-Sendfile`` or ``X-Accel-Redirect`` header.
+                  The Web server modes only apply to `LocalStorage`.
+    :param serve_prefix: For ``xaccel``, the internal nginx location the
+                         set's destination is served from.
+    :param stat_cache: A `StatCache` for `UploadSet.stat`, `UploadSet.exists`
+                       and the uploads module to use, or `None`.
+    :param shard: A function that picks the subfolder each saved file goes
+                  in, like `shard_by_hash` or `shard_by_date`, or `None` to
+                  save files in the folder they were given. It is ignored
+                  by content-addressed sets, whose names are already
+                  sharded.
+    :param variants: A dict of image variant names, like ``thumb``, to the
+                     ``(width, height)`` box each variant is shrunk to fit.
+                     See `make_variant`.
+    :param variants_eager: If `True`, every variant of an image is made in
+                           the background as soon as it is saved, instead
+                           of when it is first requested.
+    :param sniff: The `SIGNATURES` to check the first bytes of files
+                  against, or `None` not to check them.
+    :param compress: The content codings from `COMPRESSIONS` that
+                     `COMPRESSIBLE` files are compressed with when they are
+                     saved, in the order the server prefers them. See
+                     `compress_file`.
+    :param compress_only: If `True`, `COMPRESSIBLE` files are stored only
+                          gzipped, under their own names.
+    :param archive_max_members: The most entries an archive given to
+                                `UploadSet.save_archive` can have, or `None`
+                                for no limit.
+    :param archive_max_size: The most bytes an archive's files can add up
+                             to once extracted, or `None` for no limit.
+    :param archive_max_ratio: How many times bigger than the archive its
+                              extracted files can be, or `None` for no
+                              limit. It is checked once they add up to a
+                              megabyte, so small, very compressible
+                              archives get through.
     """
-    def __init__(self, destination, base_url=None, allow=(), deny=()):
+    def __init__(self, destination, base_url=None, allow=(), deny=(),
+                 atomic=False, buffer_size=16384, fsync='none', hash=None,
+                 content_addressed=False, deduplicate=False, backend=None,
+                 resumable=False, max_size=None, max_request_size=None,
+                 resumable_ttl=24 * 60 * 60,
+                 content_types=(), serve='python', serve_prefix=None,
+                 stat_cache=None, shard=None, variants=None,
+                 variants_eager=False, sniff=None, compress=(),
+                 compress_only=False, archive_max_members=1000,
+                 archive_max_size=None, archive_max_ratio=100):
         self.destination = destination
         self.base_url = base_url
         self.allow = allow
         self.deny = deny
+        self.atomic = atomic
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        if hash is None and (content_addressed or deduplicate):
+            hash = 'sha256'
+        self.hash = hash
+        self.content_addressed = content_addressed
+        self.deduplicate = deduplicate
+        if backend is None:
+            backend = LocalStorage(destination)
+        self.backend = backend
+        self.resumable = resumable
+        self.resumable_ttl = resumable_ttl
+        self.max_size = max_size
+        self.max_request_size = max_request_size
+        self.content_types = content_types
+        self.serve = serve
+        self.serve_prefix = serve_prefix
+        self.stat_cache = stat_cache
+        self.shard = shard
+        self.variants = variants or {}
+        self.variants_eager = variants_eager
+        self.sniff = sniff
+        self.compress = compress
+        self.compress_only = compress_only
+        self.archive_max_members = archive_max_members
+        self.archive_max_size = archive_max_size
+        self.archive_max_ratio = archive_max_ratio
+        #: The `ExtensionPolicy` compiled for the set, or `None` until the
+        #: set first needs it.
+        self.policy = None
+        #: The `SignatureTable` compiled for the set, or `None` until the
+        #: set first needs it.
+        self.signatures = None
 
     @property
     def tuple(self):
-        return (self.destination, self.base_url, self.allow, self.deny)
+        return (self.destination, self.base_url, self.allow, self.deny,
+                self.atomic, self.buffer_size, self.fsync, self.hash,
+                self.content_addressed, self.deduplicate, self.backend,
+                self.resumable, self.resumable_ttl, self.max_size,
+                self.max_request_size,
+                self.content_types, self.serve, self.serve_prefix,
+                self.shard, self.variants, self.variants_eager, self.sniff,
+                self.compress, self.compress_only, self.archive_max_members,
+                self.archive_max_size, self.archive_max_ratio)
 
     def __eq__(self, other):
         return self.tuple == other.tuple
 
 
-class UploadSet(object):
+# The filename used to find out where the uploads module's URLs start. It
+# doesn't need quoting, so it appears in the URL as it is.
+_URL_PLACEHOLDER = 'uploads-url-placeholder'
+
+
+def _current_app():
     """
-    This represents a single set of uploaded files. Each upload set is
-    independent of the others. This can be reused across multiple application
-    instances, as all configuration is stored on the application object itself
-    and found with `flask.current_app`.
+    This returns the application handling the current request, or `None`
+    outside of one. It reads Flask's context variable directly where it can,
+    which is many times cheaper than going through the `current_app` proxy,
+    and that adds up for code like `UploadSet.url` that runs hundreds of
+    times a page.
+    """
+    if _cv_app is not None:
+        ctx = _cv_app.get(None)
+        return ctx.app if ctx is not None else None
+    try:
+        return current_app._get_current_object()
+    except RuntimeError:
+        return None
 
-    :param name: The name of this upload set. It defaults to ``files``, but
-                 you can pick any alphanumeric name you want. (For simplicity,
-                 it's best to use a plural noun.)
-    :param extensions: The extensions to allow uploading in this set. The
-                       easiest way to do this is to add together the extension
-                       presets (for example, ``TEXT + DOCUMENTS + IMAGES``).
-                       It can be overridden by the configuration with the
-                       `UPLOADED_X_ALLOW` and `UPLOADED_X_DENY` configuration
-                       parameters. The default is `DEFAULTS`.
-    :param default_dest: If given, this should be a callable. If you call it
-                         with the app, it should return the default upload
-                         destination path for that app.
+
+def _unlink_quietly(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _temp_path(target_folder):
+    return os.path.join(target_folder, '.%s.part' % uuid.uuid4().hex)
+
+
+def _fsync_dir(folder):
+    # Directories can't be opened on Windows, and don't need syncing there.
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _overrides_save(storage):
+    # Subclasses like TestingFileStorage that replace save() get their own
+    # method called, instead of having their stream copied behind their back.
+    return getattr(type(storage), 'save', None) is not FileStorage.save
+
+
+def _fileno(stream):
     """
-    def __init__(self, name='files', extensions=DEFAULTS, default_dest=None):
-        if not name.isalnum():
-            raise ValueError("Name must be alphanumeric (no underscores)")
-        self.name = name
-        self.extensions = extensions
-        self._config = None
-        self.default_dest = default_dest
+    This returns the descriptor of the regular file behind `stream`, or
+    `None` if there isn't one. An unrolled `SpooledTemporaryFile` is still in
+    memory, and asking it for a descriptor would force it onto disk, so that
+    counts as not having one.
+    """
+    if isinstance(stream, tempfile.SpooledTemporaryFile):
+        if not getattr(stream, '_rolled', True):
+            return None
+        stream = stream._file
+    try:
+        fd = stream.fileno()
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            return fd
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
 
-    @property
-    def config(self):
-        """
-        This gets the current configuration. By default, it looks up the
-        current application and gets the configuration from there. But if you
-        don't want to go to the full effort of setting an application, or it's
-        otherwise outside of a request context, set the `_config` attribute to
-        an `UploadConfiguration` instance, then set it back to `None` when
-        you're done.
-        """
-        if self._config is not None:
-            return self._config
+
+# The errno values that mean a zero-copy system call can't be used between
+# two particular files, so the next method should be tried.
+_COPY_UNSUPPORTED = frozenset(getattr(errno, code) for code in
+                              ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP',
+                               'ENOTSUP', 'ENOTSOCK', 'EBADF', 'EPERM')
+                              if hasattr(errno, code))
+
+
+def _copy_fd(src, dst, offset, count):
+    """
+    This copies `count` bytes from `offset` in `src` to the current position
+    of `dst`, inside the kernel. It returns the number of bytes copied, or
+    `None` if neither `os.copy_file_range` nor `os.sendfile` can be used.
+    That can be less than `count` if the kernel stops copying early, so the
+    caller has to copy the rest itself.
+    """
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        copied = 0
         try:
-            return current_app.upload_set_config[self.name]
-        except AttributeError:
-            raise RuntimeError("cannot access configuration outside request")
+            while copied < count:
+                if name == 'sendfile':
+                    n = func(dst, src, offset + copied, count - copied)
+                else:
+                    n = func(src, dst, count - copied, offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as e:
+            if copied or e.errno not in _COPY_UNSUPPORTED:
+                raise
+            continue
+        return copied
+    return None
 
-    def url(self, filename):
-        """
-        This function gets the URL a file uploaded to this set would be
-        accessed at. It doesn't check whether said file exists.
 
-        :param filename: The filename to return the URL for.
-        """
-        base = self.config.base_url
-        if base is None:
-            return url_for('_uploads.uploaded_file', setname=self.name,
-                           filename=filename, _external=True)
-        else:
-            return base + filename
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
 
-    def path(self, filename, folder=None):
-        """
-        This returns the absolute path of a file uploaded to this set. It
-        doesn't actually check whether said file exists.
 
-        :param filename: The filename to return the path for.
-        :param folder: The subfolder within the upload set previously used
-                       to save to.
-        """
-        if folder is not None:
-            target_folder = os.path.join(self.config.destination, folder)
-        else:
-            target_folder = self.config.destination
-        return os.path.join(target_folder, filename)
+def _seekable(stream):
+    try:
+        return stream.seekable()
+    except AttributeError:
+        try:
+            stream.seek(stream.tell())
+        except Exception:
+            return False
+        return True
+    except (OSError, ValueError):
+        return False
 
-    def file_allowed(self, storage, basename):
-        """
-        This tells whether a file is allowed. It should return `True` if the
-        given `werkzeug.FileStorage` object can be saved with the given
-        basename, and `False` if it can't. The default implementation just
-        checks the extension, so you can override this if you want.
 
-        :param storage: The `werkzeug.FileStorage` to check.
-        :param basename: The basename it will be saved under.
-        """
-        return self.extension_allowed(extension(basename))
+def hash_stream(stream, hasher, buffer_size=16384):
+    """
+    This feeds everything left in `stream` into `hasher`, a `hashlib` object,
+    and returns the number of bytes read.
 
-    def extension_allowed(self, ext):
-        """
-        This determines whether a specific extension is allowed. It is called
-        by `file_allowed`, so if you override that but still want to check
-        extensions, call back into this.
+    :param stream: The file-like object to read.
+    :param hasher: The hash object to update.
+    :param buffer_size: The number of bytes to read at a time.
+    """
+    size = 0
+    read = stream.read
+    update = hasher.update
+    while True:
+        chunk = read(buffer_size)
+        if not chunk:
+            return size
+        update(chunk)
+        size += len(chunk)
 
-        :param ext: The extension to check, without the dot.
-        """
-        return ((ext in self.config.allow) or
-                (ext in self.extensions and ext not in self.config.deny))
 
-    def get_basename(self, filename):
-        return lowercase_ext(secure_filename(filename))
+def copy_storage(storage, dst, buffer_size=16384, hasher=None):
+    """
+    This copies an uploaded file into the open binary file `dst`, and returns
+    the number of bytes copied, or `None` if it can't tell. If the upload has
+    been spooled to a file on disk, the copy is done inside the kernel with
+    `os.copy_file_range` or `os.sendfile`, so no data passes through Python.
+    Otherwise it is copied `buffer_size` bytes at a time.
 
-    def save(self, storage, folder=None, name=None):
-        """
-        This saves a `werkzeug.FileStorage` into this upload set. If the
-        upload is not allowed, an `UploadNotAllowed` error will be raised.
-        Otherwise, the file will be saved and its name (including the folder)
-        will be returned.
+    :param storage: The `werkzeug.FileStorage` to copy.
+    :param dst: The file to copy it into.
+    :param buffer_size: The number of bytes to copy at a time when it has to
+                        be done in Python.
+    :param hasher: If given, a `hashlib` object that is updated with the data
+                   as it is copied, so it doesn't have to be read again. The
+                   copy is always done in Python then.
+    """
+    if _overrides_save(storage):
+        storage.save(dst, buffer_size)
+        return None
+    stream = storage.stream
+    if hasher is not None:
+        size = 0
+        read, write, update = stream.read, dst.write, hasher.update
+        while True:
+            chunk = read(buffer_size)
+            if not chunk:
+                return size
+            update(chunk)
+            write(chunk)
+            size += len(chunk)
+    src = _fileno(stream)
+    if src is not None:
+        offset = stream.tell()
+        count = os.fstat(src).st_size - offset
+        dst.flush()
+        try:
+            dst_fd = dst.fileno()
+        except (AttributeError, OSError, ValueError):
+            dst_fd = None
+        if dst_fd is not None:
+            copied = _copy_fd(src, dst_fd, offset, count)
+            if copied is not None:
+                stream.seek(offset + copied)
+                if copied == count:
+                    return copied
+                # Some filesystems make the kernel give up part way, so the
+                # rest is copied in Python.
+                rest = dst.tell()
+                shutil.copyfileobj(stream, dst, buffer_size)
+                return copied + dst.tell() - rest
+    try:
+        start = dst.tell()
+    except (AttributeError, OSError, ValueError):
+        start = None
+    shutil.copyfileobj(stream, dst, buffer_size)
+    if start is not None:
+        return dst.tell() - start
 
-        :param storage: The uploaded file to save.
-        :param folder: The subfolder within the upload set to save to.
-        :param name: The name to save the file as. If it ends with a dot, the
-                     file's extension will be appended to the end. (If you
-                     are using `name`, you can include the folder in the
-                     `name` instead of explicitly using `folder`, i.e.
-                     ``uset.save(file, name="someguy/photo_123.")``
-        """
-        if not isinstance(storage, FileStorage):
-            raise TypeError("storage must be a werkzeug.FileStorage")
 
-        if folder is None and name is not None and "/" in name:
-            folder, name = os.path.split(name)
+def write_storage(storage, path, buffer_size=16384, fsync=False,
+                  exclusive=False, hasher=None):
+    """
+    This writes an uploaded file to `path`, using the fastest way available,
+    and returns the number of bytes written, or `None` if it can't tell. A
+    spooled file is copied inside the kernel with `copy_storage`, and
+    anything else is copied `buffer_size` bytes at a time. (To not copy an
+    upload at all, stream it into place with `UploadSet.stream_request`.)
 
-        basename = self.get_basename(storage.filename)
-        
-        if not self.file_allowed(storage, basename):
-            raise UploadNotAllowed()
-        
-        if name:
-            if name.endswith('.'):
-                basename = name + extension(basename)
+    :param storage: The `werkzeug.FileStorage` to write.
+    :param path: The path to write it to.
+    :param buffer_size: The number of bytes to copy at a time when it has to
+                        be done in Python.
+    :param fsync: If `True`, the file's data is flushed to disk with
+                  `os.fsync` before this returns.
+    :param exclusive: If `True`, `path` must not exist yet.
+    :param hasher: If given, a `hashlib` object that is updated with the
+                   file's data while it is written.
+    """
+    if _overrides_save(storage) and not exclusive:
+        storage.save(path, buffer_size)
+        if hasher is not None:
+            with open(path, 'rb') as f:
+                return hash_stream(f, hasher, buffer_size)
+        return None
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    flags |= os.O_EXCL if exclusive else os.O_TRUNC
+    with os.fdopen(os.open(path, flags, 0o666), 'w+b') as dst:
+        if hasher is not None and _overrides_save(storage):
+            storage.save(dst, buffer_size)
+            dst.seek(0)
+            size = hash_stream(dst, hasher, buffer_size)
+        else:
+            size = copy_storage(storage, dst, buffer_size, hasher)
+        if fsync:
+            dst.flush()
+            os.fsync(dst.fileno())
+    return size
+
+
+# The errno values that mean os.link isn't supported for a file, as opposed
+# to the target already existing.
+_LINK_UNSUPPORTED = frozenset(getattr(errno, code) for code in
+                             ('EPERM', 'EXDEV', 'EMLINK', 'ENOTSUP',
+                              'EOPNOTSUPP', 'ENOSYS')
+                             if hasattr(errno, code))
+
+
+def _hash_ahead(storage, config):
+    """
+    If the upload's stream can be rewound, this hashes it with the set's
+    algorithm without writing anything, and returns the digest and size.
+    Otherwise it returns ``(None, None)``.
+    """
+    stream = storage.stream
+    if _overrides_save(storage) or not _seekable(stream):
+        return None, None
+    start = stream.tell()
+    hasher = hashlib.new(config.hash)
+    size = hash_stream(stream, hasher, config.buffer_size)
+    stream.seek(start)
+    return hasher.hexdigest(), size
+
+
+def publish(temp, target_folder, candidates, copy=False):
+    """
+    This gives a finished temporary file its final name, without ever
+    overwriting an existing file. Each basename from `candidates` is tried in
+    turn with `os.link`, which fails if the name is taken, so a conflict
+    costs one system call and no extra `stat`. It returns the basename that
+    was used, or `None` if `candidates` ran out. The temporary file is left
+    in place for the caller to remove.
+
+    If the filesystem doesn't support hard links, the name is claimed with
+    ``O_CREAT | O_EXCL`` instead and the temporary file is renamed over it,
+    or copied over it if `copy` is `True`.
+
+    :param temp: The path of the finished temporary file.
+    :param target_folder: The folder to publish into. It should be on the
+                          same filesystem as `temp`.
+    :param candidates: An iterable of basenames to try, in order.
+    :param copy: If `True`, `temp` is never moved, so it can be published
+                 more than once.
+    """
+    link = getattr(os, 'link', None)
+    for candidate in candidates:
+        target = os.path.join(target_folder, candidate)
+        if link is not None:
+            try:
+                link(temp, target)
+                return candidate
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    continue
+                if e.errno not in _LINK_UNSUPPORTED:
+                    raise
+                link = None
+        try:
+            fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            continue
+        os.close(fd)
+        try:
+            if copy:
+                shutil.copyfile(temp, target)
             else:
-                basename = name
+                os.rename(temp, target)
+        except (IOError, OSError):
+            _unlink_quietly(target)
+            raise
+        return candidate
 
 
+class _Budget(object):
+    # The bytes left for a set's files in the current request. It is shared
+    # by every file, possibly across threads in save_many.
+    def __init__(self, limit):
+        self.remaining = limit
+        self.lock = threading.Lock()
 
-        if folder:
-            target_folder = os.path.join(self.config.destination, folder)
-        else:
-            target_folder = self.config.destination
-        if not os.path.exists(target_folder):
-            os.makedirs(target_folder)
-        if os.path.exists(os.path.join(target_folder, basename)):
-            basename = self.resolve_conflict(target_folder, basename)
+    def spend(self, size):
+        with self.lock:
+            if size > self.remaining:
+                return False
+            self.remaining -= size
+            return True
 
-        target = os.path.join(target_folder, basename)
-        storage.save(target)
-        if folder:
-            return posixpath.join(folder, basename)
-        else:
-            return basename
 
-    def resolve_conflict(self, target_folder, basename):
-        """
-        If a file with the selected name already exists in the target folder,
-        this method is called to resolve the conflict. It should return a new
-        basename for the file.
+class _LimitedReader(object):
+    # Wraps an upload stream whose size can't be told in advance, and raises
+    # UploadTooLarge from read() as soon as too many bytes have gone by. It
+    # has no fileno(), so nothing can copy around it.
+    def __init__(self, stream, limit=None, budget=None):
+        self.stream = stream
+        self.limit = limit
+        self.budget = budget
+        self.count = 0
 
-        The default implementation splits the name and extension and adds a
-        suffix to the name consisting of an underscore and a number, and tries
-        that until it finds one that doesn't exist.
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        if ((self.limit is not None and self.count > self.limit) or
+                (self.budget is not None and
+                 not self.budget.spend(len(data)))):
+            raise UploadTooLarge()
+        return data
 
-        :param target_folder: The absolute path to the target.
-        :param basename: The file's original basename.
-        """
-        name, ext = os.path.splitext(basename)
-        count = 0
-        while True:
-            count = count + 1
-            newname = '%s_%d%s' % (name, count, ext)
-            if not os.path.exists(os.path.join(target_folder, newname)):
-                return newname
+    def readable(self):
+        return True
 
+    def close(self):
+        self.stream.close()
 
-uploads_mod = Blueprint('_uploads', __name__, url_prefix='/_uploads')
 
+class _PeekedReader(object):
+    # Puts the bytes read from the start of a stream that can't seek back in
+    # front of the rest of it, so whatever reads it next gets all of it.
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
 
-@uploads_mod.route('/<setname>/<path:filename>')
-def uploaded_file(setname, filename):
-    config = current_app.upload_set_config.get(setname)
-    if config is None:
-        abort(404)
-    return send_from_directory(config.destination, filename)
+    def read(self, size=-1):
+        if not self.head:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data = self.head + self.stream.read()
+            self.head = b''
+            return data
+        data, self.head = self.head[:size], self.head[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.stream.close()
+
+
+class _CountingReader(object):
+    # Counts the bytes read from an archive, so its extracted files can be
+    # measured against it. Everything else is passed through.
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+
+
+# Extracted files are only held to an archive's compression ratio once they
+# add up to this many bytes.
+_RATIO_GRACE = 1024 * 1024
+
+
+class _ArchiveBudget(object):
+    # The bytes an archive's files can still be extracted into. It works
+    # like a _Budget, and runs out when they add up to more than `max_size`,
+    # or to more than `max_ratio` times the bytes read from `source`.
+    def __init__(self, max_size, max_ratio, source):
+        self.max_size = max_size
+        self.max_ratio = max_ratio
+        self.source = source
+        self.total = 0
+
+    def spend(self, size):
+        self.total += size
+        if self.max_size is not None and self.total > self.max_size:
+            return False
+        return (self.max_ratio is None or self.total <= _RATIO_GRACE or
+                self.total <= self.max_ratio * self.source.count)
+
+
+def _member_name(name):
+    """
+    This splits the name of a file in an archive into the folder and
+    basename it is extracted to, cleaned with `secure_filename`, or returns
+    `None` for files that should be left out, like hidden ones. A name that
+    would land outside the folder the archive is extracted into, like
+    ``../../app.py`` or ``/etc/passwd``, raises `UploadNotAllowed`.
+    """
+    name = name.replace('\\', '/')
+    if name.startswith('/') or re.match(r'[A-Za-z]:', name):
+        raise UploadNotAllowed()
+    parts = [part for part in name.split('/') if part not in ('', '.')]
+    if '..' in parts:
+        raise UploadNotAllowed()
+    if not parts or any(part.startswith('.') or part == '__MACOSX'
+                        for part in parts):
+        return None
+    folders = [secure_filename(part) for part in parts[:-1]]
+    return '/'.join(part for part in folders if part), parts[-1]
+
+
+def _peek(storage, size):
+    """
+    This returns the first `size` bytes left in an upload's stream without
+    using them up. A stream that can seek is put back where it was, and one
+    that can't is replaced with one that gives the bytes back first.
+    """
+    stream = storage.stream
+    if _seekable(stream):
+        start = stream.tell()
+        head = stream.read(size)
+        stream.seek(start)
+        return head
+    head = b''
+    while len(head) < size:
+        data = stream.read(size - len(head))
+        if not data:
+            break
+        head += data
+    storage.stream = _PeekedReader(head, stream)
+    return head
+
+
+def _stream_size(storage):
+    """
+    This returns the number of bytes left in an upload's stream, if that can
+    be told without reading it, or `None`.
+    """
+    stream = storage.stream
+    try:
+        stream.flush()
+    except (AttributeError, OSError, ValueError):
+        pass
+    fd = _fileno(stream)
+    try:
+        if fd is not None:
+            return os.fstat(fd).st_size - stream.tell()
+        if _seekable(stream):
+            start = stream.tell()
+            end = stream.seek(0, os.SEEK_END)
+            stream.seek(start)
+            return end - start
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+
+class _CappedFile(object):
+    # Wraps a file Werkzeug writes an upload into, and rejects the request
+    # with 413 as soon as more than `limit` bytes have arrived, or the
+    # request's files have used up `budget`.
+    def __init__(self, file, limit=None, budget=None):
+        self.file = file
+        self.limit = limit
+        self.budget = budget
+        self.written = 0
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def write(self, data):
+        self.written += len(data)
+        if ((self.limit is not None and self.written > self.limit) or
+                (self.budget is not None and
+                 not self.budget.spend(len(data)))):
+            self.close()
+            abort(413)
+        return self.file.write(data)
+
+
+class StreamedFile(_CappedFile):
+    """
+    This is the file object `UploadSet.stream_factory` gives Werkzeug to
+    write an uploaded file into. It is a hidden temporary file in the folder
+    the upload will be saved to, so when the upload is saved anywhere on the
+    same filesystem, it is just given its final name, instead of being
+    copied a second time. If it
+    is never saved, it is deleted when it is closed, which Flask does at the
+    end of the request.
+
+    Everything else, like `read` and `seek`, is passed through to the real
+    file.
+
+    :param path: The path of the temporary file to create.
+    :param limit: If it is given, the request is aborted with 413 as soon as
+                  more than this many bytes are written.
+    :param budget: Used by `UploadSet.stream_factory` to limit the bytes
+                   written by all the files in the request together.
+    """
+    def __init__(self, path, limit=None, budget=None):
+        #: The path of the temporary file, or `None` once it has been given
+        #: its final name.
+        self.path = path
+        _CappedFile.__init__(self, open(path, 'w+b'), limit, budget)
+
+    def __repr__(self):
+        return "<StreamedFile: %r>" % self.path
+
+    def close(self):
+        self.file.close()
+        if self.path is not None:
+            _unlink_quietly(self.path)
+            self.path = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class _Discard(object):
+    # Stands in for the file of an upload that will never be allowed, so
+    # its data is thrown away as it arrives instead of being stored.
+    def write(self, data):
+        return len(data)
+
+    def read(self, size=-1):
+        return b''
+
+    def readline(self, size=-1):
+        return b''
+
+    def seek(self, offset, whence=0):
+        return 0
+
+    def tell(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ConflictResolver(object):
+    """
+    This is the base class for conflict resolution strategies. When an
+    `UploadSet` saves a file, it asks its resolver to *claim* a basename in the
+    target folder, and the resolver returns the basename the file should
+    actually be saved under.
+
+    You can subclass this and pass an instance to the `UploadSet` constructor
+    as `resolver` if you want different naming behavior.
+    """
+    def claim(self, uset, target_folder, basename):
+        """
+        This returns a basename in `target_folder` that is free to be written
+        to. It is passed the `UploadSet` doing the saving so it can call back
+        into `UploadSet.resolve_conflict`.
+
+        :param uset: The upload set that is saving the file.
+        :param target_folder: The absolute path to the target.
+        :param basename: The basename the file would like to have.
+        """
+        raise NotImplementedError
+
+    def candidates(self, target_folder, basename):
+        """
+        This yields the basenames to try, in order, starting with `basename`
+        itself. It never ends, so stop once one of them works. Atomic saves
+        use this instead of `claim`, and try each name by publishing to it.
+
+        The default implementation yields ``name_1.ext``, ``name_2.ext``, and
+        so on without touching the disk.
+
+        :param target_folder: The absolute path to the target.
+        :param basename: The file's original basename.
+        """
+        return suffixed_names(basename)
+
+
+class ProbingResolver(ConflictResolver):
+    """
+    This is the default resolver. If the basename already exists, it defers
+    to `UploadSet.resolve_conflict`, which tries ``name_1.ext``,
+    ``name_2.ext``, and so on until it finds one that doesn't exist. That is
+    one `os.path.exists` call per sibling, so it gets slow in folders that
+    have a lot of files with the same name.
+    """
+    def claim(self, uset, target_folder, basename):
+        if os.path.exists(os.path.join(target_folder, basename)):
+            return uset.resolve_conflict(target_folder, basename)
+        return basename
+
+
+class CountingResolver(ConflictResolver):
+    """
+    This resolver keeps a suffix counter for every name in every folder it
+    has seen. A folder is scanned once, the first time a file is saved to it,
+    and the counters are kept current as files are saved afterwards, so
+    finding a free name does not depend on how many siblings already exist.
+
+    Names are claimed by creating an empty file with ``O_CREAT | O_EXCL``, so
+    two processes saving to the same folder never end up with the same name.
+    If another process got there first, the next suffix is tried.
+
+    One instance can be shared between upload sets and applications, as the
+    counters are kept per absolute folder path. The suffixes it generates are
+    the same ``name_N.ext`` style as `UploadSet.resolve_conflict`, but note
+    that `resolve_conflict` is not called when this resolver is used.
+
+    Only the counters for the `max_folders` most recently used folders are
+    kept, so sharded sets don't grow it without bound. A folder that was
+    dropped is simply scanned again the next time it is saved to.
+
+    :param max_folders: The most folders to keep counters for.
+    """
+    suffix_re = re.compile(r'^(.*)_(\d+)$')
+
+    def __init__(self, max_folders=256):
+        self.max_folders = max_folders
+        self._folders = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _scan(self, target_folder):
+        counters = {}
+        try:
+            names = os.listdir(target_folder)
+        except OSError:
+            names = ()
+        for entry in names:
+            stem, ext = os.path.splitext(entry)
+            match = self.suffix_re.match(stem)
+            if match is None:
+                continue
+            key = (match.group(1), ext)
+            count = int(match.group(2))
+            if count > counters.get(key, 0):
+                counters[key] = count
+        return counters
+
+    def _next(self, target_folder, name, ext):
+        with self._lock:
+            counters = self._folders.get(target_folder)
+            if counters is None:
+                counters = self._folders[target_folder] = \
+                    self._scan(target_folder)
+                while len(self._folders) > self.max_folders:
+                    self._folders.popitem(last=False)
+            else:
+                self._folders.move_to_end(target_folder)
+            count = counters.get((name, ext), 0) + 1
+            counters[(name, ext)] = count
+        return '%s_%d%s' % (name, count, ext)
+
+    def candidates(self, target_folder, basename):
+        target_folder = os.path.abspath(target_folder)
+        yield basename
+        name, ext = os.path.splitext(basename)
+        while True:
+            yield self._next(target_folder, name, ext)
+
+    def forget(self, target_folder=None):
+        """
+        This drops the cached counters for a folder, or for every folder if
+        none is given, so they are rescanned on the next save.
+
+        :param target_folder: The absolute path to forget.
+        """
+        with self._lock:
+            if target_folder is None:
+                self._folders.clear()
+            else:
+                self._folders.pop(os.path.abspath(target_folder), None)
+
+    def claim(self, uset, target_folder, basename):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        for candidate in self.candidates(target_folder, basename):
+            try:
+                fd = os.open(os.path.join(target_folder, candidate), flags,
+                             0o666)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                continue
+            os.close(fd)
+            return candidate
+
+
+def suffixed_names(basename):
+    """
+    This yields `basename`, and then ``name_1.ext``, ``name_2.ext``, and so
+    on, forever. It is what the default `ConflictResolver.candidates` and the
+    storage backends that aren't on local disk use.
+
+    :param basename: The file's original basename.
+    """
+    yield basename
+    name, ext = os.path.splitext(basename)
+    count = 0
+    while True:
+        count = count + 1
+        yield '%s_%d%s' % (name, count, ext)
+
+
+class FileStat(object):
+    """
+    This holds what a storage backend knows about a stored file. The
+    constructor's arguments are also the attributes.
+
+    :param size: The file's size in bytes.
+    :param mtime: When the file was last modified, as a POSIX timestamp.
+    :param etag: An entity tag for the file's current contents, if the
+                 backend has one.
+    """
+    def __init__(self, size, mtime, etag=None):
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+
+    @property
+    def tuple(self):
+        return (self.size, self.mtime, self.etag)
+
+    def __eq__(self, other):
+        return self.tuple == other.tuple
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<FileStat size=%r mtime=%r etag=%r>' % self.tuple
+
+
+class StatCache(object):
+    """
+    This remembers what a set's backend said about its files, so hot files
+    don't cost a metadata round trip to the storage on every request, which
+    adds up on network filesystems. It holds the `FileStat` for each name,
+    or the fact that there is no such file, for at most `ttl` seconds, and
+    forgets the least recently used names once it holds `max_entries`.
+
+    `UploadSet.save` and `UploadSet.delete` drop the names they touch, so
+    changes made through the set are seen right away. Changes made behind
+    its back, or by other processes, are seen once their entries expire.
+    Sets get one when `UPLOADED_X_STAT_CACHE` is set. It is thread safe.
+
+    :param max_entries: The most names to remember.
+    :param ttl: How many seconds an answer is trusted for.
+    """
+    def __init__(self, max_entries=1024, ttl=5):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def stat(self, backend, name):
+        """
+        This returns the `FileStat` for `name`, or `None` if it doesn't
+        exist, asking `backend` only if the answer isn't remembered.
+
+        :param backend: The `StorageBackend` to ask.
+        :param name: The name of the file.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(name)
+                    return entry[1]
+                del self.entries[name]
+            generation = self.generation
+        info = backend.stat(name)
+        with self._lock:
+            # If anything was dropped while the backend was being asked, the
+            # answer may already be out of date, so it isn't kept.
+            if generation == self.generation:
+                self.entries[name] = (now + self.ttl, info)
+                self.entries.move_to_end(name)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return info
+
+    def invalidate(self, name):
+        """
+        This forgets what is known about `name`.
+
+        :param name: The name of the file.
+        """
+        with self._lock:
+            self.generation += 1
+            self.entries.pop(name, None)
+
+    def clear(self):
+        """
+        This forgets everything.
+        """
+        with self._lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+class StorageBackend(object):
+    """
+    This is the base class for the places an `UploadSet` can keep its files.
+    Every method takes names relative to the set, with ``/`` separating
+    folders, the way `UploadSet.save` returns them. The backend for a set is
+    chosen with the `UPLOADED_X_BACKEND` setting, and the default is a
+    `LocalStorage` for the set's destination.
+    """
+    def save_stream(self, uset, storage, folder, basename, config):
+        """
+        This stores an uploaded file that has already been checked by the
+        set, under `basename` in `folder` or a free name close to it, and
+        returns a `SavedFile` with the name it was stored under (including
+        the folder).
+
+        :param uset: The upload set that is saving the file.
+        :param storage: The `werkzeug.FileStorage` to store.
+        :param folder: The folder to store it in, or `None`.
+        :param basename: The basename the file would like to have.
+        :param config: The set's `UploadConfiguration`.
+        """
+        raise NotImplementedError
+
+    def exists(self, name):
+        """
+        This tells whether a file is stored under `name`.
+
+        :param name: The name to check.
+        """
+        raise NotImplementedError
+
+    def open(self, name):
+        """
+        This opens a stored file for reading, in binary mode. It raises an
+        `IOError` with `errno.ENOENT` if the file doesn't exist.
+
+        :param name: The name of the file to open.
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        """
+        This deletes a stored file, and returns `True` if it existed.
+
+        :param name: The name of the file to delete.
+        """
+        raise NotImplementedError
+
+    def url(self, name):
+        """
+        This returns a URL the file can be downloaded from directly, or
+        `None` if it has to be served through the application. The default
+        implementation returns `None`.
+
+        :param name: The name of the file.
+        """
+        return None
+
+    def stat(self, name):
+        """
+        This returns a `FileStat` for a stored file, or `None` if it doesn't
+        exist.
+
+        :param name: The name of the file.
+        """
+        raise NotImplementedError
+
+    def scan(self, folder=None, recursive=True, stat=False):
+        """
+        This lazily yields a ``(name, info)`` pair for each stored file in
+        `folder`, in no particular order. `info` is the file's `FileStat` if
+        `stat` is `True`, and `None` otherwise, which can be much cheaper.
+        Names starting with a dot, which hold the set's internal files, are
+        skipped, along with everything inside them.
+
+        :param folder: The folder to list, or `None` for the whole set.
+        :param recursive: If `False`, files in subfolders aren't included.
+        :param stat: Whether to look up each file's `FileStat`.
+        """
+        raise NotImplementedError
+
+
+def _local_etag(st):
+    # A strong entity tag from the file's inode, modification time and size.
+    # Saving over a file, or replacing it with a new one, always changes at
+    # least one of those.
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        mtime = int(st.st_mtime * 1000000000)
+    return '%x-%x-%x' % (st.st_ino, mtime, st.st_size)
+
+
+def _same_device(fd, folder):
+    # Whether an open file could be linked or renamed into `folder`.
+    return os.fstat(fd).st_dev == os.stat(folder).st_dev
+
+
+def _stat(config, name):
+    # The backend's stat for a set's file, through its cache if it has one.
+    if config.stat_cache is None:
+        return config.backend.stat(name)
+    return config.stat_cache.stat(config.backend, name)
+
+
+def _join_name(folder, filename):
+    return posixpath.join(folder, filename) if folder else filename
+
+
+def _contained_path(root, name):
+    if safe_join(root, name) is None:
+        raise ValueError("%r is outside the upload set" % name)
+    return os.path.join(root, *name.split('/'))
+
+
+def _not_found(name):
+    return IOError(errno.ENOENT, os.strerror(errno.ENOENT), name)
+
+
+class LocalStorage(StorageBackend):
+    """
+    This keeps files in a folder on a local (or mounted) filesystem. It is
+    the default backend, and the only one that supports the
+    `UPLOADED_X_ATOMIC`, `UPLOADED_X_CONTENT_ADDRESSED` and
+    `UPLOADED_X_DEDUPLICATE` settings.
+
+    :param root: The folder to keep the files in. This is normally the set's
+                 destination.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.root == other.root
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<LocalStorage %r>' % self.root
+
+    def path(self, name):
+        """
+        This returns the absolute path of a stored file. It raises
+        `ValueError` if the name would be outside `root`, like
+        ``../secret.txt``, so names from clients can't reach other files.
+
+        :param name: The name of the file.
+        """
+        return _contained_path(self.root, name)
+
+    def save_stream(self, uset, storage, folder, basename, config):
+        target_folder = self.path(folder) if folder else self.root
+        _makedirs(target_folder)
+        stream = storage.stream
+        if (isinstance(stream, StreamedFile) and stream.path is not None and
+                _same_device(stream.fileno(), target_folder) and
+                not (config.content_addressed or config.deduplicate) and
+                not _overrides_save(storage) and stream.tell() == 0):
+            saved = self.save_streamed(uset, stream, target_folder, basename,
+                                       config)
+        elif config.content_addressed:
+            saved = self.save_content_addressed(uset, storage, target_folder,
+                                                basename, config)
+        elif config.deduplicate:
+            saved = self.save_deduplicated(uset, storage, target_folder,
+                                           basename, config)
+        elif config.atomic:
+            saved = self.save_atomic(uset, storage, target_folder, basename,
+                                     config)
+        else:
+            basename = uset.resolver.claim(uset, target_folder, basename)
+            target = os.path.join(target_folder, basename)
+            hasher = hashlib.new(config.hash) if config.hash else None
+            try:
+                size = write_storage(storage, target, config.buffer_size,
+                                     fsync=config.fsync != 'none',
+                                     hasher=hasher)
+            except Exception:
+                _unlink_quietly(target)
+                raise
+            if config.fsync == 'file+dir':
+                _fsync_dir(target_folder)
+            saved = SavedFile(basename, hasher and hasher.hexdigest(), size)
+        return saved.within(folder)
+
+    def save_streamed(self, uset, stream, target_folder, basename, config):
+        """
+        This is used by `save_stream` when the upload was written straight
+        to the same filesystem as `target_folder` by
+        `UploadSet.stream_factory`. The temporary
+        file already holds the data, so it is just given its final name: with
+        `publish` if the set is atomic, or by renaming it over the name the
+        resolver claimed otherwise. It returns a `SavedFile` with the
+        basename the file was saved under.
+
+        :param uset: The upload set that is saving the file.
+        :param stream: The `StreamedFile` holding the upload.
+        :param target_folder: The absolute path to the target.
+        :param basename: The basename the file would like to have.
+        :param config: The set's `UploadConfiguration`.
+        """
+        stream.flush()
+        if config.hash:
+            hasher = hashlib.new(config.hash)
+            size = hash_stream(stream, hasher, config.buffer_size)
+            stream.seek(0)
+        else:
+            hasher = None
+            size = os.fstat(stream.fileno()).st_size
+        if config.fsync != 'none':
+            os.fsync(stream.fileno())
+        if config.atomic:
+            basename = publish(stream.path, target_folder,
+                               uset.resolver.candidates(target_folder,
+                                                        basename))
+            _unlink_quietly(stream.path)
+        else:
+            basename = uset.resolver.claim(uset, target_folder, basename)
+            os.rename(stream.path, os.path.join(target_folder, basename))
+        stream.path = None
+        if config.fsync == 'file+dir':
+            _fsync_dir(target_folder)
+        return SavedFile(basename, hasher and hasher.hexdigest(), size)
+
+    def save_atomic(self, uset, storage, target_folder, basename, config):
+        """
+        This is used by `save_stream` when the set is configured with
+        `UPLOADED_X_ATOMIC`. The file is streamed into a hidden temporary file
+        in `target_folder` and then published with `publish`, using the
+        names from the resolver's `~ConflictResolver.candidates`. Nothing is
+        ever overwritten, and there is no window between checking a name and
+        writing to it, so it is safe with many workers saving at once. It
+        returns a `SavedFile` with the basename the file was saved under.
+
+        :param uset: The upload set that is saving the file.
+        :param storage: The uploaded file to save.
+        :param target_folder: The absolute path to the target.
+        :param basename: The basename the file would like to have.
+        :param config: The set's `UploadConfiguration`.
+        """
+        hasher = hashlib.new(config.hash) if config.hash else None
+        temp = _temp_path(target_folder)
+        try:
+            size = write_storage(storage, temp, config.buffer_size,
+                                 fsync=config.fsync != 'none', exclusive=True,
+                                 hasher=hasher)
+            basename = publish(temp, target_folder,
+                               uset.resolver.candidates(target_folder,
+                                                        basename))
+        finally:
+            _unlink_quietly(temp)
+        if config.fsync == 'file+dir':
+            _fsync_dir(target_folder)
+        return SavedFile(basename, hasher and hasher.hexdigest(), size)
+
+    def save_content_addressed(self, uset, storage, target_folder,
+                               basename, config):
+        """
+        This is used by `save_stream` when the set is configured with
+        `UPLOADED_X_CONTENT_ADDRESSED`. The file is stored under the name
+        `content_name` gives for its digest and extension, and if a file with
+        that name already exists, nothing is written. If the upload's stream
+        can be rewound, it is hashed before anything is written. Otherwise it
+        is hashed while it is streamed into a temporary file, which is thrown
+        away if the contents turn out to be stored already. It returns a
+        `SavedFile` with the content name.
+
+        :param uset: The upload set that is saving the file.
+        :param storage: The uploaded file to save.
+        :param target_folder: The absolute path to the target.
+        :param basename: The basename the file would like to have. Only its
+                         extension is used.
+        :param config: The set's `UploadConfiguration`.
+        """
+        ext = extension(basename) if '.' in basename else ''
+        digest, size = _hash_ahead(storage, config)
+        if digest is not None:
+            relname = content_name(digest, ext)
+            if os.path.exists(os.path.join(target_folder, relname)):
+                return SavedFile(relname, digest, size, created=False)
+
+        temp = _temp_path(target_folder)
+        try:
+            if digest is None:
+                hasher = hashlib.new(config.hash)
+                size = write_storage(storage, temp, config.buffer_size,
+                                     fsync=config.fsync != 'none',
+                                     exclusive=True, hasher=hasher)
+                digest = hasher.hexdigest()
+                relname = content_name(digest, ext)
+            else:
+                write_storage(storage, temp, config.buffer_size,
+                              fsync=config.fsync != 'none', exclusive=True)
+            folder, name = posixpath.split(relname)
+            blob_folder = os.path.join(target_folder, folder)
+            _makedirs(blob_folder)
+            created = publish(temp, blob_folder, (name,)) is not None
+        finally:
+            _unlink_quietly(temp)
+        if created and config.fsync == 'file+dir':
+            _fsync_dir(blob_folder)
+        return SavedFile(relname, digest, size, created)
+
+    def save_deduplicated(self, uset, storage, target_folder, basename,
+                           config):
+        """
+        This is used by `save_stream` when the set is configured with
+        `UPLOADED_X_DEDUPLICATE`. The contents are stored once, at the
+        `blob_path` for their digest, and the file is saved as a hard link to
+        that, under a name picked the same way as `save_atomic` does. If the
+        contents are already stored and the upload's stream can be rewound,
+        nothing is written at all. The number of names sharing the contents
+        is the stored copy's link count, minus one, so `UploadSet.delete` knows
+        when the stored copy can go. It returns a `SavedFile`.
+
+        Every name is the same file as the stored copy, so writing to one
+        would change them all, and later uploads would be matched against
+        the wrong contents. The stored copy is made read-only to prevent
+        that. Replace deduplicated files, by deleting and saving them again,
+        instead of editing them in place.
+
+        :param uset: The upload set that is saving the file.
+        :param storage: The uploaded file to save.
+        :param target_folder: The absolute path to the target.
+        :param basename: The basename the file would like to have.
+        :param config: The set's `UploadConfiguration`.
+        """
+        resolver = uset.resolver
+        digest, size = _hash_ahead(storage, config)
+        if digest is not None:
+            blob = blob_path(self.root, digest)
+            try:
+                saved = publish(blob, target_folder,
+                                resolver.candidates(target_folder, basename),
+                                copy=True)
+            except (IOError, OSError) as e:
+                # the contents aren't stored yet, or were just deleted
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                if config.fsync == 'file+dir':
+                    _fsync_dir(target_folder)
+                return SavedFile(saved, digest, size, created=False)
+
+        temp = _temp_path(target_folder)
+        try:
+            if digest is None:
+                hasher = hashlib.new(config.hash)
+                size = write_storage(storage, temp, config.buffer_size,
+                                     fsync=config.fsync != 'none',
+                                     exclusive=True, hasher=hasher)
+                digest = hasher.hexdigest()
+            else:
+                write_storage(storage, temp, config.buffer_size,
+                              fsync=config.fsync != 'none', exclusive=True)
+            blob = blob_path(self.root, digest)
+            _makedirs(os.path.dirname(blob))
+            # Windows can't delete read-only files, so there they are left
+            # writable.
+            if os.name != 'nt':
+                os.chmod(temp, 0o444)
+            # If someone else stored the same contents first, theirs is used
+            # and this copy is thrown away.
+            created = publish(temp, os.path.dirname(blob),
+                              (digest,), copy=True) is not None
+            basename = publish(blob, target_folder,
+                               resolver.candidates(target_folder, basename),
+                               copy=True)
+        finally:
+            _unlink_quietly(temp)
+        if config.fsync == 'file+dir':
+            _fsync_dir(target_folder)
+        return SavedFile(basename, digest, size, created)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def delete(self, name):
+        try:
+            os.unlink(self.path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return True
+
+    def stat(self, name):
+        try:
+            st = os.stat(self.path(name))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return FileStat(st.st_size, st.st_mtime, _local_etag(st))
+
+    def scan(self, folder=None, recursive=True, stat=False):
+        # os.scandir gets each entry's type along with its name, so nothing
+        # is stat'ed unless it was asked for, and only the folders still to
+        # be visited are kept in memory, never the files.
+        pending = [(folder or '', self.path(folder) if folder else self.root)]
+        while pending:
+            prefix, path = pending.pop()
+            try:
+                entries = os.scandir(path)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    name = _join_name(prefix, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            pending.append((name, entry.path))
+                    elif entry.is_file(follow_symlinks=False):
+                        if stat:
+                            st = entry.stat(follow_symlinks=False)
+                            yield name, FileStat(st.st_size, st.st_mtime,
+                                                 _local_etag(st))
+                        else:
+                            yield name, None
+
+
+class MemoryStorage(StorageBackend):
+    """
+    This keeps files in a dictionary in memory. It is meant for tests, and for
+    small sets that don't need to outlive the process. It is thread safe, but
+    every process has its own copy.
+    """
+    def __init__(self):
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def save_stream(self, uset, storage, folder, basename, config):
+        buf = BytesIO()
+        hasher = hashlib.new(config.hash) if config.hash else None
+        size = copy_storage(storage, buf, config.buffer_size, hasher)
+        data = buf.getvalue()
+        with self._lock:
+            for candidate in suffixed_names(basename):
+                name = posixpath.join(folder, candidate) if folder else \
+                    candidate
+                if name not in self.files:
+                    self.files[name] = (data, time.time())
+                    break
+        return SavedFile(name, hasher and hasher.hexdigest(), len(data))
+
+    def exists(self, name):
+        return name in self.files
+
+    def open(self, name):
+        try:
+            return BytesIO(self.files[name][0])
+        except KeyError:
+            raise _not_found(name)
+
+    def delete(self, name):
+        with self._lock:
+            return self.files.pop(name, None) is not None
+
+    def stat(self, name):
+        try:
+            data, mtime = self.files[name]
+        except KeyError:
+            return None
+        return FileStat(len(data), mtime)
+
+    def scan(self, folder=None, recursive=True, stat=False):
+        start = folder + '/' if folder else ''
+        with self._lock:
+            names = [name for name in self.files if name.startswith(start)]
+        for name in names:
+            rest = name[len(start):]
+            if not recursive and '/' in rest:
+                continue
+            if any(part.startswith('.') for part in rest.split('/')):
+                continue
+            if stat:
+                info = self.stat(name)
+                if info is None:
+                    continue
+                yield name, info
+            else:
+                yield name, None
+
+
+def _read_full(stream, size):
+    # A single read() on a stream can return less than was asked for without
+    # being at the end.
+    data = stream.read(size)
+    if not data or len(data) == size:
+        return data
+    chunks = [data]
+    remaining = size - len(data)
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+class _ReadCounter(object):
+    """
+    This wraps a stream, counting (and optionally hashing) what is read from
+    it, for backends that hand the stream to a client library.
+    """
+    def __init__(self, stream, hasher=None):
+        self.stream = stream
+        self.hasher = hasher
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.size += len(chunk)
+        if self.hasher is not None:
+            self.hasher.update(chunk)
+        return chunk
+
+
+class S3Storage(StorageBackend):
+    """
+    This keeps files in a bucket on Amazon S3, or on any server that speaks
+    the same protocol, like MinIO. It needs `boto3`.
+
+    :param bucket: The name of the bucket.
+    :param prefix: A prefix for every key, like ``photos/``.
+    :param client: A `boto3` S3 client. If it isn't given, one is created with
+                   `client_options`.
+    :param base_url: If the bucket is public, the URL (ending with a /) that
+                     keys can be downloaded from.
+    :param url_expires: If the bucket isn't public, `url` returns presigned
+                        URLs that are valid for this many seconds. If neither
+                        this nor `base_url` is given, files are served through
+                        the application.
+    :param part_size: Files larger than this many bytes are sent as a
+                      multipart upload, in parts of this size. S3 needs at
+                      least 5 MiB. The default is 8 MiB.
+    :param concurrency: How many parts of one file are sent at once. At most
+                        this many parts are held in memory.
+    :param client_options: Passed to ``boto3.client('s3', ...)``, for example
+                           `endpoint_url` or `region_name`.
+    """
+    #: S3 doesn't allow more parts than this in one upload.
+    max_parts = 10000
+
+    def __init__(self, bucket, prefix='', client=None, base_url=None,
+                 url_expires=None, part_size=8 * 1024 * 1024, concurrency=4,
+                 **client_options):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        try:
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("S3Storage requires boto3")
+        self.ClientError = ClientError
+        if client is None:
+            import boto3
+            client = boto3.client('s3', **client_options)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.base_url = base_url
+        self.url_expires = url_expires
+        self.part_size = part_size
+        self.concurrency = concurrency
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                (self.bucket, self.prefix) == (other.bucket, other.prefix))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<S3Storage %s/%s>' % (self.bucket, self.prefix)
+
+    def key(self, name):
+        """
+        This returns the key a file is stored under.
+
+        :param name: The name of the file.
+        """
+        return self.prefix + name
+
+    def _missing(self, error):
+        code = error.response.get('Error', {}).get('Code')
+        return code in ('404', 'NoSuchKey', 'NotFound')
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket,
+                                           Key=self.key(name))
+        except self.ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+
+    def save_stream(self, uset, storage, folder, basename, config):
+        for candidate in suffixed_names(basename):
+            name = posixpath.join(folder, candidate) if folder else candidate
+            if self._head(name) is None:
+                break
+        hasher = hashlib.new(config.hash) if config.hash else None
+        content_type = (storage.mimetype or
+                        mimetypes.guess_type(name)[0] or
+                        'application/octet-stream')
+        if _overrides_save(storage):
+            buf = BytesIO()
+            storage.save(buf, config.buffer_size)
+            buf.seek(0)
+            stream = _ReadCounter(buf, hasher)
+        else:
+            stream = _ReadCounter(storage.stream, hasher)
+        self.upload(stream, self.key(name), content_type,
+                    storage.content_length)
+        return SavedFile(name, hasher and hasher.hexdigest(), stream.size)
+
+    def upload(self, stream, key, content_type, size_hint=None):
+        """
+        This sends everything in `stream` to `key`. Anything smaller than
+        `part_size` is sent in one request. Anything larger is sent as a
+        multipart upload, with up to `concurrency` parts in flight at once
+        on a thread pool, so throughput isn't limited to one connection. The
+        stream is only read from this thread, and reading waits while
+        `concurrency` parts are waiting to be sent, so memory use stays
+        bounded. If anything goes wrong, the multipart upload is aborted.
+
+        :param stream: The file-like object to read.
+        :param key: The key to store it under.
+        :param content_type: The object's content type.
+        :param size_hint: The expected size, if known. It is used to make the
+                          parts larger if there would otherwise be too many.
+        """
+        part_size = self.part_size
+        if size_hint and size_hint > part_size * self.max_parts:
+            part_size = -(-size_hint // self.max_parts)
+        data = _read_full(stream, part_size)
+        if len(data) < part_size:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=data,
+                                   ContentType=content_type)
+            return
+
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, ContentType=content_type)['UploadId']
+        slots = threading.BoundedSemaphore(self.concurrency)
+        failed = []
+
+        def send(number, data):
+            try:
+                response = self.client.upload_part(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id,
+                    PartNumber=number, Body=data)
+                return {'ETag': response['ETag'], 'PartNumber': number}
+            except BaseException:
+                failed.append(number)
+                raise
+            finally:
+                slots.release()
+
+        executor = ThreadPoolExecutor(self.concurrency)
+        try:
+            futures = []
+            number = 0
+            while data and not failed:
+                number += 1
+                if number > self.max_parts:
+                    raise ValueError("file has more than %d parts" %
+                                     self.max_parts)
+                slots.acquire()
+                futures.append(executor.submit(send, number, data))
+                data = _read_full(stream, part_size)
+            parts = [future.result() for future in futures]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except BaseException:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key,
+                                               UploadId=upload_id)
+            raise
+        finally:
+            executor.shutdown(wait=True)
+
+    def exists(self, name):
+        return self._head(name) is not None
+
+    def open(self, name):
+        try:
+            response = self.client.get_object(Bucket=self.bucket,
+                                              Key=self.key(name))
+        except self.ClientError as e:
+            if self._missing(e):
+                raise _not_found(name)
+            raise
+        return response['Body']
+
+    def delete(self, name):
+        if self._head(name) is None:
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        return True
+
+    def url(self, name):
+        if self.base_url is not None:
+            return self.base_url + url_quote(self.key(name))
+        if self.url_expires is not None:
+            return self.client.generate_presigned_url(
+                'get_object', ExpiresIn=self.url_expires,
+                Params={'Bucket': self.bucket, 'Key': self.key(name)})
+        return None
+
+    def stat(self, name):
+        head = self._head(name)
+        if head is None:
+            return None
+        mtime = calendar.timegm(head['LastModified'].utctimetuple())
+        return FileStat(head['ContentLength'], mtime,
+                        head.get('ETag', '').strip('"') or None)
+
+    def scan(self, folder=None, recursive=True, stat=False):
+        # Listings come a page of up to 1000 keys at a time, and every
+        # listing includes the size and modification time for free.
+        start = self.key(folder + '/' if folder else '')
+        options = dict(Bucket=self.bucket, Prefix=start)
+        if not recursive:
+            options['Delimiter'] = '/'
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(**options):
+            for item in page.get('Contents', ()):
+                name = item['Key'][len(self.prefix):]
+                rest = item['Key'][len(start):]
+                if any(part.startswith('.') for part in rest.split('/')):
+                    continue
+                if stat:
+                    mtime = calendar.timegm(
+                        item['LastModified'].utctimetuple())
+                    yield name, FileStat(item['Size'], mtime,
+                                         item.get('ETag', '').strip('"') or
+                                         None)
+                else:
+                    yield name, None
+
+
+def _memory_backend(app, uset, prefix):
+    return MemoryStorage()
+
+
+def _s3_backend(app, uset, prefix):
+    config = app.config
+    options = dict(config.get(prefix + 'S3_OPTIONS', {}))
+    endpoint_url = config.get(prefix + 'S3_ENDPOINT_URL')
+    if endpoint_url is not None:
+        options['endpoint_url'] = endpoint_url
+    try:
+        bucket = config[prefix + 'S3_BUCKET']
+    except KeyError:
+        raise RuntimeError("no %sS3_BUCKET for set %s" % (prefix, uset.name))
+    return S3Storage(bucket, config.get(prefix + 'S3_PREFIX', ''),
+                     base_url=config.get(prefix + 'S3_URL'),
+                     url_expires=config.get(prefix + 'S3_URL_EXPIRES'),
+                     part_size=config.get(prefix + 'PART_SIZE',
+                                          8 * 1024 * 1024),
+                     concurrency=config.get(prefix + 'CONCURRENCY', 4),
+                     **options)
+
+
+#: The names the `UPLOADED_X_BACKEND` setting can use, mapped to functions
+#: that take the app, the upload set, and the set's setting prefix (like
+#: ``UPLOADED_PHOTOS_``), and return the backend. ``local`` means the default
+#: `LocalStorage`.
+BACKENDS = {
+    'local': lambda app, uset, prefix: None,
+    'memory': _memory_backend,
+    's3': _s3_backend,
+}
+
+
+def shard_by_hash(storage, basename):
+    """
+    This shards files by a hash of their basename, into two levels of
+    folders with two hex digits each, like ``3f/a9/photo.jpg``. That makes
+    65,536 folders, so each one stays small even with millions of files, and
+    a name always lands in the same folder, so conflicts are still found.
+
+    :param storage: The file being saved.
+    :param basename: The basename it will be saved under.
+    """
+    digest = hashlib.sha256(basename.encode('utf-8')).hexdigest()
+    return '%s/%s' % (digest[:2], digest[2:4])
+
+
+def shard_by_date(storage, basename):
+    """
+    This shards files by the UTC date they were saved on, like
+    ``2026/10/18/photo.jpg``.
+
+    :param storage: The file being saved.
+    :param basename: The basename it will be saved under.
+    """
+    return time.strftime('%Y/%m/%d', time.gmtime())
+
+
+#: The sharding policies `UPLOADED_X_SHARD` can name, and the functions that
+#: pick a file's subfolder for them. A function can be used directly too. It
+#: is passed the file and its basename, and returns a subfolder like
+#: ``'ab/cd'``, or an empty string to use the folder the file was given.
+SHARDS = {
+    'hash': shard_by_hash,
+    'date': shard_by_date,
+}
+
+
+_executor_lock = threading.Lock()
+
+
+def upload_executor(app):
+    """
+    This returns the thread pool an app's upload sets do their file work on
+    when they are used from asynchronous views. It is created the first time
+    it is needed, with `UPLOADS_ASYNC_WORKERS` threads (4 by default), and
+    shared by every set on the app, so slow uploads can't start an unbounded
+    number of threads.
+
+    :param app: The `~flask.Flask` instance.
+    """
+    executor = getattr(app, 'upload_executor', None)
+    if executor is None:
+        with _executor_lock:
+            executor = getattr(app, 'upload_executor', None)
+            if executor is None:
+                workers = app.config.get('UPLOADS_ASYNC_WORKERS', 4)
+                executor = app.upload_executor = ThreadPoolExecutor(
+                    workers, thread_name_prefix='flask-uploads')
+    return executor
+
+
+class ProcessingStatus(object):
+    """
+    This tells how far post-processing of a saved file has got. See
+    `UploadSet.processing_status`.
+
+    :param state: One of ``pending``, ``running``, ``done`` or ``failed``.
+    :param stage: The name of the stage that is running, or that failed.
+    :param attempts: How many times that stage has been tried.
+    :param error: The exception the failed stage last raised.
+    """
+    def __init__(self, state='pending', stage=None, attempts=0, error=None):
+        self.state = state
+        self.stage = stage
+        self.attempts = attempts
+        self.error = error
+
+    def __repr__(self):
+        return '<ProcessingStatus %s stage=%r attempts=%r>' % (
+            self.state, self.stage, self.attempts)
+
+
+class ProcessingQueueFull(Exception):
+    """
+    This is raised when a saved file can't be queued for post-processing
+    because the queue has been full for longer than `UPLOADS_PROCESSING_WAIT`.
+    The file itself was saved, and its name is the `name` attribute, so it
+    can be queued again later with `UploadSet.process`. Saving doesn't raise
+    it, since the file is already stored by then: it is kept as the
+    `SavedFile`'s `processing_error` instead.
+    """
+    def __init__(self, name):
+        Exception.__init__(self, name)
+        self.name = name
+
+
+class Processor(object):
+    """
+    This is a post-processing stage registered with `UploadSet.processor`.
+    The constructor's arguments are also the attributes.
+
+    :param func: The function, which is called with the set and the saved
+                 file's name.
+    :param retries: How many more times to try the stage if it fails.
+    :param retry_delay: How many seconds to wait before the first retry. The
+                        wait doubles after each one.
+    :param name: The name the stage is known by in `ProcessingStatus`. It
+                 defaults to the function's name.
+    """
+    def __init__(self, func, retries=0, retry_delay=1.0, name=None):
+        self.func = func
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.name = name or func.__name__
+
+
+def run_processors(app, setname, name, status=None):
+    """
+    This runs every post-processing stage of a set on a saved file, in
+    order, inside an app context, retrying each one as it allows. If a stage
+    fails for good, the exception is logged and the stages after it are
+    skipped. It returns the final `ProcessingStatus`.
+
+    Queues call this to do the work. If you write one for a task queue like
+    Celery or RQ, this is what the task should call.
+
+    :param app: The `~flask.Flask` instance.
+    :param setname: The name of the upload set.
+    :param name: The name of the saved file.
+    :param status: A `ProcessingStatus` to keep up to date as it goes.
+    """
+    if status is None:
+        status = ProcessingStatus()
+    with app.app_context():
+        uset = app.upload_sets[setname]
+        status.state = 'running'
+        for stage in uset.processors:
+            status.stage = stage.name
+            status.attempts = 0
+            while True:
+                status.attempts += 1
+                try:
+                    stage.func(uset, name)
+                    break
+                except Exception as e:
+                    status.error = e
+                    if status.attempts > stage.retries:
+                        app.logger.exception("processing %s failed at %s",
+                                             name, stage.name)
+                        status.state = 'failed'
+                        return status
+                    time.sleep(stage.retry_delay * 2 ** (status.attempts - 1))
+        status.state = 'done'
+        status.stage = None
+        status.error = None
+    return status
+
+
+class ProcessingQueue(object):
+    """
+    This is the interface for the queues saved files wait in for
+    post-processing. The default, `LocalProcessingQueue`, runs the stages
+    on a thread pool in the same process. To use a task queue instead,
+    subclass this and set `UPLOADS_PROCESSING_QUEUE` to an instance.
+    """
+    def enqueue(self, app, uset, name):
+        """
+        This queues a saved file to have `run_processors` called on it. It
+        should raise `ProcessingQueueFull` if it can't take any more work.
+
+        :param app: The `~flask.Flask` instance.
+        :param uset: The `UploadSet` the file was saved to.
+        :param name: The name of the saved file.
+        """
+        raise NotImplementedError
+
+    def status(self, uset, name):
+        """
+        This returns the `ProcessingStatus` of a queued file, or `None` if
+        it isn't known.
+
+        :param uset: The `UploadSet` the file was saved to.
+        :param name: The name of the saved file.
+        """
+        return None
+
+
+class LocalProcessingQueue(ProcessingQueue):
+    """
+    This runs post-processing on a thread pool in the same process, and
+    remembers the status of the most recent files in memory.
+
+    At most `max_pending` files can be waiting or running at once. When it
+    is full, `enqueue` blocks until there is room, so a burst of uploads
+    slows down the requests saving them instead of piling up work without
+    bound. If `wait` is given, it gives up after that many seconds and
+    raises `ProcessingQueueFull`.
+
+    :param workers: The number of threads.
+    :param max_pending: The most files that can be waiting or running.
+    :param wait: How many seconds `enqueue` waits for room, or `None` to
+                 wait as long as it takes.
+    :param history: How many statuses to remember.
+    """
+    def __init__(self, workers=2, max_pending=100, wait=None, history=10000):
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix='flask-uploads-processing')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.wait = wait
+        self.history = history
+        self.statuses = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def enqueue(self, app, uset, name):
+        if self.wait is None:
+            self.slots.acquire()
+        elif not self.slots.acquire(True, self.wait):
+            raise ProcessingQueueFull(name)
+        status = ProcessingStatus()
+        with self._lock:
+            key = (uset.name, name)
+            self.statuses.pop(key, None)
+            self.statuses[key] = status
+            while len(self.statuses) > self.history:
+                self.statuses.popitem(last=False)
+
+        def job():
+            try:
+                run_processors(app, uset.name, name, status)
+            finally:
+                self.slots.release()
+        try:
+            self.executor.submit(job)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def status(self, uset, name):
+        with self._lock:
+            return self.statuses.get((uset.name, name))
+
+    def shutdown(self, wait=True):
+        """
+        This stops the worker threads, after finishing the queued files if
+        `wait` is `True`.
+        """
+        self.executor.shutdown(wait)
+
+
+def processing_queue(app):
+    """
+    This returns the `ProcessingQueue` an app's upload sets send saved files
+    to for post-processing. It is `UPLOADS_PROCESSING_QUEUE` if that is set,
+    and otherwise a `LocalProcessingQueue` created the first time it is
+    needed, with `UPLOADS_PROCESSING_WORKERS` threads (2 by default), room
+    for `UPLOADS_PROCESSING_BACKLOG` files (100 by default), and waiting
+    `UPLOADS_PROCESSING_WAIT` seconds for room (forever by default).
+
+    :param app: The `~flask.Flask` instance.
+    """
+    queue = getattr(app, 'upload_processing_queue', None)
+    if queue is None:
+        with _executor_lock:
+            queue = getattr(app, 'upload_processing_queue', None)
+            if queue is None:
+                config = app.config
+                queue = config.get('UPLOADS_PROCESSING_QUEUE')
+                if queue is None:
+                    queue = LocalProcessingQueue(
+                        config.get('UPLOADS_PROCESSING_WORKERS', 2),
+                        config.get('UPLOADS_PROCESSING_BACKLOG', 100),
+                        config.get('UPLOADS_PROCESSING_WAIT'))
+                app.upload_processing_queue = queue
+    return queue
+
+
+class UploadSet(object):
+    """
+    This represents a single set of uploaded files. Each upload set is
+    independent of the others. This can be reused across multiple application
+    instances, as all configuration is stored on the application object itself
+    and found with `flask.current_app`.
+
+    :param name: The name of this upload set. It defaults to ``files``, but
+                 you can pick any alphanumeric name you want. (For simplicity,
+                 it's best to use a plural noun.)
+    :param extensions: The extensions to allow uploading in this set. The
+                       easiest way to do this is to add together the extension
+                       presets (for example, ``TEXT + DOCUMENTS + IMAGES``).
+                       It can be overridden by the configuration with the
+                       `UPLOADED_X_ALLOW` and `UPLOADED_X_DENY` configuration
+                       parameters. The default is `DEFAULTS`.
+    :param default_dest: If given, this should be a callable. If you call it
+                         with the app, it should return the default upload
+                         destination path for that app.
+    :param resolver: The `ConflictResolver` used to pick a free name when
+                     saving. The default is a `ProbingResolver`, which calls
+                     `resolve_conflict`. Use a `CountingResolver` for folders
+                     with many files of the same name.
+    """
+    def __init__(self, name='files', extensions=DEFAULTS, default_dest=None,
+                 resolver=None):
+        if not name.isalnum():
+            raise ValueError("Name must be alphanumeric (no underscores)")
+        self.name = name
+        self.extensions = extensions
+        self._config = None
+        self.default_dest = default_dest
+        if resolver is None:
+            resolver = ProbingResolver()
+        self.resolver = resolver
+        #: The post-processing stages registered with `processor`, as
+        #: `Processor` objects, in the order they run.
+        self.processors = []
+        #: The function registered with `authorize_resumable`, or `None`.
+        self.resumable_authorizer = None
+
+    @property
+    def config(self):
+        """
+        This gets the current configuration. By default, it looks up the
+        current application and gets the configuration from there. But if you
+        don't want to go to the full effort of setting an application, or it's
+        otherwise outside of a request context, set the `_config` attribute to
+        an `UploadConfiguration` instance, then set it back to `None` when
+        you're done.
+        """
+        if self._config is not None:
+            return self._config
+        try:
+            return _current_app().upload_set_config[self.name]
+        except AttributeError:
+            raise RuntimeError("cannot access configuration outside request")
+
+    def url(self, filename, variant=None):
+        """
+        This function gets the URL a file uploaded to this set would be
+        accessed at. It doesn't check whether said file exists. If the set
+        has no `UPLOADED_X_URL`, the backend gets a chance to provide one
+        (see `StorageBackend.url`) before falling back to the application.
+
+        .. versionchanged:: 0.3
+           URLs served by the uploads module are built from a prefix that is
+           worked out once per request. See `urls`. `variant` was added.
+
+        :param filename: The filename to return the URL for.
+        :param variant: The name of one of the set's `UPLOADED_X_VARIANTS`
+                        to link to instead of the file itself. Variants are
+                        always served by the uploads module, which makes them
+                        when they are first requested if they don't exist.
+        """
+        config = self.config
+        if variant is not None:
+            self._check_variant(config, variant)
+            return self._module_url(filename, variant)
+        base = config.base_url
+        if base is None:
+            url = config.backend.url(filename)
+            if url is not None:
+                return url
+            return self._module_url(filename)
+        else:
+            return base + filename
+
+    def urls(self, filenames, variant=None):
+        """
+        This returns the URLs for several files at once, in order, exactly as
+        `url` would return them. The configuration is looked up once, and if
+        the files are served by the uploads module, the route is only built
+        once, for the first file. Each URL after that is just the route's
+        prefix plus the quoted filename. Use it for pages that list a lot of
+        uploads, like galleries. ::
+
+            for photo, url in zip(photos_list, photos.urls(photos_list)):
+                ...
+
+        .. versionadded:: 0.3
+
+        :param filenames: The filenames to return the URLs for.
+        :param variant: The variant to link to, as with `url`.
+        """
+        config = self.config
+        if variant is not None:
+            self._check_variant(config, variant)
+            return [self._module_url(filename, variant)
+                    for filename in filenames]
+        base = config.base_url
+        if base is not None:
+            return [base + filename for filename in filenames]
+        backend_url = config.backend.url
+        urls = []
+        for filename in filenames:
+            url = backend_url(filename)
+            urls.append(url if url is not None else
+                        self._module_url(filename))
+        return urls
+
+    def _check_variant(self, config, variant):
+        if variant not in config.variants:
+            raise ValueError("set %s has no variant %r" % (self.name, variant))
+
+    def _module_url(self, filename, variant=None):
+        """
+        This returns what ``url_for('_uploads.uploaded_file', ...)`` would
+        for `filename`. The URL is built once per request with a placeholder
+        filename, and the part before the placeholder is kept on `flask.g`,
+        along with the ``path`` converter that quotes filenames for the
+        route. If anything, like a URL default, adds to the end of the URL,
+        every URL is built with `url_for` instead.
+        """
+        prefixes = g.setdefault('_upload_url_prefixes', {})
+        try:
+            prefix, quote = prefixes[self.name]
+        except KeyError:
+            url = url_for('_uploads.uploaded_file', setname=self.name,
+                          filename=_URL_PLACEHOLDER, _external=True)
+            if url.endswith('/' + _URL_PLACEHOLDER):
+                url_map = current_app.url_map
+                prefix = url[:-len(_URL_PLACEHOLDER)]
+                quote = url_map.converters['path'](url_map).to_url
+            else:
+                prefix = quote = None
+            prefixes[self.name] = prefix, quote
+        if prefix is None:
+            if variant is not None:
+                return url_for('_uploads.uploaded_file', setname=self.name,
+                               filename=filename, variant=variant,
+                               _external=True)
+            return url_for('_uploads.uploaded_file', setname=self.name,
+                           filename=filename, _external=True)
+        if variant is not None:
+            return '%s%s?variant=%s' % (prefix, quote(filename),
+                                        url_quote(variant, safe=''))
+        return prefix + quote(filename)
+
+    def path(self, filename, folder=None):
+        """
+        This returns the absolute path of a file uploaded to this set. It
+        doesn't actually check whether said file exists, but it raises
+        `ValueError` if the name would be outside the set's destination. It
+        is only meaningful for sets kept in `LocalStorage`.
+
+        :param filename: The filename to return the path for.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        return _contained_path(self.config.destination,
+                               _join_name(folder, filename))
+
+    def file_allowed(self, storage, basename):
+        """
+        This tells whether a file is allowed. It should return `True` if the
+        given `werkzeug.FileStorage` object can be saved with the given
+        basename, and `False` if it can't. The default implementation just
+        checks the extension, so you can override this if you want.
+
+        :param storage: The `werkzeug.FileStorage` to check.
+        :param basename: The basename it will be saved under.
+
+        .. versionchanged:: 0.3
+           If `UPLOADED_X_CONTENT_TYPES` is set, the file's declared content
+           type is checked with `content_type_allowed` too, and if
+           `UPLOADED_X_SNIFF` is set, its first bytes are checked with
+           `content_allowed`.
+        """
+        return self._file_allowed(self.config, storage, basename)
+
+    def _check(self, config, check, *args):
+        # Runs one of the public checks, like `file_allowed`, for a caller
+        # that already has the configuration. Its private version takes the
+        # configuration, so it isn't looked up again, but a subclass's
+        # replacement has to be called as it is.
+        if getattr(type(self), check) is not getattr(UploadSet, check):
+            return getattr(self, check)(*args)
+        return getattr(self, '_' + check)(config, *args)
+
+    def _file_allowed(self, config, storage, basename):
+        ext = extension(basename)
+        return (self._check(config, 'extension_allowed', ext) and
+                self._check(config, 'content_type_allowed',
+                            storage.mimetype) and
+                self._check(config, 'content_allowed', storage, ext))
+
+    def extension_allowed(self, ext):
+        """
+        This determines whether a specific extension is allowed. It is called
+        by `file_allowed`, so if you override that but still want to check
+        extensions, call back into this.
+
+        .. versionchanged:: 0.3
+           The check uses the set's compiled `ExtensionPolicy`.
+
+        :param ext: The extension to check, without the dot.
+        """
+        return self._extension_allowed(self.config, ext)
+
+    def _extension_allowed(self, config, ext):
+        return self._policy(config).allows(ext)
+
+    def _policy(self, config):
+        """
+        This returns the set's compiled `ExtensionPolicy`, compiling it again
+        if `extensions` has been replaced since.
+        """
+        policy = config.policy
+        if policy is None or policy.extensions is not self.extensions:
+            policy = config.policy = ExtensionPolicy(self.extensions,
+                                                     config.allow,
+                                                     config.deny)
+        return policy
+
+    def content_allowed(self, storage, ext):
+        """
+        This determines whether a file's first bytes match the magic numbers
+        in `SIGNATURES` for its extension, so that, say, an HTML page named
+        ``photo.jpg`` is refused. It is only checked if `UPLOADED_X_SNIFF` is
+        set. The bytes are peeked from the upload's stream before anything is
+        written, and left there for `save` to read. Extensions without
+        signatures are always allowed.
+
+        .. versionadded:: 0.3
+
+        :param storage: The `werkzeug.FileStorage` to check.
+        :param ext: The extension it will be saved with, without the dot.
+        """
+        return self._content_allowed(self.config, storage, ext)
+
+    def _content_allowed(self, config, storage, ext):
+        if config.sniff is None:
+            return True
+        policy = self._policy(config)
+        table = config.signatures
+        if table is None or table.extensions is not policy:
+            table = config.signatures = SignatureTable(policy, config.sniff)
+        if ext not in table:
+            return True
+        return table.matches(ext, _peek(storage, table.size))
+
+    def content_type_allowed(self, content_type):
+        """
+        This determines whether a file declared with a content type is
+        allowed, going by `UPLOADED_X_CONTENT_TYPES`. Any type is allowed if
+        that isn't set. Otherwise, the type must be listed, or its family
+        must be listed as ``family/*``. Parameters like ``charset`` are
+        ignored.
+
+        .. versionadded:: 0.3
+
+        :param content_type: The declared content type, like ``image/png``.
+        """
+        return self._content_type_allowed(self.config, content_type)
+
+    def _content_type_allowed(self, config, content_type):
+        allowed = config.content_types
+        if not allowed:
+            return True
+        content_type = (content_type or '').split(';')[0].strip().lower()
+        return (content_type in allowed or
+                content_type.split('/')[0] + '/*' in allowed)
+
+    def get_basename(self, filename):
+        return lowercase_ext(secure_filename(filename))
+
+    def save(self, storage, folder=None, name=None):
+        """
+        This saves a `werkzeug.FileStorage` into this upload set. If the
+        upload is not allowed, an `UploadNotAllowed` error will be raised. If
+        it is too big for the set's size limits, that error is an
+        `UploadTooLarge`, and nothing is left behind.
+        Otherwise, the file will be saved and its name (including the folder)
+        will be returned, as a `SavedFile`.
+
+        .. versionchanged:: 0.3
+           The name is returned as a `SavedFile`, which is a string that also
+           has the file's digest and size.
+
+        :param storage: The uploaded file to save.
+        :param folder: The subfolder within the upload set to save to.
+        :param name: The name to save the file as. If it ends with a dot, the
+                     file's extension will be appended to the end. (If you
+                     are using `name`, you can include the folder in the
+                     `name` instead of explicitly using `folder`, i.e.
+                     ``uset.save(file, name="someguy/photo_123.")``
+                     It is ignored by content-addressed sets.
+        """
+        config = self.config
+        return self._save(config, storage, folder, name,
+                          self._budget(config))
+
+    def _save(self, config, storage, folder, name, budget):
+        # `save`, with the set's configuration and request budget looked up
+        # by the caller, which may be in another thread.
+        if not isinstance(storage, FileStorage):
+            raise TypeError("storage must be a werkzeug.FileStorage")
+
+        if folder is None and name is not None and "/" in name:
+            folder, name = os.path.split(name)
+
+        basename = self.get_basename(storage.filename)
+        
+        if not self._check(config, 'file_allowed', storage, basename):
+            raise UploadNotAllowed()
+        
+        if name:
+            if name.endswith('.'):
+                basename = name + extension(basename)
+            else:
+                basename = name
+
+        storage = self._limit(storage, config, budget)
+        folder = self._shard(storage, basename, folder, config)
+        saved = config.backend.save_stream(self, storage, folder, basename,
+                                           config)
+        if config.compress:
+            compress_file(config, saved)
+        if config.stat_cache is not None:
+            config.stat_cache.invalidate(saved)
+        if config.variants_eager and config.variants:
+            self._queue_variants(config, saved)
+        if self.processors:
+            self._queue_processing(saved)
+        return saved
+
+    def _queue_processing(self, saved):
+        # The file is already stored, so a full queue is noted on the result
+        # instead of being raised at a caller that would think it failed.
+        try:
+            self.process(saved)
+        except ProcessingQueueFull as e:
+            saved.processing_error = e
+
+    def processor(self, func=None, retries=0, retry_delay=1.0, name=None):
+        """
+        This registers a post-processing stage, like a virus scan or
+        stripping EXIF data, to be run on every file saved to this set. The
+        stages run in the order they were registered, in the background on
+        the app's `processing_queue`, so `save` returns as soon as the file
+        is stored. Each one is called with the set and the saved file's name,
+        inside an app context. Use it as a decorator, with or without
+        arguments::
+
+            @photos.processor(retries=3)
+            def scan(uset, name):
+                virus_scanner.check(uset.path(name))
+
+        .. versionadded:: 0.3
+
+        :param func: The stage function.
+        :param retries: How many more times to try the stage if it raises.
+        :param retry_delay: How many seconds to wait before the first retry.
+                            The wait doubles after each one.
+        :param name: The stage's name in `ProcessingStatus`. It defaults to
+                     the function's name.
+        """
+        def register(func):
+            self.processors.append(Processor(func, retries, retry_delay,
+                                             name))
+            return func
+        if func is not None:
+            return register(func)
+        return register
+
+    def authorize_resumable(self, func):
+        """
+        This registers a function that decides who may use this set's
+        resumable upload views. It is called before each of them with the
+        set and the upload's ID (`None` when an upload is being created),
+        inside the request, and the request is refused with 403 unless it
+        returns `True`. Use it as a decorator::
+
+            @files.authorize_resumable
+            def check(uset, upload_id):
+                return current_user.is_authenticated
+
+        Without one, anyone who can reach the uploads module can upload to a
+        set with `UPLOADED_X_RESUMABLE` turned on.
+
+        .. versionadded:: 0.3
+
+        :param func: The function.
+        """
+        self.resumable_authorizer = func
+        return func
+
+    def process(self, filename, folder=None):
+        """
+        This queues a stored file for this set's post-processing stages.
+        `save` does this automatically, so it is only needed to process a
+        file again, or to retry after `ProcessingQueueFull`.
+
+        .. versionadded:: 0.3
+
+        :param filename: The filename to process.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        app = _current_app()
+        if app is None:
+            raise RuntimeError("processing uploads needs an application")
+        processing_queue(app).enqueue(app, self, _join_name(folder, filename))
+
+    def processing_status(self, filename, folder=None):
+        """
+        This returns the `ProcessingStatus` of a file queued for
+        post-processing, or `None` if the queue doesn't know about it.
+
+        .. versionadded:: 0.3
+
+        :param filename: The filename to look up.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        return processing_queue(_current_app()).status(
+            self, _join_name(folder, filename))
+
+    def make_variant(self, filename, variant, folder=None):
+        """
+        This makes sure a variant of an image stored in this set is up to
+        date, and returns the name it is stored under, or `None` if the file
+        doesn't exist or isn't an image Pillow can read. See `make_variant`.
+
+        .. versionadded:: 0.3
+
+        :param filename: The filename of the original image.
+        :param variant: The name of one of the set's `UPLOADED_X_VARIANTS`.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        config = self.config
+        self._check_variant(config, variant)
+        return make_variant(config, _join_name(folder, filename), variant)
+
+    def _queue_variants(self, config, name):
+        app = _current_app()
+        if app is None or not isinstance(config.backend, LocalStorage):
+            return
+
+        def make_all():
+            for variant in config.variants:
+                try:
+                    make_variant(config, name, variant)
+                except Exception:
+                    app.logger.exception("could not make %s variant of %s",
+                                         variant, name)
+        upload_executor(app).submit(make_all)
+
+    def _shard(self, storage, basename, folder, config):
+        # The folder a file goes in once the set's sharding is applied.
+        if config.shard is None or config.content_addressed:
+            return folder
+        shard = config.shard(storage, basename)
+        if not shard:
+            return folder
+        return posixpath.join(folder, shard) if folder else shard
+
+    def _budget(self, config):
+        # The set's byte budget for the current request, if it has one.
+        if config.max_request_size is None or not has_request_context():
+            return None
+        budgets = g.setdefault('_upload_budgets', {})
+        if self.name not in budgets:
+            budgets[self.name] = _Budget(config.max_request_size)
+        return budgets[self.name]
+
+    def _limit(self, storage, config, budget):
+        """
+        This enforces `UPLOADED_X_MAX_SIZE`, and `UPLOADED_X_MAX_REQUEST_SIZE`
+        through the request's `budget` from `_budget`, on an upload. If its
+        size is known, it is checked right away, so an oversized file is
+        never written at all. Otherwise, it is returned wrapped so that its
+        bytes are counted while it is saved, and the save fails with
+        `UploadTooLarge` as soon as it goes over.
+        """
+        if ((config.max_size is None and budget is None) or
+                _overrides_save(storage)):
+            return storage
+        size = _stream_size(storage)
+        if size is None:
+            return FileStorage(_LimitedReader(storage.stream, config.max_size,
+                                              budget),
+                               storage.filename, storage.name,
+                               headers=storage.headers)
+        if ((config.max_size is not None and size > config.max_size) or
+                (budget is not None and not budget.spend(size))):
+            raise UploadTooLarge()
+        return storage
+
+    def stream_factory(self, folder=None, strict=False):
+        """
+        This returns a function Werkzeug can use as its ``stream_factory``
+        while it parses a multipart request. Each file whose extension this
+        set allows is written straight into a hidden temporary file in the
+        folder it will be saved to, so `save` only has to give it its final
+        name, instead of copying it again. Every byte of the upload is
+        written to disk once. Files this set would refuse are thrown away as
+        they arrive, without being stored anywhere, and `save` then refuses
+        them as usual.
+
+        Files without a filename, and sets that don't use `LocalStorage`, get
+        Werkzeug's usual in-memory or temporary file.
+
+        If `strict` is `True`, a file this set would refuse stops the whole
+        request as soon as its headers arrive, before any of its data is
+        read. A disallowed extension or declared content type aborts with
+        415, and a file that declares, or turns out to have, more than
+        `UPLOADED_X_MAX_SIZE` bytes aborts with 413 once the limit is
+        passed. So do files that together pass
+        `UPLOADED_X_MAX_REQUEST_SIZE`.
+
+        The easiest way to use it is `stream_request`. To use it for every
+        request, override ``_get_file_stream`` on your request class.
+
+        .. versionadded:: 0.3
+
+        :param folder: The subfolder within the upload set the files will be
+                       saved to. Files saved to another filesystem are
+                       copied.
+        :param strict: If `True`, abort the request as soon as a file is
+                       known to be refused.
+        """
+        config = self.config
+        backend = config.backend
+        limit = config.max_size if strict else None
+        if strict and config.max_request_size is not None:
+            budget = _Budget(config.max_request_size)
+        else:
+            budget = None
+
+        def factory(total_content_length, content_type, filename=None,
+                    content_length=None):
+            if filename:
+                basename = self.get_basename(filename)
+                allowed = self._check(config, 'extension_allowed',
+                                      extension(basename))
+                if strict:
+                    if not (allowed and self._check(
+                            config, 'content_type_allowed', content_type)):
+                        abort(415)
+                    if limit is not None and content_length and \
+                            content_length > limit:
+                        abort(413)
+                elif not allowed:
+                    return _Discard()
+            if not filename or not isinstance(backend, LocalStorage):
+                stream = default_stream_factory(
+                    total_content_length=total_content_length,
+                    content_type=content_type, filename=filename,
+                    content_length=content_length)
+                if filename and (limit is not None or budget is not None):
+                    stream = _CappedFile(stream, limit, budget)
+                return stream
+            target_folder = backend.path(folder) if folder else backend.root
+            _makedirs(target_folder)
+            return StreamedFile(_temp_path(target_folder), limit, budget)
+        return factory
+
+    def stream_request(self, folder=None, strict=False):
+        """
+        This makes the current request write its uploaded files with this
+        set's `stream_factory`. Call it in the view before touching
+        `request.files` or `request.form`. ::
+
+            @app.route('/upload', methods=['POST'])
+            def upload():
+                photos.stream_request()
+                filename = photos.save(request.files['photo'])
+
+        .. versionadded:: 0.3
+
+        To refuse bad uploads before their data is read, pass `strict`, or
+        call it from a ``before_request`` function for the upload views::
+
+            @app.before_request
+            def guard_uploads():
+                if request.endpoint == 'upload':
+                    photos.stream_request(strict=True)
+
+        :param folder: The subfolder the files will be saved to.
+        :param strict: If `True`, abort the request with 415 or 413 as soon
+                       as a file is known to be refused. See
+                       `stream_factory`.
+        """
+        request._get_file_stream = self.stream_factory(folder, strict)
+
+    def save_many(self, storages, folder=None, workers=4):
+        """
+        This saves a batch of uploaded files, like the ones from a form field
+        with ``multiple`` set, into this upload set. Every file is checked
+        before anything is written, and the files are then written at the
+        same time on up to `workers` threads. It returns a list with one item
+        per file, in order: the `SavedFile` if it was saved, or the exception
+        (like `UploadNotAllowed`) if it wasn't. ::
+
+            results = photos.save_many(request.files.getlist('photos'))
+            saved = [r for r in results if not isinstance(r, Exception)]
+
+        For a plain `LocalStorage` set with the default resolver, the target
+        folder is created and listed once, and every name is picked from
+        that listing, instead of being checked file by file.
+
+        :param storages: The uploaded files to save.
+        :param folder: The subfolder within the upload set to save to.
+        :param workers: The most files to write at once.
+        """
+        config = self.config
+        budget = self._budget(config)
+        storages = list(storages)
+        results = [None] * len(storages)
+        pending = []
+        for index, storage in enumerate(storages):
+            if not isinstance(storage, FileStorage):
+                results[index] = TypeError(
+                    "storage must be a werkzeug.FileStorage")
+                continue
+            basename = self.get_basename(storage.filename)
+            if not self._check(config, 'file_allowed', storage, basename):
+                results[index] = UploadNotAllowed()
+                continue
+            try:
+                storage = self._limit(storage, config, budget)
+            except UploadTooLarge as e:
+                results[index] = e
+                continue
+            pending.append((index, storage, basename,
+                            self._shard(storage, basename, folder, config)))
+        if not pending:
+            return results
+
+        backend = config.backend
+        if (isinstance(backend, LocalStorage) and
+                type(self.resolver) is ProbingResolver and
+                type(self).resolve_conflict is UploadSet.resolve_conflict and
+                not (config.atomic or config.content_addressed or
+                     config.deduplicate)):
+            jobs = self._claim_batch(backend, config, pending, results)
+        else:
+            # Files that want the same name are saved one after another, so
+            # they can't race each other for it.
+            groups = {}
+            for item in pending:
+                groups.setdefault((item[3], item[2]), []).append(item)
+            jobs = [(self._save_group, (config, group))
+                    for group in groups.values()]
+
+        with ThreadPoolExecutor(max(1, min(workers, len(jobs)))) as pool:
+            futures = []
+            try:
+                for func, args in jobs:
+                    futures.append(pool.submit(func, *args))
+            except BaseException:
+                # The names claimed for jobs that will never run would
+                # otherwise be left behind as empty files.
+                unrun = [job for job, future in zip(jobs, futures)
+                         if future.cancel()] + jobs[len(futures):]
+                for func, args in unrun:
+                    if func == self._write_claimed:
+                        _unlink_quietly(args[-1])
+                raise
+            for future in futures:
+                for index, result in future.result():
+                    results[index] = result
+        if config.fsync == 'file+dir' and isinstance(backend, LocalStorage):
+            for folder in set(item[3] for item in pending):
+                _fsync_dir(backend.path(folder) if folder else backend.root)
+        for index, result in enumerate(results):
+            if isinstance(result, SavedFile):
+                if config.compress:
+                    compress_file(config, result)
+                if config.stat_cache is not None:
+                    config.stat_cache.invalidate(result)
+                if config.variants_eager and config.variants:
+                    self._queue_variants(config, result)
+                if self.processors:
+                    self._queue_processing(result)
+        return results
+
+    def save_archive(self, storage, folder=None):
+        """
+        This extracts an uploaded ``.zip``, ``.tar``, ``.tar.gz``,
+        ``.tar.bz2`` or ``.tar.xz`` archive into this upload set, and
+        returns the names of the files saved, as `SavedFile` objects. Each
+        file is read straight out of the archive into `save`, so neither the
+        archive nor its files are copied anywhere first. Folders inside the
+        archive are kept, under `folder`.
+
+        Files this set wouldn't allow, hidden files, and anything that isn't
+        a regular file, like a link, are left out. If any name would be
+        extracted outside `folder` ("zip slip"), or the archive can't be
+        read, `UploadNotAllowed` is raised. If it goes over
+        `UPLOADED_X_ARCHIVE_MAX_MEMBERS`, `UPLOADED_X_ARCHIVE_MAX_SIZE` or
+        `UPLOADED_X_ARCHIVE_MAX_RATIO`, `UploadTooLarge` is raised. Either
+        way, the files already saved from it are deleted again.
+
+        A zip file is checked from its directory before anything is written.
+        It has to be read out of order, so if the upload's stream can't seek,
+        it is copied to a temporary file first. Tar archives are read
+        in one pass.
+
+        .. versionadded:: 0.3
+
+        :param storage: The uploaded archive.
+        :param folder: The subfolder within the upload set to extract to.
+        """
+        if not isinstance(storage, FileStorage):
+            raise TypeError("storage must be a werkzeug.FileStorage")
+        config = self.config
+        filename = (storage.filename or '').lower()
+        if filename.endswith('.zip'):
+            stream = storage.stream
+            if not _seekable(stream):
+                stream = tempfile.TemporaryFile()
+                shutil.copyfileobj(storage.stream, stream, config.buffer_size)
+                stream.seek(0)
+            read = self._zip_members
+        elif filename.endswith(('.tar', '.tar.gz', '.tgz', '.tar.bz2',
+                                '.tbz2', '.tar.xz', '.txz')):
+            stream = storage.stream
+            read = self._tar_members
+        else:
+            raise UploadNotAllowed()
+        source = _CountingReader(stream)
+        budget = _ArchiveBudget(config.archive_max_size,
+                                config.archive_max_ratio, source)
+        members = read(config, source, budget)
+        request_budget = self._budget(config)
+        saved = []
+        try:
+            for subfolder, basename, member in members:
+                member = FileStorage(
+                    _LimitedReader(member, None, budget), basename,
+                    content_type=mimetypes.guess_type(basename)[0])
+                try:
+                    saved.append(self._save(
+                        config, member, _join_name(folder, subfolder) or None,
+                        None, request_budget))
+                except UploadTooLarge:
+                    raise
+                except UploadNotAllowed:
+                    # Like a file whose contents don't fit its extension.
+                    continue
+        except (zipfile.BadZipfile, tarfile.TarError, zlib.error, EOFError,
+                LZMAError):
+            for name in saved:
+                self.delete(name)
+            raise UploadNotAllowed()
+        except BaseException:
+            for name in saved:
+                self.delete(name)
+            raise
+        finally:
+            members.close()
+            if stream is not storage.stream:
+                stream.close()
+        return saved
+
+    def _archive_member(self, config, name):
+        # The folder and basename a file in an archive is saved under, or
+        # None if it should be left out.
+        split = _member_name(name)
+        if split is None:
+            return None
+        basename = self.get_basename(split[1])
+        if not self._check(config, 'extension_allowed', extension(basename)):
+            return None
+        return split[0], basename
+
+    def _zip_members(self, config, source, budget):
+        # Everything the directory says is checked before anything is read.
+        with zipfile.ZipFile(source) as archive:
+            infos = archive.infolist()
+            if (config.archive_max_members is not None and
+                    len(infos) > config.archive_max_members):
+                raise UploadTooLarge()
+            members = []
+            for info in infos:
+                split = self._archive_member(config, info.filename)
+                # Folders, links and encrypted files are left out.
+                if (split is None or info.filename.endswith('/') or
+                        stat.S_ISLNK(info.external_attr >> 16) or
+                        info.flag_bits & 0x1):
+                    continue
+                members.append((info, split))
+            total = sum(info.file_size for info, split in members)
+            packed = sum(info.compress_size for info, split in members)
+            if ((config.archive_max_size is not None and
+                 total > config.archive_max_size) or
+                    (config.archive_max_ratio is not None and
+                     total > _RATIO_GRACE and
+                     total > config.archive_max_ratio * packed)):
+                raise UploadTooLarge()
+            for info, (subfolder, basename) in members:
+                with archive.open(info) as member:
+                    yield subfolder, basename, member
+
+    def _tar_members(self, config, source, budget):
+        with tarfile.open(fileobj=source, mode='r|*') as archive:
+            count = 0
+            for info in archive:
+                count += 1
+                if (config.archive_max_members is not None and
+                        count > config.archive_max_members):
+                    raise UploadTooLarge()
+                split = self._archive_member(config, info.name)
+                if split is None or not info.isreg():
+                    # It is still unpacked to get past it.
+                    if info.isreg() and not budget.spend(info.size):
+                        raise UploadTooLarge()
+                    continue
+                yield split[0], split[1], archive.extractfile(info)
+
+    def _claim_batch(self, backend, config, pending, results):
+        # Each target folder is created and listed once, however many of the
+        # files are going into it. A file whose folder or name can't be
+        # claimed gets the error in `results`, and the rest still go ahead.
+        listings = {}
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        jobs = []
+        for index, storage, basename, folder in pending:
+            target_folder = backend.path(folder) if folder else backend.root
+            try:
+                taken = listings.get(target_folder)
+                if taken is None:
+                    _makedirs(target_folder)
+                    taken = listings[target_folder] = set(
+                        os.listdir(target_folder))
+                target = self._claim_name(target_folder, basename, taken,
+                                          flags)
+            except Exception as e:
+                results[index] = e
+                continue
+            jobs.append((self._write_claimed,
+                         (config, folder, index, storage,
+                          os.path.basename(target), target)))
+        return jobs
+
+    def _claim_name(self, target_folder, basename, taken, flags):
+        for candidate in suffixed_names(basename):
+            if candidate in taken:
+                continue
+            taken.add(candidate)
+            target = os.path.join(target_folder, candidate)
+            try:
+                os.close(os.open(target, flags, 0o666))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                continue
+            return target
+
+    def _write_claimed(self, config, folder, index, storage, basename,
+                       target):
+        hasher = hashlib.new(config.hash) if config.hash else None
+        try:
+            size = write_storage(storage, target, config.buffer_size,
+                                 fsync=config.fsync != 'none', hasher=hasher)
+        except Exception as e:
+            _unlink_quietly(target)
+            return [(index, e)]
+        saved = SavedFile(basename, hasher and hasher.hexdigest(), size)
+        return [(index, saved.within(folder))]
+
+    def _save_group(self, config, group):
+        results = []
+        for index, storage, basename, folder in group:
+            try:
+                saved = config.backend.save_stream(self, storage, folder,
+                                                   basename, config)
+            except Exception as e:
+                saved = e
+            results.append((index, saved))
+        return results
+
+    def _offload(self, func, *args, **kwargs):
+        app = current_app._get_current_object()
+
+        def call():
+            with app.app_context():
+                return func(*args, **kwargs)
+        return asyncio.wrap_future(upload_executor(app).submit(call))
+
+    def save_async(self, storage, folder=None, name=None):
+        """
+        This is `save` for asynchronous views. It returns an awaitable that
+        resolves to the `SavedFile` (or raises `UploadNotAllowed`), and does
+        all of the file work on the app's `upload_executor`, so the event
+        loop isn't blocked while the upload is written. ::
+
+            @app.route('/upload', methods=['POST'])
+            async def upload():
+                filename = await photos.save_async(request.files['photo'])
+
+        :param storage: The uploaded file to save.
+        :param folder: The subfolder within the upload set to save to.
+        :param name: The name to save the file as. See `save`.
+        """
+        # The request's budget can only be found from the request's thread.
+        config = self.config
+        return self._offload(self._save, config, storage, folder, name,
+                             self._budget(config))
+
+    def exists_async(self, filename, folder=None):
+        """
+        This is `exists` for asynchronous views. It returns an awaitable.
+
+        :param filename: The filename to check.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        return self._offload(self.exists, filename, folder)
+
+    def delete_async(self, filename, folder=None):
+        """
+        This is `delete` for asynchronous views. It returns an awaitable.
+
+        :param filename: The filename to delete.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        return self._offload(self.delete, filename, folder)
+
+    def exists(self, filename, folder=None):
+        """
+        This tells whether a file is stored in this set.
+
+        :param filename: The filename to check.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        config = self.config
+        if config.stat_cache is not None:
+            return self.stat(filename, folder) is not None
+        return config.backend.exists(_join_name(folder, filename))
+
+    def iter_files(self, folder=None, recursive=True):
+        """
+        This lazily yields the name of every file stored in this set, or in
+        one of its folders, in no particular order. The names are the same
+        as the ones `save` returns, so they can be passed to `url`, `stat`,
+        `delete` and so on. Hidden files, like unfinished uploads and a
+        deduplicated set's stored copies, are skipped. Nothing is stat'ed,
+        and the names are never all held in memory at once, so it is fine
+        for sets with millions of files. ::
+
+            for name in photos.iter_files('tmp'):
+                photos.delete(name)
+
+        .. versionadded:: 0.3
+
+        :param folder: The folder to list, or `None` for the whole set.
+        :param recursive: If `False`, files in subfolders aren't included.
+        """
+        for name, info in self.config.backend.scan(folder, recursive):
+            yield name
+
+    def disk_usage(self, folder=None):
+        """
+        This returns the total size, in bytes, of the files stored in this
+        set, or in one of its folders. It adds up the files' sizes as it
+        goes, without listing them all first. Files that are hard links to
+        the same contents, as in deduplicated sets, are counted once for each
+        name.
+
+        .. versionadded:: 0.3
+
+        :param folder: The folder to measure, or `None` for the whole set.
+        """
+        return sum(info.size for name, info in
+                   self.config.backend.scan(folder, True, stat=True))
+
+    def stat(self, filename, folder=None):
+        """
+        This returns a `FileStat` with the size, modification time and entity
+        tag of a file stored in this set, or `None` if there is no such file.
+        If the set has a `StatCache` (see `UPLOADED_X_STAT_CACHE`), recent
+        answers come from it instead of the storage.
+
+        .. versionadded:: 0.3
+
+        For a file kept gzipped by `UPLOADED_X_COMPRESS_ONLY`, the size is
+        that of the original contents, as gzip records it (modulo 4 GB).
+
+        :param filename: The filename to look up.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        config = self.config
+        name = _join_name(folder, filename)
+        info = _stat(config, name)
+        if info is not None and _stored_gzipped(config, name):
+            info = FileStat(_gzip_size(config.backend.path(name)),
+                            info.mtime, info.etag)
+        return info
+
+    def open(self, filename, folder=None):
+        """
+        This opens a file stored in this set for reading, in binary mode,
+        wherever the set's backend keeps it. A file kept gzipped by
+        `UPLOADED_X_COMPRESS_ONLY` is unzipped as it is read, so this always
+        gives the contents that were uploaded. (`path` still leads to the
+        gzipped file.)
+
+        :param filename: The filename to open.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        config = self.config
+        name = _join_name(folder, filename)
+        if _stored_gzipped(config, name):
+            return gzip.open(config.backend.path(name), 'rb')
+        return config.backend.open(name)
+
+    def delete(self, filename, folder=None):
+        """
+        This deletes a file from this set, and returns `True` if it existed.
+        If the set is deduplicated and this was the last name for its
+        contents, the stored copy is deleted as well. (Finding it means
+        hashing the file one last time.) Any image variants and compressed
+        copies made from it are deleted too.
+
+        Be careful with content-addressed sets, where every upload with the
+        same contents shares a single name. In a local set, a name outside
+        the set's destination, like ``../secret.txt``, raises `ValueError`.
+
+        :param filename: The filename to delete.
+        :param folder: The subfolder within the upload set previously used
+                       to save to.
+        """
+        config = self.config
+        name = _join_name(folder, filename)
+        if isinstance(config.backend, LocalStorage):
+            # This refuses a name outside the set before anything made from
+            # it, like its variants, is touched.
+            config.backend.path(name)
+        try:
+            return self._delete(config, filename, folder)
+        finally:
+            if config.stat_cache is not None:
+                config.stat_cache.invalidate(name)
+            if config.variants and isinstance(config.backend, LocalStorage):
+                for variant in config.variants:
+                    _unlink_quietly(config.backend.path(
+                        variant_name(name, variant)))
+            if config.compress and not config.compress_only:
+                for encoding in config.compress:
+                    cname = compressed_name(name, encoding)
+                    _unlink_quietly(config.backend.path(cname))
+                    if config.stat_cache is not None:
+                        config.stat_cache.invalidate(cname)
+
+    def _delete(self, config, filename, folder):
+        if not (config.deduplicate and
+                isinstance(config.backend, LocalStorage)):
+            return config.backend.delete(_join_name(folder, filename))
+        path = self.path(filename, folder)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        blob = None
+        if st.st_nlink == 2:
+            hasher = hashlib.new(config.hash)
+            with open(path, 'rb') as f:
+                hash_stream(f, hasher, config.buffer_size)
+            blob = blob_path(config.destination, hasher.hexdigest())
+        _unlink_quietly(path)
+        if blob is not None:
+            try:
+                blob_st = os.stat(blob)
+            except OSError:
+                return True
+            if os.path.samestat(st, blob_st) and blob_st.st_nlink == 1:
+                _unlink_quietly(blob)
+        return True
+
+    def prune_blobs(self):
+        """
+        This deletes every stored copy in a deduplicated set that no longer
+        has any names, because the files were deleted without going through
+        `delete`, and returns how many were deleted.
+        """
+        root = os.path.join(self.config.destination, BLOB_FOLDER)
+        pruned = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if os.stat(path).st_nlink == 1:
+                    _unlink_quietly(path)
+                    pruned += 1
+        return pruned
+
+    def resolve_conflict(self, target_folder, basename):
+        """
+        If a file with the selected name already exists in the target folder,
+        this method is called by the default `ProbingResolver` to resolve the
+        conflict. It should return a new basename for the file.
+
+        The default implementation splits the name and extension and adds a
+        suffix to the name consisting of an underscore and a number, and tries
+        that until it finds one that doesn't exist.
+
+        :param target_folder: The absolute path to the target.
+        :param basename: The file's original basename.
+        """
+        name, ext = os.path.splitext(basename)
+        count = 0
+        while True:
+            count = count + 1
+            newname = '%s_%d%s' % (name, count, ext)
+            if not os.path.exists(os.path.join(target_folder, newname)):
+                return newname
+
+
+#: The hidden folder, inside a set's destination, that image variants are
+#: kept in. Everything in it can be made again, so it can be cleared at any
+#: time.
+VARIANT_FOLDER = '.variants'
+
+
+def variant_name(name, variant):
+    """
+    This returns the name a variant of a stored file is kept under, relative
+    to the set's destination, like ``.variants/thumb/2026/cat.jpg``.
+
+    :param name: The name of the original file.
+    :param variant: The name of the variant.
+    """
+    return posixpath.join(VARIANT_FOLDER, variant, name)
+
+
+def make_variant(config, name, variant):
+    """
+    This makes sure the `variant` of the image `name` in a `LocalStorage` set
+    is up to date, and returns its name (see `variant_name`), or `None` if
+    the original doesn't exist or isn't an image Pillow can read. The image
+    is shrunk, keeping its proportions, to fit in the variant's box from
+    `UploadConfiguration.variants`, and saved in its original format.
+
+    A variant is given its original's modification time, and only made again
+    if that stops matching, so replacing an image replaces its variants too,
+    and checking one costs two `os.stat` calls. It is written to a temporary
+    file and renamed into place, so nothing ever sees half a variant.
+
+    :param config: The set's `UploadConfiguration`.
+    :param name: The name of the original image.
+    :param variant: The name of the variant to make.
+    """
+    from PIL import Image, ImageOps
+
+    backend = config.backend
+    source = backend.path(name)
+    vname = variant_name(name, variant)
+    target = backend.path(vname)
+    try:
+        source_st = os.stat(source)
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return None
+    if not stat.S_ISREG(source_st.st_mode):
+        return None
+    try:
+        if os.stat(target).st_mtime_ns == source_st.st_mtime_ns:
+            return vname
+    except OSError as e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+    try:
+        image = Image.open(source)
+    except (IOError, OSError, ValueError, Image.DecompressionBombError):
+        return None
+    with image:
+        image_format = image.format
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(config.variants[variant])
+        target_folder = os.path.dirname(target)
+        _makedirs(target_folder)
+        temp = _temp_path(target_folder)
+        try:
+            options = {'quality': 85} if image_format == 'JPEG' else {}
+            image.save(temp, format=image_format, **options)
+            os.utime(temp, ns=(source_st.st_atime_ns, source_st.st_mtime_ns))
+            os.rename(temp, target)
+        finally:
+            _unlink_quietly(temp)
+    if config.stat_cache is not None:
+        config.stat_cache.invalidate(vname)
+    return vname
+
+
+#: The hidden folder, inside a set's destination, that compressed copies of
+#: files are kept in.
+COMPRESSED_FOLDER = '.compressed'
+
+
+def compressed_name(name, encoding):
+    """
+    This returns the name the compressed copy of a stored file is kept
+    under, relative to the set's destination, like
+    ``.compressed/2026/export.csv.gz``.
+
+    :param name: The name of the original file.
+    :param encoding: The content coding, from `COMPRESSIONS`.
+    """
+    return posixpath.join(COMPRESSED_FOLDER, name + COMPRESSIONS[encoding])
+
+
+def _stored_gzipped(config, name):
+    # Whether `compress_file` replaced the file with its gzipped form.
+    return (config.compress_only and
+            isinstance(config.backend, LocalStorage) and
+            extension(name).lower() in COMPRESSIBLE)
+
+
+def _gzip_size(path):
+    # A gzip file ends with the size of its contents, modulo 2 ** 32.
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def _compress_stream(encoding, source, target, buffer_size):
+    if encoding == 'gzip':
+        # With no timestamp, the same file always compresses the same way.
+        with gzip.GzipFile(fileobj=target, mode='wb', compresslevel=9,
+                           mtime=0) as out:
+            shutil.copyfileobj(source, out, buffer_size)
+    elif encoding == 'br':
+        import brotli
+        compressor = brotli.Compressor(quality=9)
+        for chunk in iter(lambda: source.read(buffer_size), b''):
+            target.write(compressor.process(chunk))
+        target.write(compressor.finish())
+    else:
+        import zstandard
+        zstandard.ZstdCompressor(level=10).copy_stream(
+            source, target, read_size=buffer_size, write_size=buffer_size)
+
+
+def compress_file(config, name):
+    """
+    This compresses a stored file in a `LocalStorage` set with each of the
+    set's `UploadConfiguration.compress` codings, if its extension is in
+    `COMPRESSIBLE`, and returns the names it wrote. `UploadSet.save` calls
+    it, so the work is done once per file instead of once per request.
+
+    Each copy is kept under `compressed_name`, and given its original's
+    modification time, so the uploads module can tell when it is out of
+    date. A copy that isn't smaller than the original isn't kept. If the set
+    has `UploadConfiguration.compress_only` set, the file is instead
+    replaced with its gzipped form, under the same name.
+
+    :param config: The set's `UploadConfiguration`.
+    :param name: The name of the stored file.
+    """
+    if extension(name).lower() not in COMPRESSIBLE:
+        return []
+    backend = config.backend
+    source = backend.path(name)
+    written = []
+    with open(source, 'rb') as f:
+        source_st = os.fstat(f.fileno())
+        for encoding in config.compress[:1] if config.compress_only \
+                else config.compress:
+            if config.compress_only:
+                cname = name
+                target = source
+            else:
+                cname = compressed_name(name, encoding)
+                target = backend.path(cname)
+            target_folder = os.path.dirname(target)
+            _makedirs(target_folder)
+            temp = _temp_path(target_folder)
+            try:
+                f.seek(0)
+                with open(temp, 'wb') as out:
+                    _compress_stream(encoding, f, out, config.buffer_size)
+                    size = out.tell()
+                if config.compress_only or size < source_st.st_size:
+                    os.utime(temp, ns=(source_st.st_atime_ns,
+                                       source_st.st_mtime_ns))
+                    os.rename(temp, target)
+                    written.append(cname)
+                else:
+                    _unlink_quietly(target)
+            finally:
+                _unlink_quietly(temp)
+            if config.stat_cache is not None:
+                config.stat_cache.invalidate(cname)
+    return written
+
+
+#: The hidden folder in a local set's destination that resumable uploads are
+#: assembled in.
+RESUMABLE_FOLDER = '.resumable'
+
+#: The largest resumable upload a set takes when neither
+#: `MAX_CONTENT_LENGTH` nor its `UPLOADED_X_MAX_SIZE` is set, since the
+#: space for the whole file is set aside as soon as it is created.
+RESUMABLE_MAX_SIZE = 100 * 1024 * 1024
+
+#: The version of the tus protocol the resumable upload views speak.
+TUS_VERSION = '1.0.0'
+
+
+def resumable_folder(config):
+    """
+    This returns the folder unfinished resumable uploads for a set are kept
+    in. For `LocalStorage` it is in the destination, so finished files don't
+    have to cross filesystems. Otherwise it is in the temporary directory.
+
+    :param config: The set's `UploadConfiguration`.
+    """
+    if isinstance(config.backend, LocalStorage):
+        return os.path.join(config.backend.root, RESUMABLE_FOLDER)
+    return os.path.join(tempfile.gettempdir(), 'flask-uploads',
+                        uuid.uuid5(uuid.NAMESPACE_URL,
+                                   repr(config.backend)).hex)
+
+
+class ResumableUpload(object):
+    """
+    This is a file being uploaded in pieces. Its data is written straight
+    into a file of its full length, allocated when the upload is created,
+    and its progress is kept in a small JSON file next to it, so any worker
+    can continue it. The constructor's arguments are also the attributes.
+
+    The uploads module exposes this as a subset of the `tus`_ protocol, for
+    sets configured with `UPLOADED_X_RESUMABLE`:
+
+    ``POST /_uploads/<set>/.resumable``
+        Creates an upload. `Upload-Length` gives its size, and
+        `Upload-Metadata` should include a `filename`. The response's
+        `Location` is the upload's URL.
+
+    ``HEAD <location>``
+        Returns the `Upload-Offset` to continue from.
+
+    ``PATCH <location>``
+        Writes the body at `Upload-Offset`.
+
+    ``POST <location>/finalize``
+        Saves the finished file into the set with `UploadSet.save`, and
+        returns its name and URL as JSON.
+
+    ``DELETE <location>``
+        Throws the upload away.
+
+    .. _tus: https://tus.io/protocols/resumable-upload
+
+    :param folder: The folder the upload is kept in.
+    :param id: The upload's ID.
+    :param filename: The filename the client gave.
+    :param length: The file's full size.
+    :param offset: How many bytes have been received.
+    :param content_type: The content type the client gave.
+    """
+    id_re = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, folder, id, filename, length, offset=0,
+                 content_type=None):
+        self.folder = folder
+        self.id = id
+        self.filename = filename
+        self.length = length
+        self.offset = offset
+        self.content_type = content_type
+
+    @property
+    def data_path(self):
+        return os.path.join(self.folder, self.id)
+
+    @property
+    def info_path(self):
+        return os.path.join(self.folder, self.id + '.json')
+
+    @property
+    def complete(self):
+        return self.offset == self.length
+
+    @classmethod
+    def create(cls, folder, filename, length, content_type=None):
+        """
+        This starts a new upload in `folder`, and allocates the space for it.
+
+        :param folder: The folder to keep the upload in.
+        :param filename: The filename the client gave.
+        :param length: The file's full size.
+        :param content_type: The content type the client gave.
+        """
+        _makedirs(folder)
+        upload = cls(folder, uuid.uuid4().hex, filename, length,
+                     content_type=content_type)
+        fd = os.open(upload.data_path,
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                     getattr(os, 'O_BINARY', 0), 0o600)
+        try:
+            if length and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, length)
+                except OSError as e:
+                    if e.errno not in _COPY_UNSUPPORTED:
+                        raise
+                    os.ftruncate(fd, length)
+            else:
+                os.ftruncate(fd, length)
+        except BaseException:
+            os.close(fd)
+            _unlink_quietly(upload.data_path)
+            raise
+        os.close(fd)
+        upload.save_info()
+        return upload
+
+    @classmethod
+    def load(cls, folder, id, max_age=None):
+        """
+        This returns the upload in `folder` with the given ID, or `None` if
+        there isn't one. If `max_age` is given and no data has arrived for
+        the upload in that many seconds, it is discarded instead.
+
+        :param folder: The folder the upload is kept in.
+        :param id: The upload's ID.
+        :param max_age: How many seconds an upload is kept after its last
+                        write.
+        """
+        if not cls.id_re.match(id):
+            return None
+        info_path = os.path.join(folder, id + '.json')
+        try:
+            if (max_age is not None and
+                    os.stat(info_path).st_mtime < time.time() - max_age):
+                cls(folder, id, None, 0).discard()
+                return None
+            with open(info_path) as f:
+                info = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return cls(folder, id, info['filename'], info['length'],
+                   info['offset'], info.get('content_type'))
+
+    @classmethod
+    def sweep(cls, folder, max_age):
+        """
+        This discards every upload in `folder` that no data has arrived for
+        in `max_age` seconds, along with any data file whose record is gone,
+        and returns how many it discarded. The uploads module calls it each
+        time an upload is created, so abandoned uploads don't pile up.
+
+        :param folder: The folder the uploads are kept in.
+        :param max_age: How many seconds an upload is kept after its last
+                        write.
+        """
+        cutoff = time.time() - max_age
+        swept = 0
+        try:
+            names = os.listdir(folder)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+        for name in names:
+            id = name[:-len('.json')] if name.endswith('.json') else name
+            if not cls.id_re.match(id):
+                continue
+            try:
+                mtime = os.stat(os.path.join(folder, id + '.json')).st_mtime
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # A data file whose record is gone, unless it is being
+                # created right now.
+                try:
+                    mtime = os.stat(os.path.join(folder, id)).st_mtime
+                except OSError:
+                    continue
+            if mtime < cutoff:
+                cls(folder, id, None, 0).discard()
+                if name == id:
+                    swept += 1
+        return swept
+
+    def save_info(self):
+        """
+        This records the upload's progress, replacing the old record in one
+        step so a crash never leaves it half written.
+        """
+        info = dict(filename=self.filename, length=self.length,
+                    offset=self.offset, content_type=self.content_type)
+        temp = _temp_path(self.folder)
+        with open(temp, 'w') as f:
+            json.dump(info, f)
+        try:
+            os.rename(temp, self.info_path)
+        except OSError:
+            # Windows won't rename over an existing file.
+            _unlink_quietly(self.info_path)
+            os.rename(temp, self.info_path)
+
+    def write(self, stream, offset, buffer_size=16384):
+        """
+        This writes everything in `stream` into the upload at `offset`, which
+        must be the current `offset`, and records the new offset. If the
+        stream breaks off, whatever arrived before that still counts. It
+        raises a `ValueError` if the offset is wrong or the data would go
+        past `length`.
+
+        :param stream: The file-like object to read.
+        :param offset: The offset the client is writing at.
+        :param buffer_size: The number of bytes to read at a time.
+        """
+        if offset != self.offset:
+            raise ValueError("upload is at offset %d, not %d" %
+                             (self.offset, offset))
+        try:
+            with open(self.data_path, 'r+b') as f:
+                f.seek(offset)
+                while True:
+                    chunk = stream.read(buffer_size)
+                    if not chunk:
+                        break
+                    if self.offset + len(chunk) > self.length:
+                        raise ValueError("data goes past the upload's length")
+                    f.write(chunk)
+                    self.offset += len(chunk)
+        finally:
+            self.save_info()
+        return self.offset
+
+    def storage(self):
+        """
+        This returns a `werkzeug.FileStorage` for the finished file, to pass
+        to `UploadSet.save`. Close it when you're done.
+        """
+        return FileStorage(open(self.data_path, 'rb'), self.filename,
+                           content_type=self.content_type or
+                           'application/octet-stream')
+
+    def discard(self):
+        """
+        This deletes the upload's data and record.
+        """
+        _unlink_quietly(self.data_path)
+        _unlink_quietly(self.info_path)
+
+
+uploads_mod = Blueprint('_uploads', __name__, url_prefix='/_uploads')
+
+
+@uploads_mod.route('/<setname>/<path:filename>')
+def uploaded_file(setname, filename):
+    config = current_app.upload_set_config.get(setname)
+    if config is None:
+        abort(404)
+    # Hidden folders hold blobs and unfinished uploads, and are never served.
+    if any(part.startswith('.') for part in filename.split('/')):
+        abort(404)
+    backend = config.backend
+    local = isinstance(backend, LocalStorage)
+    variant = request.args.get('variant')
+    if variant is not None:
+        if not local or variant not in config.variants:
+            abort(404)
+        # Files that aren't images are served as they are.
+        filename = make_variant(config, filename, variant) or filename
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if local:
+        path = safe_join(backend.root, filename)
+        if path is None:
+            abort(404)
+    encoding = None
+    compressible = (config.compress and local and
+                    extension(filename).lower() in COMPRESSIBLE)
+    if compressible and config.compress_only:
+        encoding = 'gzip'
+        if not request.accept_encodings['gzip']:
+            # The client can't take it gzipped, so it's unzipped on the fly.
+            info = _stat(config, filename)
+            if info is None:
+                abort(404)
+            response = send_file(gzip.open(path, 'rb'), mimetype=mimetype,
+                                 etag=info.etag and info.etag + '-identity'
+                                 or False,
+                                 last_modified=info.mtime, conditional=True)
+            response.vary.add('Accept-Encoding')
+            return response
+    elif compressible:
+        encoding = request.accept_encodings.best_match(config.compress)
+        if encoding is not None:
+            cname = compressed_name(filename, encoding)
+            info = _stat(config, filename)
+            cinfo = _stat(config, cname)
+            # A copy that doesn't have its original's modification time is
+            # out of date.
+            if info is not None and cinfo is not None and \
+                    cinfo.mtime == info.mtime:
+                filename = cname
+                path = backend.path(cname)
+            else:
+                encoding = None
+    if local and config.serve == 'xsendfile':
+        response = current_app.response_class(
+            mimetype=mimetype, headers={'X-Sendfile': path})
+    elif local and config.serve == 'xaccel':
+        response = current_app.response_class(
+            mimetype=mimetype, headers={'X-Accel-Redirect':
+                addslash(config.serve_prefix) + url_quote(filename)})
+    else:
+        info = _stat(config, filename)
+        if info is None:
+            abort(404)
+        try:
+            response = send_file(path if local else backend.open(filename),
+                                 mimetype=mimetype, etag=info.etag or False,
+                                 last_modified=info.mtime, conditional=True)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            # It was removed behind the stat cache's back.
+            if config.stat_cache is not None:
+                config.stat_cache.invalidate(filename)
+            abort(404)
+    if compressible:
+        response.vary.add('Accept-Encoding')
+        if encoding is not None:
+            response.content_encoding = encoding
+    if config.content_addressed:
+        # Their names come from their contents, so they never change.
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.no_cache = None
+        response.cache_control.immutable = True
+        response.expires = None
+    return response
+
+
+def _resumable_set(setname, upload_id=None):
+    config = current_app.upload_set_config.get(setname)
+    if config is None or not config.resumable:
+        abort(404)
+    uset = current_app.upload_sets[setname]
+    if (uset.resumable_authorizer is not None and
+            not uset.resumable_authorizer(uset, upload_id)):
+        abort(403)
+    return uset, config
+
+
+def _tus_response(response, status=204, **headers):
+    response = current_app.make_response((response, status))
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    response.headers['Cache-Control'] = 'no-store'
+    for key, value in headers.items():
+        response.headers[key.replace('_', '-')] = str(value)
+    return response
+
+
+def _parse_tus_metadata(header):
+    metadata = {}
+    for pair in header.split(','):
+        key, _, value = pair.strip().partition(' ')
+        if not key:
+            continue
+        try:
+            metadata[key] = base64.b64decode(value).decode('utf-8')
+        except (TypeError, ValueError):
+            abort(400)
+    return metadata
+
+
+def _load_upload(config, upload_id):
+    upload = ResumableUpload.load(resumable_folder(config), upload_id,
+                                  config.resumable_ttl)
+    if upload is None:
+        abort(404)
+    return upload
+
+
+@uploads_mod.route('/<setname>/.resumable', methods=['POST'])
+def create_resumable(setname):
+    uset, config = _resumable_set(setname)
+    try:
+        length = int(request.headers['Upload-Length'])
+    except (KeyError, ValueError):
+        abort(400)
+    if length < 0:
+        abort(400)
+    limits = [limit for limit in (current_app.config.get('MAX_CONTENT_LENGTH'),
+                                  config.max_size) if limit is not None]
+    if length > min(limits or [RESUMABLE_MAX_SIZE]):
+        abort(413)
+    metadata = _parse_tus_metadata(request.headers.get('Upload-Metadata', ''))
+    filename = metadata.get('filename')
+    if not filename:
+        abort(400)
+    if not uset.extension_allowed(extension(uset.get_basename(filename))):
+        abort(415)
+    folder = resumable_folder(config)
+    if config.resumable_ttl is not None:
+        ResumableUpload.sweep(folder, config.resumable_ttl)
+    upload = ResumableUpload.create(folder, filename, length,
+                                    metadata.get('filetype'))
+    location = url_for('_uploads.resumable_upload', setname=setname,
+                       upload_id=upload.id, _external=True)
+    return _tus_response('', 201, Location=location, Upload_Offset=0)
+
+
+@uploads_mod.route('/<setname>/.resumable/<upload_id>',
+                   methods=['HEAD', 'PATCH', 'DELETE'])
+def resumable_upload(setname, upload_id):
+    uset, config = _resumable_set(setname, upload_id)
+    upload = _load_upload(config, upload_id)
+    if request.method == 'DELETE':
+        upload.discard()
+        return _tus_response('')
+    if request.method == 'PATCH':
+        if request.mimetype != 'application/offset+octet-stream':
+            abort(415)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            abort(400)
+        if offset != upload.offset:
+            abort(409)
+        if (request.content_length is not None and
+                offset + request.content_length > upload.length):
+            abort(413)
+        try:
+            upload.write(request.stream, offset, config.buffer_size)
+        except ValueError:
+            abort(413)
+    return _tus_response('', 204 if request.method == 'PATCH' else 200,
+                         Upload_Offset=upload.offset,
+                         Upload_Length=upload.length)
+
+
+@uploads_mod.route('/<setname>/.resumable/<upload_id>/finalize',
+                   methods=['POST'])
+def finalize_resumable(setname, upload_id):
+    uset, config = _resumable_set(setname, upload_id)
+    upload = _load_upload(config, upload_id)
+    if not upload.complete:
+        abort(409)
+    storage = upload.storage()
+    try:
+        saved = uset.save(storage)
+    except UploadNotAllowed as e:
+        storage.close()
+        upload.discard()
+        abort(413 if isinstance(e, UploadTooLarge) else 415)
+    finally:
+        storage.close()
+    upload.discard()
+    response = jsonify(filename=saved, url=uset.url(saved))
+    return _tus_response(response, 201)
 
 
 class TestingFileStorage(FileStorage):
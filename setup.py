@@ -28,9 +28,17 @@ setup(
     py_modules=['flask_uploads'],
     zip_safe=False,
     platforms='any',
+    python_requires='>=3.6',
     install_requires=[
-        'Flask>=0.8.0'
+        'Flask>=2.0',
+        'Werkzeug>=2.0',
     ],
+    extras_require={
+        's3': ['boto3'],
+        'images': ['Pillow'],
+        'brotli': ['brotli'],
+        'zstd': ['zstandard'],
+    },
     tests_require='nose',
     test_suite='nose.collector',
     classifiers=[
@@ -40,6 +48,8 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Internet :: WWW/HTTP :: Dynamic Content',
         'Topic :: Software Development :: Libraries :: Python Modules'
     ]
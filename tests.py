@@ -12,11 +12,40 @@ will pass.
 :license:   MIT/X11, see LICENSE for details
 """
 from __future__ import with_statement
+import asyncio
+import base64
 import os.path
-from flask import Flask, url_for
+import errno
+import gzip
+import hashlib
+import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from flask import Flask, request, url_for
+from werkzeug.datastructures import FileStorage
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+import flask_uploads
 from flask_uploads import (UploadSet, UploadConfiguration, extension,
     lowercase_ext, TestingFileStorage, patch_request_class, configure_uploads,
-    addslash, ALL, AllExcept)
+    addslash, ALL, AllExcept, ExtensionPolicy, IMAGES, CountingResolver,
+    UploadNotAllowed, UploadTooLarge, SavedFile, content_name,
+    blob_path, LocalStorage, MemoryStorage, S3Storage, StreamedFile,
+    StatCache, LocalProcessingQueue, ProcessingQueueFull, SignatureTable,
+    DOCUMENTS, ARCHIVES, config_for_set)
 
 
 class TestMiscellaneous(object):
@@ -76,6 +105,24 @@ class TestConfiguration(object):
         configure_uploads(self.app, sets)
         return self.app.upload_set_config
 
+    def test_config_lookup(self):
+        f = UploadSet('files')
+        self.configure(f, UPLOADED_FILES_DEST='/var/files')
+        other = Flask(__name__)
+        other.config['UPLOADED_FILES_DEST'] = '/srv/files'
+        configure_uploads(other, f)
+        with self.app.app_context():
+            assert f.config.destination == '/var/files'
+            with other.app_context():
+                assert f.config.destination == '/srv/files'
+            assert f.config.destination == '/var/files'
+        try:
+            f.config
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("config found outside an app context")
+
     def test_manual(self):
         f, p = UploadSet('files'), UploadSet('photos')
         setconfig = self.configure(f, p,
@@ -176,6 +223,42 @@ class TestPreconditions(object):
         for ext, result in extpairs:
             assert uset.extension_allowed(ext) is result
 
+    def test_compiled_policy(self):
+        class Vowels(object):
+            def __contains__(self, ext):
+                return ext[:1] in 'aeiou'
+
+        allow, deny = ('exe', 'iso'), ('txt', 'py', 'iso')
+        exts = ('txt', 'jpg', 'exe', 'iso', 'py', 'so', 'zip', 'avi')
+        for extensions in (IMAGES + ('txt',), ['txt', 'so'], ALL,
+                           AllExcept(('so', 'py')), AllExcept('so py'),
+                           Vowels()):
+            policy = ExtensionPolicy(extensions, allow, deny)
+            for ext in exts:
+                expected = ext in allow or (ext in extensions and
+                                            ext not in deny)
+                assert (ext in policy) is expected
+                assert policy.allows(ext) is expected
+        policy = ExtensionPolicy(ALL, allow, deny)
+        assert policy.blocked == frozenset(['txt', 'py'])
+        assert policy.allowed is None
+        policy = ExtensionPolicy(['txt', 'so'], allow, deny)
+        assert policy.allowed == frozenset(['so', 'exe', 'iso'])
+
+    def test_policy_follows_extensions(self):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST='/uploads',
+                          UPLOADED_FILES_DENY=['jpg'])
+        uset = UploadSet('files')
+        configure_uploads(app, uset)
+        with app.app_context():
+            assert app.upload_set_config['files'].policy is not None
+            assert not uset.extension_allowed('jpg')
+            assert uset.extension_allowed('png')
+            uset.extensions = ('exe',)
+            assert uset.extension_allowed('exe')
+            assert not uset.extension_allowed('png')
+
 
 class TestSaving(object):
     def setup(self):
@@ -299,6 +382,1909 @@ class TestConflictResolution(object):
         assert res == 'foo_1'
 
 
+class TestCountingResolver(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def touch(self, *names):
+        for name in names:
+            open(os.path.join(self.dest, name), 'w').close()
+
+    def test_no_conflict(self):
+        uset = UploadSet('files', resolver=CountingResolver())
+        uset._config = Config(self.dest)
+        tfs = TestingFileStorage(filename='foo.txt')
+        assert uset.save(tfs) == 'foo.txt'
+        assert os.path.exists(os.path.join(self.dest, 'foo.txt'))
+
+    def test_seeded_from_scan(self):
+        self.touch('foo.txt', *('foo_%d.txt' % n for n in range(1, 6)))
+        uset = UploadSet('files', resolver=CountingResolver())
+        uset._config = Config(self.dest)
+        assert uset.save(TestingFileStorage(filename='foo.txt')) == 'foo_6.txt'
+        assert uset.save(TestingFileStorage(filename='foo.txt')) == 'foo_7.txt'
+        assert uset.save(TestingFileStorage(filename='bar.txt')) == 'bar.txt'
+
+    def test_claims_are_exclusive(self):
+        resolver = CountingResolver()
+        uset = UploadSet('files', resolver=resolver)
+        uset._config = Config(self.dest)
+        self.touch('foo.txt')
+        assert uset.save(TestingFileStorage(filename='foo.txt')) == 'foo_1.txt'
+        # another worker took the next name behind the resolver's back
+        self.touch('foo_2.txt')
+        assert uset.save(TestingFileStorage(filename='foo.txt')) == 'foo_3.txt'
+
+    def test_forget(self):
+        resolver = CountingResolver()
+        uset = UploadSet('files', resolver=resolver)
+        uset._config = Config(self.dest)
+        self.touch('foo.txt')
+        assert uset.save(TestingFileStorage(filename='foo.txt')) == 'foo_1.txt'
+        for name in os.listdir(self.dest):
+            os.remove(os.path.join(self.dest, name))
+        resolver.forget(self.dest)
+        self.touch('foo.txt')
+        assert uset.save(TestingFileStorage(filename='foo.txt')) == 'foo_1.txt'
+
+    def test_folders_bounded(self):
+        resolver = CountingResolver(max_folders=2)
+        uset = UploadSet('files', resolver=resolver)
+        uset._config = Config(self.dest)
+        for folder in ('a', 'b', 'c'):
+            os.mkdir(os.path.join(self.dest, folder))
+            self.touch(os.path.join(folder, 'foo.txt'))
+        for folder in ('a', 'b', 'a', 'c'):
+            uset.save(TestingFileStorage(filename='foo.txt'), folder)
+        assert list(resolver._folders) == [
+            os.path.join(self.dest, 'a'), os.path.join(self.dest, 'c')]
+        # a dropped folder is scanned again, so its names keep counting up
+        assert uset.save(TestingFileStorage(filename='foo.txt'),
+                         'b') == 'b/foo_2.txt'
+
+
+class TestAtomicSaving(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def storage(self, data, filename='foo.txt'):
+        return FileStorage(BytesIO(data), filename=filename)
+
+    def read(self, name):
+        with open(os.path.join(self.dest, name), 'rb') as f:
+            return f.read()
+
+    def test_atomic(self):
+        uset = UploadSet('files')
+        uset._config = Config(self.dest, atomic=True)
+        assert uset.save(self.storage(b'one')) == 'foo.txt'
+        assert uset.save(self.storage(b'two')) == 'foo_1.txt'
+        assert uset.save(self.storage(b'three')) == 'foo_2.txt'
+        assert self.read('foo.txt') == b'one'
+        assert self.read('foo_1.txt') == b'two'
+        assert self.read('foo_2.txt') == b'three'
+        assert sorted(os.listdir(self.dest)) == ['foo.txt', 'foo_1.txt',
+                                                 'foo_2.txt']
+
+    def test_concurrent_new_folders(self):
+        uset = UploadSet('files')
+        uset._config = Config(self.dest, atomic=True)
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def worker():
+            for n in range(30):
+                try:
+                    barrier.wait()
+                    uset.save(self.storage(b'data'), 'new%d/sub' % n)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert len(os.listdir(os.path.join(self.dest, 'new0', 'sub'))) == 8
+
+    def test_atomic_counting(self):
+        uset = UploadSet('files', resolver=CountingResolver())
+        uset._config = Config(self.dest, atomic=True)
+        open(os.path.join(self.dest, 'foo_4.txt'), 'w').close()
+        assert uset.save(self.storage(b'one')) == 'foo.txt'
+        assert uset.save(self.storage(b'two')) == 'foo_5.txt'
+        assert self.read('foo_5.txt') == b'two'
+
+    def test_atomic_without_links(self):
+        def link(src, dst):
+            raise OSError(errno.EPERM, 'Operation not permitted')
+        old_link, os.link = os.link, link
+        try:
+            uset = UploadSet('files')
+            uset._config = Config(self.dest, atomic=True)
+            assert uset.save(self.storage(b'one')) == 'foo.txt'
+            assert uset.save(self.storage(b'two')) == 'foo_1.txt'
+        finally:
+            os.link = old_link
+        assert self.read('foo.txt') == b'one'
+        assert self.read('foo_1.txt') == b'two'
+        assert len(os.listdir(self.dest)) == 2
+
+
+class TestStreamingSave(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.old_copyfileobj = shutil.copyfileobj
+        self.copies = []
+
+        def copyfileobj(src, dst, length=16384):
+            self.copies.append(length)
+            return self.old_copyfileobj(src, dst, length)
+        shutil.copyfileobj = copyfileobj
+
+    def teardown(self):
+        shutil.copyfileobj = self.old_copyfileobj
+        shutil.rmtree(self.dest)
+
+    def read(self, name):
+        with open(os.path.join(self.dest, name), 'rb') as f:
+            return f.read()
+
+    def test_buffer_size(self):
+        uset = UploadSet('files')
+        uset._config = Config(self.dest, buffer_size=4096)
+        tfs = FileStorage(BytesIO(b'x' * 10000), filename='foo.txt')
+        assert uset.save(tfs) == 'foo.txt'
+        assert self.read('foo.txt') == b'x' * 10000
+        assert self.copies == [4096]
+
+    def test_spooled_file_copied_in_kernel(self):
+        spool = tempfile.SpooledTemporaryFile(max_size=10)
+        spool.write(b'y' * 100000)
+        spool.seek(0)
+        uset = UploadSet('files')
+        uset._config = Config(self.dest)
+        assert uset.save(FileStorage(spool, filename='foo.txt')) == 'foo.txt'
+        assert self.read('foo.txt') == b'y' * 100000
+        assert self.copies == []
+
+    def test_short_kernel_copy(self):
+        # The kernel may stop copying early; the rest must not be lost.
+        def copy_file_range(src, dst, count, offset_src=None):
+            if calls:
+                return 0
+            calls.append(count)
+            return os.write(dst, os.pread(src, 1000, offset_src))
+        calls = []
+        old = getattr(os, 'copy_file_range', None)
+        os.copy_file_range = copy_file_range
+        try:
+            spool = tempfile.SpooledTemporaryFile(max_size=10)
+            spool.write(b'v' * 100000)
+            spool.seek(0)
+            uset = UploadSet('files')
+            uset._config = Config(self.dest)
+            saved = uset.save(FileStorage(spool, filename='foo.txt'))
+        finally:
+            if old is None:
+                del os.copy_file_range
+            else:
+                os.copy_file_range = old
+        assert calls == [100000]
+        assert self.read('foo.txt') == b'v' * 100000
+        assert saved.size == 100000
+
+    def test_unrolled_spool_stays_in_memory(self):
+        spool = tempfile.SpooledTemporaryFile(max_size=1000)
+        spool.write(b'z' * 100)
+        spool.seek(0)
+        uset = UploadSet('files')
+        uset._config = Config(self.dest, atomic=True)
+        assert uset.save(FileStorage(spool, filename='foo.txt')) == 'foo.txt'
+        assert self.read('foo.txt') == b'z' * 100
+        assert not spool._rolled
+
+    def test_fsync_policy(self):
+        synced = []
+        old_fsync = os.fsync
+        os.fsync = lambda fd: synced.append(fd)
+        try:
+            uset = UploadSet('files')
+            uset._config = Config(self.dest, fsync='file')
+            uset.save(FileStorage(BytesIO(b'a'), filename='foo.txt'))
+            assert len(synced) == 1
+            uset._config = Config(self.dest, fsync='file+dir', atomic=True)
+            uset.save(FileStorage(BytesIO(b'a'), filename='foo.txt'))
+            assert len(synced) == 3
+        finally:
+            os.fsync = old_fsync
+
+    def test_fsync_configuration(self):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST=self.dest,
+                          UPLOADED_FILES_FSYNC='always')
+        try:
+            configure_uploads(app, UploadSet('files'))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("invalid FSYNC was accepted")
+
+
+class TestHashing(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def storage(self, data, filename='foo.txt'):
+        return FileStorage(BytesIO(data), filename=filename)
+
+    def test_saved_file(self):
+        saved = SavedFile('foo.txt', 'abc', 3)
+        assert saved == 'foo.txt'
+        assert saved.within('bar') == 'bar/foo.txt'
+        assert saved.within('bar').digest == 'abc'
+        assert saved.within('') is saved
+
+    def test_content_name(self):
+        assert content_name('abcdef', 'jpg') == 'ab/cd/abcdef.jpg'
+        assert content_name('abcdef', '') == 'ab/cd/abcdef'
+
+    def test_digest(self):
+        uset = UploadSet('files')
+        for atomic in (False, True):
+            uset._config = Config(self.dest, hash='sha256', atomic=atomic)
+            saved = uset.save(self.storage(b'hello'), folder='sub')
+            assert saved.digest == hashlib.sha256(b'hello').hexdigest()
+            assert saved.size == 5
+            assert saved.created
+
+    def test_blake2b(self):
+        uset = UploadSet('files')
+        uset._config = Config(self.dest, hash='blake2b')
+        saved = uset.save(self.storage(b'hello'))
+        assert saved.digest == hashlib.blake2b(b'hello').hexdigest()
+
+    def test_no_hash(self):
+        uset = UploadSet('files')
+        uset._config = Config(self.dest)
+        saved = uset.save(self.storage(b'hello'))
+        assert saved == 'foo.txt'
+        assert saved.digest is None
+
+    def test_content_addressed(self):
+        uset = UploadSet('files')
+        uset._config = Config(self.dest, content_addressed=True)
+        digest = hashlib.sha256(b'hello').hexdigest()
+        first = uset.save(self.storage(b'hello'))
+        assert first == content_name(digest, 'txt')
+        assert first.created
+        second = uset.save(self.storage(b'hello', 'bar.txt'))
+        assert second == first
+        assert not second.created
+        with open(uset.path(first), 'rb') as f:
+            assert f.read() == b'hello'
+        assert os.listdir(self.dest) == [digest[:2]]
+
+    def test_content_addressed_unseekable(self):
+        class Unseekable(BytesIO):
+            def seekable(self):
+                return False
+        uset = UploadSet('files')
+        uset._config = Config(self.dest, content_addressed=True)
+        first = uset.save(FileStorage(Unseekable(b'hi'), filename='a.txt'))
+        second = uset.save(FileStorage(Unseekable(b'hi'), filename='b.txt'))
+        assert first == second
+        assert first.created and not second.created
+        assert os.listdir(self.dest) == [first.digest[:2]]
+
+    def test_hash_configuration(self):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST=self.dest,
+                          UPLOADED_FILES_CONTENT_ADDRESSED=True)
+        configure_uploads(app, UploadSet('files'))
+        assert app.upload_set_config['files'].hash == 'sha256'
+
+
+class TestDeduplication(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.uset = UploadSet('files')
+        self.uset._config = Config(self.dest, deduplicate=True)
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def storage(self, data, filename='foo.txt'):
+        return FileStorage(BytesIO(data), filename=filename)
+
+    def blob(self, data):
+        return blob_path(self.dest, hashlib.sha256(data).hexdigest())
+
+    def test_shared_contents(self):
+        first = self.uset.save(self.storage(b'avatar'))
+        second = self.uset.save(self.storage(b'avatar'))
+        third = self.uset.save(self.storage(b'avatar', 'bar.txt'), 'sub')
+        assert (first, second, third) == ('foo.txt', 'foo_1.txt',
+                                          'sub/bar.txt')
+        assert first.created and not second.created and not third.created
+        blob = os.stat(self.blob(b'avatar'))
+        assert blob.st_nlink == 4
+        assert os.path.samestat(os.stat(self.uset.path(third)), blob)
+        with open(self.uset.path(second), 'rb') as f:
+            assert f.read() == b'avatar'
+
+    def test_read_only(self):
+        if os.name == 'nt':
+            return
+        first = self.uset.save(self.storage(b'avatar'))
+        second = self.uset.save(self.storage(b'avatar'))
+        for path in (self.blob(b'avatar'), self.uset.path(first),
+                     self.uset.path(second)):
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o444
+        assert self.uset.delete(first) and self.uset.delete(second)
+        assert not os.path.exists(self.blob(b'avatar'))
+
+    def test_distinct_contents(self):
+        self.uset.save(self.storage(b'one'))
+        self.uset.save(self.storage(b'two'))
+        assert os.path.exists(self.blob(b'one'))
+        assert os.path.exists(self.blob(b'two'))
+
+    def test_delete(self):
+        first = self.uset.save(self.storage(b'avatar'))
+        second = self.uset.save(self.storage(b'avatar'))
+        assert self.uset.delete(first)
+        assert os.path.exists(self.blob(b'avatar'))
+        assert not self.uset.delete(first)
+        assert self.uset.delete(second)
+        assert not os.path.exists(self.blob(b'avatar'))
+
+    def test_names_outside_set(self):
+        root = os.path.join(self.dest, 'set')
+        secret = os.path.join(self.dest, 'secret.txt')
+        open(secret, 'w').close()
+        for config in (Config(root), Config(root, deduplicate=True)):
+            uset = UploadSet('files')
+            uset._config = config
+            for call in (lambda: uset.delete('../secret.txt'),
+                         lambda: uset.delete('secret.txt', '..'),
+                         lambda: uset.open('../secret.txt'),
+                         lambda: uset.stat('../secret.txt'),
+                         lambda: uset.exists(secret),
+                         lambda: uset.path('../secret.txt')):
+                try:
+                    call()
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError("reached a file outside the set")
+        assert os.path.exists(secret)
+
+    def test_prune_blobs(self):
+        saved = self.uset.save(self.storage(b'avatar'))
+        os.remove(self.uset.path(saved))
+        assert self.uset.prune_blobs() == 1
+        assert not os.path.exists(self.blob(b'avatar'))
+
+
+class TestBackends(object):
+    def setup(self):
+        self.app = Flask(__name__)
+
+    def storage(self, data, filename='foo.txt'):
+        return FileStorage(BytesIO(data), filename=filename)
+
+    def test_default_backend(self):
+        self.app.config.update(UPLOADED_FILES_DEST='/var/files')
+        configure_uploads(self.app, UploadSet('files'))
+        backend = self.app.upload_set_config['files'].backend
+        assert backend == LocalStorage('/var/files')
+
+    def test_local(self):
+        dest = tempfile.mkdtemp()
+        try:
+            backend = LocalStorage(dest)
+            uset = UploadSet('files')
+            uset._config = Config(dest, backend=backend)
+            saved = uset.save(self.storage(b'hello'), folder='sub')
+            assert saved == 'sub/foo.txt'
+            assert uset.exists('foo.txt', folder='sub')
+            with uset.open(saved) as f:
+                assert f.read() == b'hello'
+            assert backend.stat(saved).size == 5
+            assert backend.url(saved) is None
+            assert uset.delete(saved)
+            assert not uset.exists(saved)
+            assert backend.stat(saved) is None
+        finally:
+            shutil.rmtree(dest)
+
+    def test_memory(self):
+        self.app.config.update(UPLOADED_FILES_BACKEND='memory',
+                               UPLOADED_FILES_HASH='sha256')
+        uset = UploadSet('files')
+        configure_uploads(self.app, uset)
+        with self.app.test_request_context():
+            first = uset.save(self.storage(b'hello'))
+            second = uset.save(self.storage(b'world'))
+            assert (first, second) == ('foo.txt', 'foo_1.txt')
+            assert first.digest == hashlib.sha256(b'hello').hexdigest()
+            assert uset.open(second).read() == b'world'
+            url = uset.url(second)
+        rv = self.app.test_client().get(url)
+        assert rv.status_code == 200
+        assert rv.data == b'world'
+        assert rv.mimetype == 'text/plain'
+        assert self.app.test_client().get(url + 'x').status_code == 404
+        with self.app.test_request_context():
+            assert uset.delete(first)
+            assert not uset.delete(first)
+            try:
+                uset.open(first)
+            except IOError as e:
+                assert e.errno == errno.ENOENT
+            else:
+                raise AssertionError("deleted file could be opened")
+
+    def test_unknown_backend(self):
+        self.app.config.update(UPLOADED_FILES_BACKEND='ftp')
+        try:
+            configure_uploads(self.app, UploadSet('files'))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("unknown backend was accepted")
+
+    def test_s3(self):
+        if mock_aws is None:
+            return
+        with mock_aws():
+            client = boto3.client('s3', region_name='us-east-1')
+            client.create_bucket(Bucket='uploads')
+            self.app.config.update(
+                UPLOADED_FILES_BACKEND='s3',
+                UPLOADED_FILES_S3_BUCKET='uploads',
+                UPLOADED_FILES_S3_PREFIX='files/',
+                UPLOADED_FILES_S3_OPTIONS={'region_name': 'us-east-1'},
+                UPLOADED_FILES_HASH='sha256',
+            )
+            uset = UploadSet('files')
+            configure_uploads(self.app, uset)
+            with self.app.test_request_context():
+                first = uset.save(self.storage(b'hello'), folder='a')
+                second = uset.save(self.storage(b'world'), folder='a')
+                assert (first, second) == ('a/foo.txt', 'a/foo_1.txt')
+                assert first.size == 5
+                assert first.digest == hashlib.sha256(b'hello').hexdigest()
+                body = client.get_object(Bucket='uploads',
+                                         Key='files/a/foo.txt')['Body']
+                assert body.read() == b'hello'
+                assert uset.exists(second)
+                assert uset.open(second).read() == b'world'
+                backend = self.app.upload_set_config['files'].backend
+                assert backend.stat(second).size == 5
+                url = uset.url(second)
+            rv = self.app.test_client().get(url)
+            assert rv.data == b'world'
+            with self.app.test_request_context():
+                assert uset.delete(first)
+                assert not uset.exists(first)
+                assert not uset.delete(first)
+
+    def test_s3_urls(self):
+        if mock_aws is None:
+            return
+        with mock_aws():
+            client = boto3.client('s3', region_name='us-east-1')
+            public = S3Storage('uploads', 'files/', client=client,
+                               base_url='https://cdn.example.com/')
+            assert (public.url('a b.txt') ==
+                    'https://cdn.example.com/files/a%20b.txt')
+            private = S3Storage('uploads', client=client, url_expires=60)
+            assert 'Signature' in private.url('foo.txt')
+
+
+class TestMultipartUpload(object):
+    part_size = 5 * 1024 * 1024
+
+    def setup(self):
+        if mock_aws is None:
+            return
+        self.mock = mock_aws()
+        self.mock.start()
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket='uploads')
+
+    def teardown(self):
+        if mock_aws is not None:
+            self.mock.stop()
+
+    def save(self, backend, data):
+        uset = UploadSet('files')
+        uset._config = Config(None, hash='md5', backend=backend)
+        return uset.save(FileStorage(BytesIO(data), filename='big.txt'))
+
+    def test_multipart(self):
+        if mock_aws is None:
+            return
+        backend = S3Storage('uploads', client=self.client,
+                            part_size=self.part_size, concurrency=2)
+        data = os.urandom(1024) * (11 * 1024)
+        saved = self.save(backend, data)
+        assert saved.size == len(data)
+        assert saved.digest == hashlib.md5(data).hexdigest()
+        head = self.client.head_object(Bucket='uploads', Key='big.txt')
+        assert head['ETag'].strip('"').endswith('-3')
+        assert backend.open(saved).read() == data
+
+    def test_small_file_single_request(self):
+        if mock_aws is None:
+            return
+        backend = S3Storage('uploads', client=self.client,
+                            part_size=self.part_size)
+        self.save(backend, b'small')
+        head = self.client.head_object(Bucket='uploads', Key='big.txt')
+        assert '-' not in head['ETag']
+
+    def test_failed_part_aborts(self):
+        if mock_aws is None:
+            return
+        client = self.client
+
+        class FailingClient(object):
+            def __getattr__(self, name):
+                return getattr(client, name)
+
+            def upload_part(self, **kwargs):
+                if kwargs['PartNumber'] == 2:
+                    raise IOError('connection reset')
+                return client.upload_part(**kwargs)
+
+        backend = S3Storage('uploads', client=FailingClient(),
+                            part_size=self.part_size, concurrency=2)
+        try:
+            self.save(backend, b'x' * (self.part_size * 3))
+        except IOError:
+            pass
+        else:
+            raise AssertionError("failed part was ignored")
+        uploads = client.list_multipart_uploads(Bucket='uploads')
+        assert not uploads.get('Uploads')
+        assert not backend.exists('big.txt')
+
+
+class TestResumableUploads(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_RESUMABLE=True,
+                               UPLOADED_DOCS_DEST=self.dest)
+        self.uset = UploadSet('files')
+        configure_uploads(self.app, (self.uset, UploadSet('docs')))
+        self.client = self.app.test_client()
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def create(self, filename, length, setname='files'):
+        metadata = 'filename ' + base64.b64encode(
+            filename.encode('utf-8')).decode('ascii')
+        return self.client.post('/_uploads/%s/.resumable' % setname,
+                                headers={'Upload-Length': str(length),
+                                         'Upload-Metadata': metadata,
+                                         'Tus-Resumable': '1.0.0'})
+
+    def patch(self, location, offset, data):
+        return self.client.patch(location, data=data, headers={
+            'Upload-Offset': str(offset),
+            'Content-Type': 'application/offset+octet-stream'})
+
+    def test_resumable(self):
+        rv = self.create('report.txt', 11)
+        assert rv.status_code == 201
+        assert rv.headers['Upload-Offset'] == '0'
+        location = rv.headers['Location']
+        assert self.patch(location, 0, b'hello ').status_code == 204
+        assert self.client.head(location).headers['Upload-Offset'] == '6'
+        assert self.patch(location, 0, b'again').status_code == 409
+        assert self.client.post(location + '/finalize').status_code == 409
+        rv = self.patch(location, 6, b'world')
+        assert rv.headers['Upload-Offset'] == '11'
+        rv = self.client.post(location + '/finalize')
+        assert rv.status_code == 201
+        assert rv.get_json()['filename'] == 'report.txt'
+        with open(os.path.join(self.dest, 'report.txt'), 'rb') as f:
+            assert f.read() == b'hello world'
+        assert self.client.head(location).status_code == 404
+        assert os.listdir(os.path.join(self.dest, '.resumable')) == []
+
+    def test_too_long(self):
+        location = self.create('report.txt', 3).headers['Location']
+        assert self.patch(location, 0, b'hello').status_code == 413
+
+    def test_delete(self):
+        location = self.create('report.txt', 3).headers['Location']
+        assert self.client.delete(location).status_code == 204
+        assert self.client.head(location).status_code == 404
+
+    def test_rejected(self):
+        assert self.create('warez.exe', 3).status_code == 415
+        assert self.create('report.txt', 3, 'docs').status_code == 404
+        assert self.create('report.txt', 3, 'nothing').status_code == 404
+
+    def test_max_size(self):
+        self.app.config['UPLOADED_FILES_MAX_SIZE'] = 100
+        configure_uploads(self.app, self.uset)
+        assert self.create('report.txt', 1000000000).status_code == 413
+        assert not os.path.exists(os.path.join(self.dest, '.resumable'))
+        self.app.config['UPLOADED_FILES_MAX_SIZE'] = None
+        configure_uploads(self.app, self.uset)
+        location = self.create('report.txt', 11).headers['Location']
+        self.patch(location, 0, b'hello world')
+        self.app.config['UPLOADED_FILES_MAX_SIZE'] = 5
+        configure_uploads(self.app, self.uset)
+        assert self.client.post(location + '/finalize').status_code == 413
+
+    def test_default_max_size(self):
+        rv = self.create('report.txt', flask_uploads.RESUMABLE_MAX_SIZE + 1)
+        assert rv.status_code == 413
+        assert not os.path.exists(os.path.join(self.dest, '.resumable'))
+
+    def test_authorization(self):
+        seen = []
+
+        @self.uset.authorize_resumable
+        def check(uset, upload_id):
+            seen.append(upload_id)
+            return request.headers.get('Authorization') == 'yes'
+
+        assert self.create('report.txt', 3).status_code == 403
+        assert not os.path.exists(os.path.join(self.dest, '.resumable'))
+        self.client.environ_base['HTTP_AUTHORIZATION'] = 'yes'
+        location = self.create('report.txt', 3).headers['Location']
+        upload_id = location.rsplit('/', 1)[1]
+        del self.client.environ_base['HTTP_AUTHORIZATION']
+        assert self.client.head(location).status_code == 403
+        assert self.patch(location, 0, b'abc').status_code == 403
+        assert self.client.delete(location).status_code == 403
+        assert seen == [None, None, upload_id, upload_id, upload_id]
+
+    def test_expiry(self):
+        folder = os.path.join(self.dest, '.resumable')
+        old = self.create('old.txt', 3).headers['Location']
+        stale = time.time() - 2 * 24 * 60 * 60
+        for name in os.listdir(folder):
+            os.utime(os.path.join(folder, name), (stale, stale))
+        orphan = os.path.join(folder, 'f' * 32)
+        open(orphan, 'wb').close()
+        os.utime(orphan, (stale, stale))
+        fresh = self.create('new.txt', 3).headers['Location']
+        assert self.client.head(old).status_code == 404
+        assert self.client.head(fresh).status_code == 200
+        assert len(os.listdir(folder)) == 2
+        new_id = fresh.rsplit('/', 1)[1]
+        os.utime(os.path.join(folder, new_id + '.json'), (stale, stale))
+        assert self.client.head(fresh).status_code == 404
+        assert os.listdir(folder) == []
+
+    def test_hidden_files_not_served(self):
+        location = self.create('report.txt', 3).headers['Location']
+        upload_id = location.rsplit('/', 1)[1]
+        rv = self.client.get('/_uploads/files/.resumable/%s.json' % upload_id)
+        assert rv.status_code == 404
+
+
+class TestAsync(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_ATOMIC=True,
+                               UPLOADS_ASYNC_WORKERS=2)
+        self.uset = UploadSet('files')
+        configure_uploads(self.app, self.uset)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def teardown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        shutil.rmtree(self.dest)
+
+    def run(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def test_save_async(self):
+        with self.app.app_context():
+            pending = [self.uset.save_async(
+                FileStorage(BytesIO(b'data'), filename='foo.txt'))
+                for n in range(5)]
+            saved = self.run(asyncio.gather(*pending))
+            assert sorted(saved)[0] == 'foo.txt'
+            assert len(set(saved)) == 5
+            assert self.run(self.uset.exists_async(saved[0]))
+            assert self.run(self.uset.delete_async(saved[0]))
+            assert not self.run(self.uset.exists_async(saved[0]))
+        assert self.app.upload_executor._max_workers == 2
+
+    def test_request_budget(self):
+        self.app.config['UPLOADED_FILES_MAX_REQUEST_SIZE'] = 10
+        configure_uploads(self.app, self.uset)
+        with self.app.test_request_context():
+            self.run(self.uset.save_async(
+                FileStorage(BytesIO(b'12345678'), filename='b.txt')))
+            try:
+                self.run(self.uset.save_async(
+                    FileStorage(BytesIO(b'12345678'), filename='c.txt')))
+            except UploadTooLarge:
+                pass
+            else:
+                raise AssertionError("async save ignored the request budget")
+        assert os.listdir(self.dest) == ['b.txt']
+
+    def test_not_allowed(self):
+        with self.app.app_context():
+            pending = self.uset.save_async(
+                FileStorage(BytesIO(b'data'), filename='warez.exe'))
+            try:
+                self.run(pending)
+            except UploadNotAllowed:
+                pass
+            else:
+                raise AssertionError("disallowed upload was saved")
+
+
+class TestSaveMany(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def storages(self, *names):
+        return [FileStorage(BytesIO(name.encode('utf-8')), filename=name)
+                for name in names]
+
+    def read(self, name):
+        with open(os.path.join(self.dest, name), 'rb') as f:
+            return f.read()
+
+    def test_batch(self):
+        uset = UploadSet('files')
+        uset._config = Config(self.dest, hash='sha256')
+        open(os.path.join(self.dest, 'a.txt'), 'w').close()
+        storages = self.storages('a.txt', 'b.txt', 'warez.exe', 'a.txt')
+        results = uset.save_many(storages + ['nope'])
+        assert results[:2] == ['a_1.txt', 'b.txt']
+        assert isinstance(results[2], UploadNotAllowed)
+        assert results[3] == 'a_2.txt'
+        assert isinstance(results[4], TypeError)
+        assert self.read('a_1.txt') == b'a.txt'
+        assert self.read('b.txt') == b'b.txt'
+        assert results[1].digest == hashlib.sha256(b'b.txt').hexdigest()
+
+    def test_batch_folder(self):
+        uset = UploadSet('files')
+        uset._config = Config(self.dest)
+        results = uset.save_many(self.storages(*['p.jpg'] * 20), 'gallery')
+        assert sorted(results) == sorted(
+            ['gallery/p.jpg'] + ['gallery/p_%d.jpg' % n for n in range(1, 20)])
+        assert len(os.listdir(os.path.join(self.dest, 'gallery'))) == 20
+
+    def test_other_modes(self):
+        for config in (Config(self.dest, atomic=True),
+                       Config(None, backend=MemoryStorage())):
+            uset = UploadSet('files')
+            uset._config = config
+            results = uset.save_many(self.storages('x.txt', 'x.txt', 'y.txt',
+                                                   'z.exe'))
+            assert results[:3] == ['x.txt', 'x_1.txt', 'y.txt']
+            assert isinstance(results[3], UploadNotAllowed)
+            assert uset.open('x_1.txt').read() == b'x.txt'
+
+    def test_counting_resolver(self):
+        uset = UploadSet('files', resolver=CountingResolver())
+        uset._config = Config(self.dest)
+        results = uset.save_many(self.storages('x.txt', 'x.txt'))
+        assert results == ['x.txt', 'x_1.txt']
+
+    def test_unclaimable_folder(self):
+        uset = UploadSet('files')
+        uset._config = Config(self.dest, shard=lambda storage, name: name[0])
+        open(os.path.join(self.dest, 'b'), 'w').close()
+        results = uset.save_many(self.storages('a.txt', 'b.txt', 'c.txt'))
+        assert results[0] == 'a/a.txt'
+        assert isinstance(results[1], OSError)
+        assert results[2] == 'c/c.txt'
+        assert self.read('c/c.txt') == b'c.txt'
+
+    def test_claims_released(self):
+        class Broken(ThreadPoolExecutor):
+            def submit(self, func, *args):
+                if func.__name__ == '_write_claimed' and args[2] == 1:
+                    raise RuntimeError("can't start new thread")
+                return ThreadPoolExecutor.submit(self, func, *args)
+
+        uset = UploadSet('files')
+        uset._config = Config(self.dest)
+        flask_uploads.ThreadPoolExecutor = Broken
+        try:
+            try:
+                uset.save_many(self.storages('a.txt', 'b.txt', 'c.txt'))
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError("didn't raise")
+        finally:
+            flask_uploads.ThreadPoolExecutor = ThreadPoolExecutor
+        assert os.listdir(self.dest) == ['a.txt']
+
+
+class TestStreamedUploads(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest)
+        self.uset = UploadSet('files')
+        configure_uploads(self.app, (self.uset,))
+        self.streams = []
+
+        @self.app.route('/upload/<mode>', methods=['POST'])
+        def upload(mode):
+            from flask import request
+            self.uset.stream_request('inbox')
+            storage = request.files['file']
+            self.streams.append(storage.stream)
+            if mode == 'ignore':
+                return 'ignored'
+            try:
+                return self.uset.save(storage, 'inbox')
+            except UploadNotAllowed:
+                return 'refused', 400
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def post(self, mode, filename, data):
+        return self.app.test_client().post('/upload/' + mode, data={
+            'file': (BytesIO(data), filename)})
+
+    def listing(self):
+        return sorted(os.listdir(os.path.join(self.dest, 'inbox')))
+
+    def test_streamed(self):
+        rv = self.post('save', 'notes.txt', b'streamed once')
+        assert rv.data == b'inbox/notes.txt'
+        assert isinstance(self.streams[0], StreamedFile)
+        assert self.listing() == ['notes.txt']
+        with open(os.path.join(self.dest, 'inbox', 'notes.txt'), 'rb') as f:
+            assert f.read() == b'streamed once'
+        assert self.post('save', 'notes.txt', b'again').data == \
+            b'inbox/notes_1.txt'
+
+    def test_atomic_hashed(self):
+        self.app.config.update(UPLOADED_FILES_ATOMIC=True,
+                               UPLOADED_FILES_HASH='sha256')
+        configure_uploads(self.app, (self.uset,))
+        open(os.path.join(self.dest, 'taken.txt'), 'w').close()
+        os.mkdir(os.path.join(self.dest, 'inbox'))
+        open(os.path.join(self.dest, 'inbox', 'a.txt'), 'w').close()
+        assert self.post('save', 'a.txt', b'data').data == b'inbox/a_1.txt'
+        assert self.listing() == ['a.txt', 'a_1.txt']
+
+    def test_unsaved_is_removed(self):
+        assert self.post('ignore', 'notes.txt', b'unwanted').data == \
+            b'ignored'
+        assert self.listing() == []
+
+    def test_disallowed_discarded(self):
+        rv = self.post('save', 'virus.exe', b'MZ' * 1000)
+        assert rv.status_code == 400
+        assert not isinstance(self.streams[0], StreamedFile)
+        assert not os.path.exists(os.path.join(self.dest, 'inbox'))
+
+
+class TestEarlyRejection(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_PHOTOS_DEST=self.dest,
+                               UPLOADED_PHOTOS_MAX_SIZE=1000,
+                               UPLOADED_PHOTOS_CONTENT_TYPES=['image/*'])
+        self.uset = UploadSet('photos', IMAGES)
+        configure_uploads(self.app, (self.uset,))
+
+        @self.app.before_request
+        def guard():
+            from flask import request
+            if request.endpoint == 'upload':
+                self.uset.stream_request(strict=True)
+
+        @self.app.route('/upload', methods=['POST'])
+        def upload():
+            from flask import request
+            return self.uset.save(request.files['file'])
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def post(self, filename, data, content_type='image/png'):
+        return self.app.test_client().post('/upload', data={
+            'file': (BytesIO(data), filename, content_type)})
+
+    def test_allowed(self):
+        rv = self.post('cat.png', b'x' * 1000)
+        assert rv.status_code == 200
+        assert rv.data == b'cat.png'
+
+    def test_rejected(self):
+        assert self.post('setup.exe', b'MZ').status_code == 415
+        assert self.post('cat.png', b'x', 'application/x-msdownload'
+                         ).status_code == 415
+        assert self.post('cat.png', b'x' * 1001).status_code == 413
+        assert os.listdir(self.dest) == []
+
+    def test_content_type_allowed(self):
+        with self.app.app_context():
+            assert self.uset.content_type_allowed('image/png')
+            assert self.uset.content_type_allowed('IMAGE/JPEG; q=1')
+            assert not self.uset.content_type_allowed('text/plain')
+            assert not self.uset.content_type_allowed(None)
+
+
+class Unseekable(object):
+    def __init__(self, data):
+        self.stream = BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+class TestSizeLimits(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_MAX_SIZE=10,
+                               UPLOADED_FILES_MAX_REQUEST_SIZE=15)
+        self.uset = UploadSet('files')
+        configure_uploads(self.app, (self.uset,))
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def storage(self, data, filename='a.txt'):
+        return FileStorage(data, filename=filename)
+
+    def test_per_file(self):
+        with self.app.app_context():
+            assert self.uset.save(self.storage(BytesIO(b'x' * 10))) == 'a.txt'
+            for stream in (BytesIO(b'x' * 11), Unseekable(b'x' * 11)):
+                try:
+                    self.uset.save(self.storage(stream, 'b.txt'))
+                except UploadTooLarge:
+                    pass
+                else:
+                    raise AssertionError("saved an oversized file")
+            assert os.listdir(self.dest) == ['a.txt']
+
+    def test_per_request(self):
+        with self.app.test_request_context():
+            self.uset.save(self.storage(BytesIO(b'x' * 8)))
+            try:
+                self.uset.save(self.storage(Unseekable(b'x' * 8)))
+            except UploadTooLarge:
+                pass
+            else:
+                raise AssertionError("went over the request limit")
+            results = self.uset.save_many([self.storage(BytesIO(b'xx')),
+                                           self.storage(BytesIO(b'x' * 9))])
+            assert results[0] == 'a_1.txt'
+            assert isinstance(results[1], UploadTooLarge)
+        with self.app.test_request_context():
+            assert self.uset.save(self.storage(BytesIO(b'x' * 8))) == \
+                'a_2.txt'
+        assert sorted(os.listdir(self.dest)) == ['a.txt', 'a_1.txt',
+                                                 'a_2.txt']
+
+
+class TestServing(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        with open(os.path.join(self.dest, 'cat.txt'), 'wb') as f:
+            f.write(b'0123456789')
+        os.mkdir(os.path.join(self.dest, 'sub'))
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def client(self, **options):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST=self.dest, **options)
+        self.uset = UploadSet('files')
+        configure_uploads(app, self.uset)
+        return app.test_client()
+
+    def test_python(self):
+        client = self.client()
+        rv = client.get('/_uploads/files/cat.txt')
+        assert rv.data == b'0123456789'
+        etag, weak = rv.get_etag()
+        assert etag and not weak
+        assert rv.last_modified is not None
+        last_modified = rv.headers['Last-Modified']
+        rv = client.get('/_uploads/files/cat.txt',
+                        headers={'If-None-Match': '"%s"' % etag})
+        assert rv.status_code == 304
+        rv = client.get('/_uploads/files/cat.txt', headers={
+            'If-Modified-Since': last_modified})
+        assert rv.status_code == 304
+        rv = client.get('/_uploads/files/cat.txt',
+                        headers={'Range': 'bytes=2-4'})
+        assert rv.status_code == 206
+        assert rv.data == b'234'
+        for name in ('sub', 'missing.txt', '../etc/passwd', '.blobs/x'):
+            assert client.get('/_uploads/files/' + name).status_code == 404
+
+    def test_etag_changes(self):
+        client = self.client()
+        etag = client.get('/_uploads/files/cat.txt').get_etag()[0]
+        path = os.path.join(self.dest, 'cat.txt')
+        with open(path + '.new', 'wb') as f:
+            f.write(b'9876543210')
+        os.rename(path + '.new', path)
+        rv = client.get('/_uploads/files/cat.txt',
+                        headers={'If-None-Match': '"%s"' % etag})
+        assert rv.status_code == 200
+        assert rv.data == b'9876543210'
+
+    def test_xsendfile(self):
+        rv = self.client(UPLOADED_FILES_SERVE='xsendfile').get(
+            '/_uploads/files/cat.txt')
+        assert rv.headers['X-Sendfile'] == os.path.join(self.dest, 'cat.txt')
+        assert rv.mimetype == 'text/plain'
+        assert rv.data == b''
+
+    def test_xaccel(self):
+        rv = self.client(UPLOADED_FILES_SERVE='xaccel',
+                         UPLOADED_FILES_SERVE_PREFIX='/internal/files').get(
+            '/_uploads/files/sub/a%20b.txt')
+        assert (rv.headers['X-Accel-Redirect'] ==
+                '/internal/files/sub/a%20b.txt')
+        try:
+            self.client(UPLOADED_FILES_SERVE='xaccel')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("xaccel accepted without a prefix")
+
+    def test_content_addressed_immutable(self):
+        client = self.client(UPLOADED_FILES_CONTENT_ADDRESSED=True)
+        with client.application.app_context():
+            name = self.uset.save(FileStorage(BytesIO(b'data'),
+                                              filename='a.txt'))
+        rv = client.get('/_uploads/files/' + name)
+        assert rv.data == b'data'
+        assert rv.cache_control.immutable
+        assert rv.cache_control.max_age == 365 * 24 * 60 * 60
+        assert not rv.cache_control.no_cache
+        rv = self.client().get('/_uploads/files/cat.txt')
+        assert 'immutable' not in rv.headers['Cache-Control']
+
+    def test_backend_conditional(self):
+        backend = MemoryStorage()
+        client = self.client(UPLOADED_FILES_BACKEND=backend)
+        with client.application.app_context():
+            self.uset.save(FileStorage(BytesIO(b'hello'), filename='a.txt'))
+        mtime = backend.stat('a.txt').mtime
+        rv = client.get('/_uploads/files/a.txt', headers={'If-Modified-Since':
+            time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+                          time.gmtime(mtime + 1))})
+        assert rv.status_code == 304
+        rv = client.get('/_uploads/files/a.txt',
+                        headers={'Range': 'bytes=1-2'})
+        assert rv.status_code == 206
+        assert rv.data == b'el'
+
+
+class CountingBackend(MemoryStorage):
+    def __init__(self):
+        MemoryStorage.__init__(self)
+        self.stats = 0
+
+    def stat(self, name):
+        self.stats += 1
+        return MemoryStorage.stat(self, name)
+
+
+class TestStatCache(object):
+    def setup(self):
+        self.backend = CountingBackend()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_BACKEND=self.backend,
+                               UPLOADED_FILES_STAT_CACHE=2)
+        self.uset = UploadSet('files')
+        configure_uploads(self.app, self.uset)
+
+    def save(self, data, filename='a.txt'):
+        return self.uset.save(FileStorage(BytesIO(data), filename=filename))
+
+    def test_cached(self):
+        with self.app.app_context():
+            assert not self.uset.exists('a.txt')
+            assert self.uset.stat('a.txt') is None
+            assert self.backend.stats == 1
+            self.save(b'hello')
+            assert self.uset.exists('a.txt')
+            assert self.uset.stat('a.txt').size == 5
+            assert self.backend.stats == 2
+            assert self.uset.delete('a.txt')
+            assert self.uset.stat('a.txt') is None
+            assert self.backend.stats == 3
+
+    def test_served(self):
+        with self.app.app_context():
+            self.save(b'hello')
+        client = self.app.test_client()
+        assert client.get('/_uploads/files/a.txt').data == b'hello'
+        assert client.get('/_uploads/files/a.txt').data == b'hello'
+        assert self.backend.stats == 1
+        self.backend.delete('a.txt')
+        assert client.get('/_uploads/files/a.txt').status_code == 404
+        assert client.get('/_uploads/files/a.txt').status_code == 404
+        assert self.backend.stats == 2
+
+    def test_lru_and_ttl(self):
+        cache = StatCache(max_entries=2, ttl=60)
+        backend = CountingBackend()
+        for name in ('a', 'b', 'a', 'c', 'a'):
+            cache.stat(backend, name)
+        assert list(cache.entries) == ['c', 'a']
+        assert backend.stats == 3
+        cache.ttl = -1
+        cache.stat(backend, 'x')
+        cache.stat(backend, 'x')
+        assert backend.stats == 5
+
+    def test_stale_answer_dropped(self):
+        cache = StatCache()
+        backend = CountingBackend()
+
+        class Racing(object):
+            def stat(self, name):
+                cache.invalidate('other')
+                return backend.stat(name)
+        assert cache.stat(Racing(), 'a') is None
+        assert 'a' not in cache.entries
+
+
+class TestSharding(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def app(self, shard, **options):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST=self.dest,
+                          UPLOADED_FILES_SHARD=shard, **options)
+        uset = UploadSet('files')
+        configure_uploads(app, uset)
+        return app, uset
+
+    def storage(self, data=b'data', filename='photo.jpg'):
+        return FileStorage(BytesIO(data), filename=filename)
+
+    def test_hash(self):
+        app, uset = self.app('hash')
+        digest = hashlib.sha256(b'photo.jpg').hexdigest()
+        shard = '%s/%s' % (digest[:2], digest[2:4])
+        with app.test_request_context():
+            name = uset.save(self.storage())
+            assert name == shard + '/photo.jpg'
+            assert uset.save(self.storage()) == shard + '/photo_1.jpg'
+            assert uset.save(self.storage(), folder='users') == \
+                'users/' + shard + '/photo.jpg'
+            assert uset.path(name) == os.path.join(self.dest, shard,
+                                                   'photo.jpg')
+            assert uset.url(name).endswith('/_uploads/files/' + name)
+            assert uset.exists(name)
+        assert app.test_client().get('/_uploads/files/' + name).data == \
+            b'data'
+
+    def test_date_and_callable(self):
+        app, uset = self.app('date')
+        with app.app_context():
+            name = uset.save(self.storage())
+        assert name == time.strftime('%Y/%m/%d/photo.jpg', time.gmtime())
+        app, uset = self.app(lambda storage, basename: basename[0])
+        with app.app_context():
+            assert uset.save(self.storage()) == 'p/photo.jpg'
+        try:
+            self.app('sideways')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("accepted an unknown shard policy")
+
+    def test_save_many(self):
+        app, uset = self.app(lambda storage, basename: basename[0])
+        with app.app_context():
+            results = uset.save_many([self.storage(filename=n) for n in
+                                      ('a.txt', 'b.txt', 'a.txt')])
+        assert results == ['a/a.txt', 'b/b.txt', 'a/a_1.txt']
+        assert sorted(os.listdir(os.path.join(self.dest, 'a'))) == \
+            ['a.txt', 'a_1.txt']
+
+    def test_content_addressed_unsharded(self):
+        app, uset = self.app('date', UPLOADED_FILES_CONTENT_ADDRESSED=True)
+        with app.app_context():
+            name = uset.save(self.storage())
+        assert name == content_name(hashlib.sha256(b'data').hexdigest(),
+                                    'jpg')
+
+
+class TestListing(object):
+    files = {'a.txt': b'a', 'b.jpg': b'bb', 'sub/c.txt': b'ccc',
+             'sub/deep/d.txt': b'dddd', '.blobs/ab/cd/x': b'xxxxx',
+             'sub/.e.part': b'eeeeee'}
+
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def check(self, uset):
+        assert sorted(uset.iter_files()) == ['a.txt', 'b.jpg', 'sub/c.txt',
+                                             'sub/deep/d.txt']
+        assert sorted(uset.iter_files(recursive=False)) == ['a.txt', 'b.jpg']
+        assert sorted(uset.iter_files('sub')) == ['sub/c.txt',
+                                                  'sub/deep/d.txt']
+        assert list(uset.iter_files('sub', recursive=False)) == ['sub/c.txt']
+        assert list(uset.iter_files('missing')) == []
+        assert uset.disk_usage() == 10
+        assert uset.disk_usage('sub') == 7
+
+    def test_local(self):
+        for name, data in self.files.items():
+            path = os.path.join(self.dest, *name.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+        os.symlink('/etc', os.path.join(self.dest, 'link'))
+        uset = UploadSet('files')
+        uset._config = Config(self.dest)
+        files = uset.iter_files()
+        assert not isinstance(files, list)
+        self.check(uset)
+
+    def test_memory(self):
+        backend = MemoryStorage()
+        for name, data in self.files.items():
+            backend.files[name] = (data, 0)
+        uset = UploadSet('files')
+        uset._config = Config(None, backend=backend)
+        self.check(uset)
+
+    def test_s3(self):
+        if mock_aws is None:
+            return
+        with mock_aws():
+            client = boto3.client('s3', region_name='us-east-1')
+            client.create_bucket(Bucket='uploads')
+            for name, data in self.files.items():
+                client.put_object(Bucket='uploads', Key='files/' + name,
+                                  Body=data)
+            client.put_object(Bucket='uploads', Key='other/z.txt', Body=b'z')
+            uset = UploadSet('files')
+            uset._config = Config(None, backend=S3Storage(
+                'uploads', 'files/', client=client))
+            self.check(uset)
+
+
+class TestVariants(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        if Image is None:
+            return
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_PHOTOS_DEST=self.dest,
+                               UPLOADED_PHOTOS_VARIANTS={'thumb': (20, 10)})
+        self.uset = UploadSet('photos')
+        configure_uploads(self.app, self.uset)
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def image(self, filename='cat.png', size=(100, 40), color='red'):
+        data = BytesIO()
+        Image.new('RGB', size, color).save(data, 'PNG')
+        data.seek(0)
+        return FileStorage(data, filename=filename)
+
+    def open_variant(self, data):
+        return Image.open(BytesIO(data))
+
+    def test_lazy(self):
+        if Image is None:
+            return
+        client = self.app.test_client()
+        with self.app.test_request_context():
+            name = self.uset.save(self.image())
+            url = self.uset.url(name, variant='thumb')
+            assert url == 'http://localhost/_uploads/photos/cat.png' \
+                '?variant=thumb'
+            assert self.uset.urls([name], variant='thumb') == [url]
+            try:
+                self.uset.url(name, variant='huge')
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("linked to an unknown variant")
+        vpath = os.path.join(self.dest, '.variants', 'thumb', 'cat.png')
+        assert not os.path.exists(vpath)
+        rv = client.get('/_uploads/photos/cat.png?variant=thumb')
+        assert rv.status_code == 200
+        assert self.open_variant(rv.data).size == (20, 8)
+        assert os.path.exists(vpath)
+        assert client.get('/_uploads/photos/cat.png?variant=huge'
+                          ).status_code == 404
+        assert client.get('/_uploads/photos/dog.png?variant=thumb'
+                          ).status_code == 404
+        assert client.get('/_uploads/photos/.variants/thumb/cat.png'
+                          ).status_code == 404
+
+    def test_remade_when_replaced(self):
+        if Image is None:
+            return
+        with self.app.app_context():
+            name = self.uset.save(self.image())
+            vname = self.uset.make_variant(name, 'thumb')
+            assert vname == '.variants/thumb/cat.png'
+            with open(self.uset.path(name), 'wb') as f:
+                f.write(self.image(size=(10, 100)).read())
+            st = os.stat(self.uset.path(name))
+            os.utime(self.uset.path(name), ns=(st.st_atime_ns,
+                                               st.st_mtime_ns + 1000000000))
+            assert self.uset.make_variant(name, 'thumb') == vname
+            with open(self.uset.path(vname), 'rb') as f:
+                assert self.open_variant(f.read()).size == (1, 10)
+            self.uset.delete(name)
+            assert not os.path.exists(self.uset.path(vname))
+
+    def test_not_an_image(self):
+        if Image is None:
+            return
+        self.app.config['UPLOADED_PHOTOS_ALLOW'] = ['txt']
+        configure_uploads(self.app, self.uset)
+        with self.app.app_context():
+            name = self.uset.save(FileStorage(BytesIO(b'text'),
+                                              filename='a.txt'))
+            assert self.uset.make_variant(name, 'thumb') is None
+        rv = self.app.test_client().get('/_uploads/photos/a.txt?variant=thumb')
+        assert rv.data == b'text'
+
+    def test_eager(self):
+        if Image is None:
+            return
+        self.app.config['UPLOADED_PHOTOS_VARIANTS_EAGER'] = True
+        configure_uploads(self.app, self.uset)
+        with self.app.app_context():
+            self.uset.save(self.image())
+        self.app.upload_executor.shutdown(wait=True)
+        assert os.path.exists(os.path.join(self.dest, '.variants', 'thumb',
+                                           'cat.png'))
+
+
+class TestProcessing(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config['UPLOADED_FILES_DEST'] = self.dest
+        self.uset = UploadSet('files')
+        configure_uploads(self.app, self.uset)
+
+    def teardown(self):
+        queue = getattr(self.app, 'upload_processing_queue', None)
+        if queue is not None:
+            queue.shutdown()
+        shutil.rmtree(self.dest)
+
+    def upload(self, filename='a.txt'):
+        return FileStorage(BytesIO(b'data'), filename=filename)
+
+    def test_stages_run_in_order(self):
+        seen = []
+
+        @self.uset.processor
+        def first(uset, name):
+            seen.append(('first', uset.name, name, os.path.exists(
+                uset.path(name))))
+
+        @self.uset.processor(name='second')
+        def other(uset, name):
+            seen.append(('second', name))
+
+        with self.app.app_context():
+            name = self.uset.save(self.upload())
+            self.app.upload_processing_queue.shutdown()
+            status = self.uset.processing_status(name)
+        assert seen == [('first', 'files', 'a.txt', True),
+                        ('second', 'a.txt')]
+        assert status.state == 'done'
+        assert status.error is None
+
+    def test_retries(self):
+        calls = []
+
+        @self.uset.processor(retries=2, retry_delay=0.001)
+        def flaky(uset, name):
+            calls.append(name)
+            if len(calls) < 3:
+                raise IOError("try again")
+
+        with self.app.app_context():
+            name = self.uset.save(self.upload())
+            self.app.upload_processing_queue.shutdown()
+            status = self.uset.processing_status(name)
+        assert len(calls) == 3
+        assert status.state == 'done'
+
+    def test_failure(self):
+        after = []
+
+        @self.uset.processor(retries=1, retry_delay=0.001)
+        def broken(uset, name):
+            raise ValueError("bad file")
+
+        @self.uset.processor
+        def later(uset, name):
+            after.append(name)
+
+        with self.app.app_context():
+            name = self.uset.save(self.upload())
+            self.app.upload_processing_queue.shutdown()
+            status = self.uset.processing_status(name)
+        assert status.state == 'failed'
+        assert status.stage == 'broken'
+        assert status.attempts == 2
+        assert isinstance(status.error, ValueError)
+        assert after == []
+
+    def test_backpressure(self):
+        release = threading.Event()
+        queue = LocalProcessingQueue(workers=1, max_pending=1, wait=0.05)
+        self.app.config['UPLOADS_PROCESSING_QUEUE'] = queue
+
+        @self.uset.processor
+        def slow(uset, name):
+            release.wait(5)
+
+        try:
+            with self.app.app_context():
+                assert self.uset.save(
+                    self.upload('a.txt')).processing_error is None
+                saved = self.uset.save(self.upload('b.txt'))
+                assert isinstance(saved.processing_error, ProcessingQueueFull)
+                assert saved.processing_error.name == 'b.txt'
+                assert os.path.exists(os.path.join(self.dest, 'b.txt'))
+                results = self.uset.save_many([self.upload('c.txt')])
+                assert results == ['c.txt']
+                assert isinstance(results[0].processing_error,
+                                  ProcessingQueueFull)
+                release.set()
+                queue.wait = None
+                self.uset.process('b.txt')
+                queue.shutdown()
+                assert self.uset.processing_status('b.txt').state == 'done'
+        finally:
+            release.set()
+            queue.shutdown()
+
+    def test_queue_full_archive_and_resumable(self):
+        release = threading.Event()
+        queue = LocalProcessingQueue(workers=1, max_pending=1, wait=0.05)
+        self.app.config.update(UPLOADS_PROCESSING_QUEUE=queue,
+                               UPLOADED_FILES_RESUMABLE=True)
+        configure_uploads(self.app, self.uset)
+
+        @self.uset.processor
+        def slow(uset, name):
+            release.wait(5)
+
+        data = BytesIO()
+        with zipfile.ZipFile(data, 'w') as archive:
+            archive.writestr('f1.txt', b'one')
+            archive.writestr('f2.txt', b'two')
+        data.seek(0)
+        client = self.app.test_client()
+        try:
+            with self.app.app_context():
+                self.uset.save(self.upload('a.txt'))
+                saved = self.uset.save_archive(
+                    FileStorage(data, filename='files.zip'))
+            assert sorted(saved) == ['f1.txt', 'f2.txt']
+            assert all(isinstance(name.processing_error, ProcessingQueueFull)
+                       for name in saved)
+
+            metadata = 'filename ' + base64.b64encode(b'r.txt').decode('ascii')
+            location = client.post('/_uploads/files/.resumable', headers={
+                'Upload-Length': '4', 'Upload-Metadata': metadata,
+                'Tus-Resumable': '1.0.0'}).headers['Location']
+            client.patch(location, data=b'data', headers={
+                'Upload-Offset': '0',
+                'Content-Type': 'application/offset+octet-stream'})
+            rv = client.post(location + '/finalize')
+            assert rv.status_code == 201
+            assert rv.get_json()['filename'] == 'r.txt'
+            assert client.head(location).status_code == 404
+        finally:
+            release.set()
+            queue.shutdown()
+
+    def test_no_stages(self):
+        with self.app.app_context():
+            name = self.uset.save(self.upload())
+            assert getattr(self.app, 'upload_processing_queue', None) is None
+            assert self.uset.processing_status(name) is None
+
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 20
+
+
+class TestSniffing(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_PHOTOS_DEST=self.dest,
+                               UPLOADED_PHOTOS_SNIFF=True,
+                               UPLOADED_PHOTOS_ALLOW=['txt'])
+        self.uset = UploadSet('photos', IMAGES)
+        configure_uploads(self.app, self.uset)
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def test_table(self):
+        table = SignatureTable(IMAGES)
+        assert 'png' in table and 'PNG' in table
+        assert 'pdf' not in table and 'svg' not in table
+        assert table.matches('png', PNG)
+        assert not table.matches('png', b'<html>')
+        assert table.matches('webp', b'RIFF\x10\x00\x00\x00WEBPVP8 ')
+        assert not table.matches('webp', b'RIFF\x10\x00\x00\x00WAVEfmt ')
+        assert table.matches('svg', b'<html>')
+        archives = SignatureTable(ARCHIVES)
+        assert archives.size == 262
+        assert archives.matches('tar', b'\x00' * 257 + b'ustar\x0000')
+        assert not archives.matches('tar', b'\x00' * 300)
+        assert SignatureTable(DOCUMENTS).matches('docx', b'PK\x03\x04rest')
+
+    def test_spoofed(self):
+        with self.app.app_context():
+            try:
+                self.uset.save(FileStorage(BytesIO(b'<html><script>'),
+                                           filename='cat.jpg'))
+            except UploadNotAllowed:
+                pass
+            else:
+                raise AssertionError("saved HTML as a JPEG")
+            assert os.listdir(self.dest) == []
+            name = self.uset.save(FileStorage(BytesIO(PNG),
+                                              filename='cat.png'))
+        with open(os.path.join(self.dest, name), 'rb') as f:
+            assert f.read() == PNG
+
+    def test_unchecked_extensions(self):
+        with self.app.app_context():
+            assert self.uset.save(FileStorage(BytesIO(b'<svg/>'),
+                                              filename='a.svg')) == 'a.svg'
+            assert self.uset.save(FileStorage(BytesIO(b'text'),
+                                              filename='a.txt')) == 'a.txt'
+
+    def test_unseekable(self):
+        self.app.config['UPLOADED_PHOTOS_MAX_SIZE'] = 100
+        configure_uploads(self.app, self.uset)
+        with self.app.app_context():
+            name = self.uset.save(FileStorage(Unseekable(PNG),
+                                              filename='cat.png'))
+            assert not self.uset.file_allowed(
+                FileStorage(Unseekable(b'GIF89a'), filename='cat.png'),
+                'cat.png')
+        with open(os.path.join(self.dest, name), 'rb') as f:
+            assert f.read() == PNG
+
+    def test_config_looked_up_once(self):
+        self.app.config['UPLOADED_PHOTOS_CONTENT_TYPES'] = ['image/*']
+        configure_uploads(self.app, self.uset)
+        lookup = flask_uploads._current_app
+        calls = []
+
+        def counting():
+            calls.append(1)
+            return lookup()
+        flask_uploads._current_app = counting
+        try:
+            with self.app.app_context():
+                self.uset.save(FileStorage(BytesIO(PNG), filename='cat.png',
+                                           content_type='image/png'))
+        finally:
+            flask_uploads._current_app = lookup
+        assert len(calls) == 1
+
+    def test_overridden_checks(self):
+        class PickySet(UploadSet):
+            def content_allowed(self, storage, ext):
+                return storage.filename != 'evil.png'
+
+        uset = PickySet('photos', IMAGES)
+        with self.app.app_context():
+            assert uset.save(FileStorage(BytesIO(b'no magic'),
+                                         filename='cat.png')) == 'cat.png'
+            try:
+                uset.save(FileStorage(BytesIO(PNG), filename='evil.png'))
+            except UploadNotAllowed:
+                pass
+            else:
+                raise AssertionError("overridden check wasn't used")
+
+    def test_off_by_default(self):
+        self.app.config['UPLOADED_PHOTOS_SNIFF'] = False
+        configure_uploads(self.app, self.uset)
+        with self.app.app_context():
+            assert self.uset.save(FileStorage(BytesIO(b'<html>'),
+                                              filename='cat.jpg'))
+
+    def test_extra_signatures(self):
+        self.app.config['UPLOADED_PHOTOS_SNIFF'] = {'txt': (b'hello',)}
+        configure_uploads(self.app, self.uset)
+        with self.app.app_context():
+            assert self.uset.save(FileStorage(BytesIO(b'hello world'),
+                                              filename='a.txt'))
+            try:
+                self.uset.save(FileStorage(BytesIO(b'bye'), filename='b.txt'))
+            except UploadNotAllowed:
+                pass
+            else:
+                raise AssertionError("extra signature wasn't checked")
+            assert not self.uset.file_allowed(
+                FileStorage(BytesIO(b'<html>'), filename='cat.png'),
+                'cat.png')
+
+
+CSV = b'id,name,colour\n' + b''.join(b'%d,cat,red\n' % i for i in range(200))
+
+
+class TestCompression(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_FILES_DEST=self.dest,
+                               UPLOADED_FILES_ALLOW=['png'],
+                               UPLOADED_FILES_COMPRESS=['gzip'])
+        self.uset = UploadSet('files')
+        configure_uploads(self.app, self.uset)
+        self.client = self.app.test_client()
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def save(self, data=CSV, filename='export.csv'):
+        with self.app.app_context():
+            return self.uset.save(FileStorage(BytesIO(data),
+                                              filename=filename))
+
+    def test_sibling(self):
+        name = self.save()
+        gz = os.path.join(self.dest, '.compressed', 'export.csv.gz')
+        assert os.path.getsize(gz) < len(CSV)
+        assert os.stat(gz).st_mtime_ns == \
+            os.stat(os.path.join(self.dest, name)).st_mtime_ns
+        rv = self.client.get('/_uploads/files/export.csv',
+                             headers={'Accept-Encoding': 'br, gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert rv.headers['Vary'] == 'Accept-Encoding'
+        assert rv.mimetype == 'text/csv'
+        assert gzip.decompress(rv.data) == CSV
+        rv = self.client.get('/_uploads/files/export.csv')
+        assert 'Content-Encoding' not in rv.headers
+        assert rv.headers['Vary'] == 'Accept-Encoding'
+        assert rv.data == CSV
+        with self.app.app_context():
+            assert list(self.uset.iter_files()) == ['export.csv']
+            self.uset.delete(name)
+        assert not os.path.exists(gz)
+
+    def test_stale_sibling(self):
+        name = self.save()
+        path = os.path.join(self.dest, name)
+        with open(path, 'wb') as f:
+            f.write(b'replaced')
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        rv = self.client.get('/_uploads/files/export.csv',
+                             headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in rv.headers
+        assert rv.data == b'replaced'
+
+    def test_not_compressed(self):
+        self.save(b'x', 'tiny.txt')
+        self.save(CSV, 'image.png')
+        assert os.listdir(os.path.join(self.dest, '.compressed')) == []
+        rv = self.client.get('/_uploads/files/image.png',
+                             headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in rv.headers
+        assert 'Vary' not in rv.headers
+
+    def test_compress_only(self):
+        self.app.config['UPLOADED_FILES_COMPRESS_ONLY'] = True
+        configure_uploads(self.app, self.uset)
+        name = self.save()
+        with open(os.path.join(self.dest, name), 'rb') as f:
+            assert gzip.decompress(f.read()) == CSV
+        assert not os.path.exists(os.path.join(self.dest, '.compressed'))
+        rv = self.client.get('/_uploads/files/export.csv',
+                             headers={'Accept-Encoding': 'gzip'})
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(rv.data) == CSV
+        rv = self.client.get('/_uploads/files/export.csv')
+        assert 'Content-Encoding' not in rv.headers
+        assert rv.headers['Vary'] == 'Accept-Encoding'
+        assert rv.data == CSV
+        with self.app.app_context():
+            with self.uset.open(name) as f:
+                assert f.read() == CSV
+            assert self.uset.stat(name).size == len(CSV) == name.size
+
+    def test_configuration(self):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST=self.dest,
+                          UPLOADED_FILES_COMPRESS='gzip')
+        assert config_for_set(self.uset, app).compress == ('gzip',)
+        app.config['UPLOADED_FILES_COMPRESS'] = 'deflate'
+        try:
+            config_for_set(self.uset, app)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("accepted an unknown coding")
+        app.config.update(UPLOADED_FILES_COMPRESS=['gzip'],
+                          UPLOADED_FILES_COMPRESS_ONLY=True,
+                          UPLOADED_FILES_DEDUPLICATE=True)
+        try:
+            config_for_set(self.uset, app)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("compressed a deduplicated set in place")
+
+    def test_missing_libraries(self):
+        find_spec = flask_uploads.find_spec
+        flask_uploads.find_spec = lambda name: None
+        try:
+            for setting, value in (('COMPRESS', 'br'), ('COMPRESS', 'zstd'),
+                                   ('VARIANTS', {'thumb': (10, 10)})):
+                app = Flask(__name__)
+                app.config.update({'UPLOADED_FILES_DEST': self.dest,
+                                   'UPLOADED_FILES_' + setting: value})
+                try:
+                    config_for_set(self.uset, app)
+                except RuntimeError:
+                    pass
+                else:
+                    raise AssertionError("%s didn't need its library" % value)
+        finally:
+            flask_uploads.find_spec = find_spec
+
+
+class TestArchives(object):
+    def setup(self):
+        self.dest = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(UPLOADED_PHOTOS_DEST=self.dest,
+                               UPLOADED_PHOTOS_ARCHIVE_MAX_MEMBERS=10)
+        self.uset = UploadSet('photos', IMAGES)
+        configure_uploads(self.app, self.uset)
+
+    def teardown(self):
+        shutil.rmtree(self.dest)
+
+    def zip(self, members):
+        data = BytesIO()
+        with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, contents in members:
+                archive.writestr(name, contents)
+        data.seek(0)
+        return FileStorage(data, filename='photos.zip')
+
+    def tar(self, members, stream=BytesIO):
+        data = BytesIO()
+        with tarfile.open(fileobj=data, mode='w:gz') as archive:
+            for name, contents in members:
+                info = tarfile.TarInfo(name)
+                if contents is None:
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = '/etc/passwd'
+                    archive.addfile(info)
+                else:
+                    info.size = len(contents)
+                    archive.addfile(info, BytesIO(contents))
+        return FileStorage(stream(data.getvalue()), filename='photos.tar.gz')
+
+    def listing(self):
+        with self.app.app_context():
+            return sorted(self.uset.iter_files())
+
+    def refused(self, storage, error=UploadNotAllowed):
+        with self.app.app_context():
+            try:
+                self.uset.save_archive(storage)
+            except error:
+                pass
+            else:
+                raise AssertionError("archive wasn't refused")
+        assert self.listing() == []
+
+    def test_zip(self):
+        storage = self.zip([('cat.png', PNG), ('trip/dog.jpg', b'jpeg'),
+                            ('trip/', b''), ('notes.txt', b'text'),
+                            ('__MACOSX/._cat.png', b'junk'),
+                            ('.hidden.png', PNG)])
+        with self.app.app_context():
+            saved = self.uset.save_archive(storage, folder='upload')
+        assert saved == ['upload/cat.png', 'upload/trip/dog.jpg']
+        assert saved[0].size == len(PNG)
+        assert self.listing() == saved
+        with open(os.path.join(self.dest, 'upload', 'cat.png'), 'rb') as f:
+            assert f.read() == PNG
+
+    def test_tar(self):
+        for stream in (BytesIO, Unseekable):
+            storage = self.tar([('a/cat.png', PNG), ('link.png', None),
+                                ('a/notes.txt', b'text')], stream)
+            with self.app.app_context():
+                saved = self.uset.save_archive(storage)
+                assert saved == ['a/cat.png']
+                self.uset.delete(saved[0])
+
+    def test_zip_slip(self):
+        self.refused(self.zip([('cat.png', PNG), ('../evil.png', PNG)]))
+        self.refused(self.zip([('/etc/evil.png', PNG)]))
+        self.refused(self.tar([('cat.png', PNG), ('a/../../evil.png', PNG)]))
+
+    def test_limits(self):
+        self.refused(self.zip([('%d.png' % i, PNG) for i in range(11)]),
+                     UploadTooLarge)
+        bomb = b'\x00' * (3 * 1024 * 1024)
+        self.refused(self.zip([('cat.png', PNG), ('bomb.png', bomb)]),
+                     UploadTooLarge)
+        self.refused(self.tar([('cat.png', PNG), ('bomb.png', bomb)]),
+                     UploadTooLarge)
+        self.app.config.update(UPLOADED_PHOTOS_ARCHIVE_MAX_SIZE=100,
+                               UPLOADED_PHOTOS_ARCHIVE_MAX_RATIO=None)
+        configure_uploads(self.app, self.uset)
+        self.refused(self.tar([('cat.png', PNG), ('dog.png', b'x' * 100)]),
+                     UploadTooLarge)
+
+    def test_unreadable(self):
+        self.refused(FileStorage(BytesIO(b'not a zip'), filename='a.zip'))
+        self.refused(FileStorage(BytesIO(b'7z'), filename='a.7z'))
+
+
 class TestPathsAndURLs(object):
     def test_path(self):
         uset = UploadSet('files')
@@ -323,6 +2309,45 @@ class TestPathsAndURLs(object):
                           filename='foo.txt', _external=True)
             assert url == gen
 
+    def test_urls(self):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST='/uploads')
+        uset = UploadSet('files')
+        configure_uploads(app, uset)
+        names = ['foo.txt', 'a b/c#d?.jpg', u'\u5929.png', '100%.gif', '']
+        for base in ('http://localhost/', 'https://example.com:8443/app/'):
+            with app.test_request_context(base_url=base):
+                gen = [url_for('_uploads.uploaded_file', setname='files',
+                               filename=name, _external=True)
+                       for name in names]
+                assert uset.urls(names) == gen
+                assert [uset.url(name) for name in names] == gen
+                assert gen[0].startswith(base)
+
+    def test_urls_with_url_defaults(self):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST='/uploads')
+        uset = UploadSet('files')
+        configure_uploads(app, uset)
+
+        @app.url_defaults
+        def add_version(endpoint, values):
+            values.setdefault('v', '2')
+        with app.test_request_context():
+            assert uset.urls(['a.txt', 'b.txt']) == [
+                'http://localhost/_uploads/files/a.txt?v=2',
+                'http://localhost/_uploads/files/b.txt?v=2']
+
+    def test_urls_based(self):
+        app = Flask(__name__)
+        app.config.update(UPLOADED_FILES_DEST='/uploads',
+                          UPLOADED_FILES_URL='http://localhost:5001/')
+        uset = UploadSet('files')
+        configure_uploads(app, uset)
+        with app.test_request_context():
+            assert uset.urls(['a.txt', 'b/c.txt']) == [
+                'http://localhost:5001/a.txt', 'http://localhost:5001/b/c.txt']
+
     def test_url_based(self):
         app = Flask(__name__)
         app.config.update(